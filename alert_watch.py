@@ -0,0 +1,367 @@
+# Weather Alert Pro - alert watcher and Server-Sent Events streams
+# Copyright (c) 2025 Donald Bryant
+# Pushes changes to weather alerts to the browser instead of having it poll
+# /api/alerts.
+#
+# - POST /api/alerts/watch registers up to WATCH_MAX_LOCATIONS locations and
+#   returns a watch token; GET /api/alerts/stream?watch=<token> is an
+#   EventSource stream for them.
+# - A single scheduler (a lease keeps it to one process at a time) polls each
+#   distinct grid cell with a live watch once per alerts TTL (5 minutes, longer
+#   when the daily budget runs low; see ttl_policy.py), through the shared One
+#   Call cache, and diffs its alerts against the previous poll. Only
+#   new, changed and expired alerts are written to alert_events, so upstream
+#   cost follows the number of watched cells, not the number of clients.
+# - Each server process reads new events once per STREAM_TICK into a small
+#   in-memory buffer that all of its streams read from. A stream starts with a
+#   snapshot of the current alerts (or, on reconnect, the events after
+#   Last-Event-ID) and then sends only changes, plus a comment every HEARTBEAT
+#   seconds to keep proxies from closing it.
+# - A watch is dropped WATCH_TTL seconds after its last stream closed.
+#
+# Under CGI a stream cannot stay open: it sends what is pending and closes with
+# a retry hint, and the browser reconnects with Last-Event-ID. Run the polling
+# from cron instead of a background thread:
+#
+#     * * * * * cd /path/to/cgi-bin && python3 alert_watch.py
+import os
+import json
+import time
+import hashlib
+import secrets
+import threading
+from collections import Counter, deque
+
+import cache_store
+import quota
+import singleflight
+import ttl_policy
+
+POLL_TICK = 15  # how often the scheduler looks for locations that are due
+POLL_LEASE = 'alert-watch'
+POLL_LEASE_TTL = 300
+ALERT_QUOTA_SHARE = 0.2
+WATCH_MAX_LOCATIONS = 10
+WATCH_TTL = 600
+TOUCH_INTERVAL = 60  # how often open streams mark their watch as alive
+STREAM_TICK = 1.0
+HEARTBEAT = 15
+RETRY_MS = 30000  # reconnect delay for streams that cannot stay open
+BUFFER_SIZE = 1000
+READ_LIMIT = 500
+EVENT_RETENTION = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alert_watches (
+    token TEXT NOT NULL,
+    key TEXT NOT NULL,
+    label TEXT NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (token, key)
+);
+CREATE INDEX IF NOT EXISTS alert_watches_key ON alert_watches (key);
+CREATE TABLE IF NOT EXISTS alert_polls (
+    key TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS alert_state (
+    key TEXT NOT NULL,
+    alert_id TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    alert TEXT NOT NULL,
+    PRIMARY KEY (key, alert_id)
+);
+CREATE TABLE IF NOT EXISTS alert_events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    alert TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alert_events_key ON alert_events (key, id);
+"""
+
+_schema_ready = threading.local()
+# Events read by this process: (id, key, kind, alert JSON), complete after _buffer_from
+_buffer = deque()
+_buffer_from = None
+_buffer_lock = threading.Lock()
+_open = Counter()  # watch token -> streams open in this process
+_reader_pid = None
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+# --- Watches ---
+def register(locations, token=None):
+    """Watch [(key, label), ...] under token (a new one if None); return the token."""
+    token = token or secrets.token_urlsafe(16)
+    now = time.time()
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM alert_watches WHERE token = ?', (token,))
+        conn.executemany('INSERT OR REPLACE INTO alert_watches (token, key, label, last_seen) VALUES (?, ?, ?, ?)',
+                         [(token, key, label, now) for key, label in locations[:WATCH_MAX_LOCATIONS]])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return token
+
+def watched(token):
+    """Return {key: label} for a live watch token (empty if unknown or expired)."""
+    try:
+        rows = connect().execute('SELECT key, label FROM alert_watches WHERE token = ? AND last_seen > ?',
+                                 (token, time.time() - WATCH_TTL)).fetchall()
+    except Exception:
+        return {}
+    return dict(rows)
+
+def touch(tokens):
+    if not tokens:
+        return
+    try:
+        connect().executemany('UPDATE alert_watches SET last_seen = ? WHERE token = ?',
+                              [(time.time(), token) for token in tokens])
+    except Exception:
+        pass
+
+# --- Polling ---
+def alert_id(alert):
+    """Identity of an alert across polls; its text may change, these do not."""
+    ident = f"{alert.get('sender_name')}|{alert.get('event')}|{alert.get('start')}"
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:16]
+
+def digest(alert):
+    return hashlib.sha1(json.dumps(alert, sort_keys=True).encode('utf-8')).hexdigest()
+
+def diff(key, alerts, now=None):
+    """Store the alerts now in effect for key; return the number of events written."""
+    now = now or time.time()
+    current = {}
+    for alert in alerts:
+        if alert.get('end') and alert['end'] <= now:
+            continue
+        current[alert_id(alert)] = (digest(alert), alert)
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        previous = {aid: (dig, text) for aid, dig, text in
+                    conn.execute('SELECT alert_id, digest, alert FROM alert_state WHERE key = ?', (key,))}
+        events = []
+        for aid, (dig, alert) in current.items():
+            if aid not in previous or previous[aid][0] != dig:
+                text = json.dumps(alert)
+                events.append(('new' if aid not in previous else 'changed', text))
+                conn.execute('INSERT OR REPLACE INTO alert_state (key, alert_id, digest, alert) VALUES (?, ?, ?, ?)',
+                             (key, aid, dig, text))
+        for aid, (dig, text) in previous.items():
+            if aid not in current:
+                events.append(('expired', text))
+                conn.execute('DELETE FROM alert_state WHERE key = ? AND alert_id = ?', (key, aid))
+        conn.executemany('INSERT INTO alert_events (ts, key, kind, alert) VALUES (?, ?, ?, ?)',
+                         [(now, key, kind, text) for kind, text in events])
+        conn.execute('INSERT OR REPLACE INTO alert_polls (key, ts) VALUES (?, ?)', (key, now))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return len(events)
+
+def due_keys(now, interval):
+    """Distinct watched locations not polled within interval seconds, oldest first."""
+    return [key for key, in connect().execute(
+        'SELECT DISTINCT w.key FROM alert_watches w LEFT JOIN alert_polls p ON p.key = w.key '
+        'WHERE w.last_seen > ? AND (p.ts IS NULL OR p.ts <= ?) ORDER BY p.ts',
+        (now - WATCH_TTL, now - interval))]
+
+def prune(now):
+    conn = connect()
+    conn.execute('DELETE FROM alert_watches WHERE last_seen <= ?', (now - WATCH_TTL,))
+    conn.execute('DELETE FROM alert_state WHERE key NOT IN (SELECT key FROM alert_watches)')
+    conn.execute('DELETE FROM alert_polls WHERE key NOT IN (SELECT key FROM alert_watches)')
+    conn.execute('DELETE FROM alert_events WHERE ts < ?', (now - EVENT_RETENTION,))
+
+def run_pass(refresh):
+    """Poll every due location once. Returns the number of events written."""
+    if not singleflight.acquire_lease(POLL_LEASE, ttl=POLL_LEASE_TTL):
+        return 0
+    try:
+        now = time.time()
+        prune(now)
+        budget = ('alerts', int(quota.API_DAILY_LIMIT * ALERT_QUOTA_SHARE))
+        interval = ttl_policy.ttl('alerts')
+        written = 0
+        for key in due_keys(now, interval):
+            entry = cache_store.get_entry('onecall', key)
+            if entry and time.time() - entry[0] < interval:
+                result = entry[1]
+            else:
+                result, cached, error = refresh('onecall', key, pool=budget)
+                if error:
+                    # Out of budget or upstream trouble: try again next tick
+                    continue
+            written += diff(key, result.get('alerts', []))
+        return written
+    finally:
+        singleflight.release_lease(POLL_LEASE)
+
+def run_forever(refresh):
+    while True:
+        time.sleep(POLL_TICK)
+        try:
+            run_pass(refresh)
+        except Exception:
+            pass
+
+# --- Event buffer (one reader per process) ---
+def latest_id():
+    try:
+        return connect().execute('SELECT COALESCE(MAX(id), 0) FROM alert_events').fetchone()[0]
+    except Exception:
+        return 0
+
+def read_events():
+    """Move events written since the last read into the buffer."""
+    global _buffer_from
+    with _buffer_lock:
+        after = _buffer[-1][0] if _buffer else _buffer_from
+    rows = connect().execute('SELECT id, key, kind, alert FROM alert_events WHERE id > ? ORDER BY id LIMIT ?',
+                             (after, READ_LIMIT)).fetchall()
+    with _buffer_lock:
+        _buffer.extend(rows)
+        while len(_buffer) > BUFFER_SIZE:
+            _buffer_from = _buffer.popleft()[0]
+
+def run_reader():
+    last_touch = 0
+    while True:
+        time.sleep(STREAM_TICK)
+        try:
+            read_events()
+            if time.time() - last_touch >= TOUCH_INTERVAL:
+                last_touch = time.time()
+                with _buffer_lock:
+                    tokens = [token for token, count in _open.items() if count > 0]
+                touch(tokens)
+        except Exception:
+            pass
+
+def start_reader():
+    """Start this process's event reader, once (streams held open need it)."""
+    global _reader_pid, _buffer_from
+    with _buffer_lock:
+        if _reader_pid == os.getpid():
+            return
+        _reader_pid = os.getpid()
+        _buffer.clear()
+        _buffer_from = latest_id()
+    threading.Thread(target=run_reader, name='alert-reader', daemon=True).start()
+
+def covered(cursor):
+    """True if the buffer holds every event after cursor (no database read needed)."""
+    return _reader_pid == os.getpid() and _buffer_from is not None and cursor >= _buffer_from
+
+def events_after(keys, cursor):
+    """Return ([(id, key, kind, alert JSON), ...], new cursor) for keys after event id cursor."""
+    with _buffer_lock:
+        if covered(cursor):
+            rows = [row for row in _buffer if row[0] > cursor]
+            return [row for row in rows if row[1] in keys], rows[-1][0] if rows else cursor
+    marks = ','.join('?' * len(keys))
+    # Read up to the latest id taken first: an event written meanwhile stays
+    # above the new cursor instead of being skipped
+    latest = latest_id()
+    try:
+        rows = connect().execute(
+            f'SELECT id, key, kind, alert FROM alert_events WHERE id > ? AND id <= ? AND key IN ({marks}) '
+            'ORDER BY id LIMIT ?', (cursor, latest, *keys, READ_LIMIT)).fetchall()
+    except Exception:
+        return [], cursor
+    return rows, rows[-1][0] if rows else max(cursor, latest)
+
+# --- Server-Sent Events ---
+def sse(event, data, event_id=None):
+    lines = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{lines}event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+def snapshot(locations, cursor):
+    marks = ','.join('?' * len(locations))
+    alerts = {key: [] for key in locations}
+    try:
+        for key, text in connect().execute(
+                f'SELECT key, alert FROM alert_state WHERE key IN ({marks}) ORDER BY key, alert_id', tuple(locations)):
+            alerts[key].append(json.loads(text))
+    except Exception:
+        pass
+    return sse('snapshot', {'locations': [{'key': key, 'location': label, 'alerts': alerts[key]}
+                                          for key, label in locations.items()]}, cursor)
+
+def render_events(locations, rows):
+    return ''.join(sse('alert', {'kind': kind, 'key': key, 'location': locations.get(key), 'alert': json.loads(text)}, eid)
+                   for eid, key, kind, text in rows)
+
+def opening(token, last_event_id=None):
+    """Start a stream: return (locations, cursor, first chunk); locations is empty for a bad token."""
+    locations = watched(token)
+    if not locations:
+        return {}, None, sse('watch-expired', {'error': 'Unknown or expired watch token'})
+    touch([token])
+    try:
+        cursor = int(last_event_id)
+    except (TypeError, ValueError):
+        cursor = None
+    if cursor is None:
+        # Take the cursor first: an event landing in between is sent twice, never lost
+        cursor = latest_id()
+        return locations, cursor, snapshot(locations, cursor)
+    rows, cursor = events_after(locations, cursor)
+    return locations, cursor, render_events(locations, rows)
+
+def pending(locations, cursor):
+    """Return (chunk, new cursor) with the events for locations after cursor."""
+    rows, cursor = events_after(locations, cursor)
+    return render_events(locations, rows), cursor
+
+def hold(token):
+    with _buffer_lock:
+        _open[token] += 1
+
+def release(token):
+    with _buffer_lock:
+        _open[token] -= 1
+        if _open[token] <= 0:
+            del _open[token]
+
+def stream(token, last_event_id=None, keep_open=True):
+    """Yield the SSE stream for a watch token (for a WSGI response)."""
+    locations, cursor, chunk = opening(token, last_event_id)
+    yield chunk
+    if not locations:
+        return
+    if not keep_open:
+        yield f'retry: {RETRY_MS}\n\n'
+        return
+    start_reader()
+    hold(token)
+    try:
+        idle = 0
+        while True:
+            time.sleep(STREAM_TICK)
+            chunk, cursor = pending(locations, cursor)
+            idle = 0 if chunk else idle + STREAM_TICK
+            if idle >= HEARTBEAT:
+                chunk, idle = ': keep-alive\n\n', 0
+            if chunk:
+                yield chunk
+    finally:
+        release(token)
+
+if __name__ == '__main__':
+    import app
+    print(f'{run_pass(app.refresh)} alert events written')
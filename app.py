@@ -24,7 +24,7 @@ Dependencies:
 - Python 3.x
 - flup advanced web server integration
 - flask lets you create web servers and REST APIs in Python
-- requests for API calls
+- requests for API calls (pooled through upstream.py)
 - OpenWeatherMap API key required
 
 This project demonstrates advanced Python programming with:
@@ -64,37 +64,47 @@ SOFTWARE.
 import sys, os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'site-packages'))
 # Copy this file to cgi-bin/app.py
-from flask import Flask, request, render_template, jsonify, send_from_directory
-import json
+from flask import Flask, request, render_template, jsonify, send_from_directory, has_request_context, Response
+from markupsafe import escape
+import re
 import time
-import requests
+import gzip
+import hashlib
+import mimetypes
 import traceback
+import threading
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import cache_store
+import geocode_cache
+import usage_log
+import metrics
+import quota
+import upstream
+import singleflight
+import prewarm
+import projection
+import conversion
+import spatial
+import alert_watch
+import ttl_policy
+import history_store
+import breaker
+import postal_index
 
-def decode_bytes(obj):
-    if isinstance(obj, bytes):
-        return obj.decode('utf-8')
-    elif isinstance(obj, dict):
-        return {k: decode_bytes(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [decode_bytes(v) for v in obj]
-    else:
-        return obj
-        
-app = Flask(__name__, template_folder='templates', static_folder='static')
+# /static is served by static_files() below (gzip variants, immutable hashed assets)
+app = Flask(__name__, template_folder='templates', static_folder=None)
 
 # Weather alerts endpoint
-@app.route('/api/alerts', methods=['POST'])
+@app.route('/api/alerts', methods=['GET', 'POST'])
 def api_alerts():
-    allowed, usage_count = increment_api_counter()
-    if not allowed:
-        return jsonify(success=False, error=f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow.")
     try:
-        data = request.get_json(force=True, silent=True) or {}
+        data = request_data()
         city = data.get('city')
         state = data.get('state')
         zip_code = data.get('zip_code')
         country = data.get('country')
-        units = data.get('units', 'imperial')
 
         if not API_KEY:
             return jsonify(success=False, error='API key not set')
@@ -103,52 +113,153 @@ def api_alerts():
         if not lat or not lon:
             return jsonify(success=False, error='Location not found')
 
-        cache_key = f'{lat},{lon},{units}'
-        cached = get_cached_result('alerts', cache_key)
-        if cached:
-            return jsonify(success=True, data=cached, city=city, state=state, country=country, cached=True)
+        cache_key = location_key(lat, lon)
+        variant = f'alerts|{lat},{lon}|{city}|{state}|{country}'
+        hit = cached_response('onecall', cache_key, variant)
+        if hit:
+            return hit
 
-        url = f'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={API_KEY}&units={units}'
-        try:
-            resp = requests.get(url, timeout=10)
-        except Exception as e:
-            return jsonify(success=False, error=f'Alerts API request failed: {str(e)}')
+        result, cached, error = fetch_onecall(lat, lon, 'Alerts')
+        if error:
+            return jsonify(success=False, error=error)
 
-        if not resp.ok:
-            try:
-                err = resp.json()
-                err_msg = err.get('message', str(err))
-            except Exception:
-                err_msg = resp.text
-            return jsonify(success=False, error=f'Alerts API error: {err_msg}')
-
-        result = resp.json()
-        alerts = result.get('alerts', [])
-        response_data = decode_bytes({'alerts': alerts})
-        set_cached_result('alerts', cache_key, response_data)
-        return jsonify(success=True, data=response_data, city=city, state=state, country=country, cached=False)
+        response_data = build_alerts(result)
+        return rendered_response('onecall', cache_key, variant if cached else None, result, dict(
+            success=True, data=response_data, city=city, state=state, country=country, cached=cached))
+    except Exception as e:
+        tb = traceback.format_exc()
+        return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# --- Alert subscriptions (see alert_watch.py) ---
+# Registration resolves each location once; the stream then only reads the
+# events the background poller writes, never geocoding or the One Call cache.
+@app.route('/api/alerts/watch', methods=['POST'])
+def api_alerts_watch():
+    try:
+        data = request_data()
+        requested = data.get('locations') or [data]
+        if not isinstance(requested, list) or len(requested) > alert_watch.WATCH_MAX_LOCATIONS:
+            return jsonify(success=False, error=f'Provide 1 to {alert_watch.WATCH_MAX_LOCATIONS} locations')
+        locations, watching, errors = [], [], []
+        for loc in requested:
+            loc = loc if isinstance(loc, dict) else {}
+            country = loc.get('country')
+            lat, lon, city, state = get_location(loc.get('city'), loc.get('state'), loc.get('zip_code'), country)
+            if not lat or not lon:
+                errors.append({'city': city, 'state': state, 'zip_code': loc.get('zip_code'), 'error': 'Location not found'})
+                continue
+            key = location_key(lat, lon)
+            locations.append((key, ', '.join(p for p in (city, state, country) if p)))
+            watching.append({'city': city, 'state': state, 'country': country, 'key': key})
+        if not locations:
+            return jsonify(success=False, error='Location not found', errors=errors)
+        token = alert_watch.register(locations, data.get('watch'))
+        return jsonify(success=True, watch=token, locations=watching, errors=errors)
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
 
+# Each open stream holds a worker thread here, so only STREAM_SLOTS of them stay
+# open per process; the rest (and every stream under CGI) send what is pending
+# and let the browser reconnect. asgi.py serves streams without this limit.
+STREAM_SLOTS = None
+
+@app.route('/api/alerts/stream', methods=['GET'])
+def api_alerts_stream():
+    token = request.args.get('watch', '')
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    def generate():
+        held = STREAM_SLOTS is not None and STREAM_SLOTS.acquire(blocking=False)
+        try:
+            yield from alert_watch.stream(token, last_event_id, keep_open=held)
+        finally:
+            if held:
+                STREAM_SLOTS.release()
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Usage dashboards ---
+# Both read only the pre-aggregated counters in usage_log.py and bounded pages
+# (events newest first, a cursor for older pages, the most recently used cache
+# keys), so their cost does not grow with traffic or cache size.
+USAGE_PAGE_SIZE = 50
+USAGE_MAX_HOURS = 24 * 7
+
+def breaker_report():
+    """Circuit state of each upstream host, with its calls and failures in the breaker window."""
+    tripped = {b['host']: b for b in breaker.status()}
+    calls = breaker.recent_calls()
+    report = []
+    for host in sorted(set(upstream.HOST_CONCURRENCY) | set(tripped)):
+        entry = tripped.get(host) or dict(host=host, state='closed', tripped_for=0, retry_in=0, trips=0,
+                                           trial=False, reason=None)
+        entry['calls'], entry['failures'] = calls.get(host, (0, 0))
+        report.append(entry)
+    return report
+
+def usage_report():
+    """Return the data behind /api/usage and /api/usage/html for the current request."""
+    try:
+        hours = max(1, min(int(request.args.get('hours', 24)), USAGE_MAX_HOURS))
+        limit = int(request.args.get('limit', USAGE_PAGE_SIZE))
+        before = request.args.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        hours, limit, before = 24, USAGE_PAGE_SIZE, None
+    today, count = get_api_usage()
+    usage = usage_log.summary(hours)
+    entries = cache_store.stats()
+    cache = {feature: dict(entries=n, hits=0, misses=0, hit_ratio=None) for feature, n in entries.items()}
+    for feature, outcome in usage['cache'].items():
+        cache.setdefault(feature, dict(entries=0)).update(outcome)
+    events, next_before = usage_log.recent_events(before, limit)
+    return {
+        'date': today,
+        'api_requests_today': count,
+        'api_daily_limit': API_DAILY_LIMIT,
+        'hours': hours,
+        'requests': usage['endpoints'],
+        'hourly': [dict(hour=h, requests=r, cache_hits=hit, cache_misses=miss) for h, r, hit, miss in usage['hourly']],
+        'top_client_locations': [dict(location=loc, requests=n) for loc, n in usage['locations']],
+        'top_requested': [dict(feature=f, key=k, hits=n) for f, k, n in usage_log.top_demand(days=1, limit=10)],
+        'cache': cache,
+        'upstream': breaker_report(),
+        'recently_used': [dict(feature=f, key=k, ts=ts, last_access=la) for f, k, ts, la in cache_store.recent()],
+        'events': [dict(id=i, ts=ts, endpoint=e, ip=ip, location=loc) for i, ts, e, ip, loc in events],
+        'next_before': next_before,
+    }
+
+def local_time(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+def html_rows(rows, columns):
+    if not rows:
+        return f"<tr><td colspan='{columns}'>None yet.</td></tr>"
+    return ''.join('<tr>' + ''.join(f'<td>{escape(str(cell))}</td>' for cell in row) + '</tr>' for row in rows)
+
 # User-friendly HTML dashboard for API usage and cache
 @app.route('/api/usage/html', methods=['GET'])
 def api_usage_html():
-    today, count = get_api_usage()
-    cache = load_cache()
-    # Read recent API usage log entries
-    usage_log_rows = ""
-    log_path = os.path.join(os.path.dirname(__file__), 'api_usage_log.txt')
-    try:
-        with open(log_path, 'r') as f:
-            lines = f.readlines()[-50:]  # Show last 50 entries
-        for line in reversed(lines):
-            parts = line.strip().split('|')
-            if len(parts) == 4:
-                dt, endpoint, ip, location = [p.strip() for p in parts]
-                usage_log_rows += f"<tr><td>{dt}</td><td>{endpoint}</td><td>{ip}</td><td>{location}</td></tr>"
-    except Exception:
-        usage_log_rows = "<tr><td colspan='4'>No usage log found or error reading log.</td></tr>"
+    report = usage_report()
+    older = ''
+    if report['next_before']:
+        older = f"<p><a href='?before={report['next_before']}&hours={report['hours']}'>Older entries &raquo;</a></p>"
+    requests_rows = html_rows(sorted(report['requests'].items()), 2)
+    hourly_rows = html_rows([(h['hour'] + ':00', h['requests'], h['cache_hits'], h['cache_misses'])
+                             for h in reversed(report['hourly'])], 4)
+    location_rows = html_rows([(l['location'], l['requests']) for l in report['top_client_locations']], 2)
+    demand_rows = html_rows([(d['feature'], d['key'], d['hits']) for d in report['top_requested']], 3)
+    cache_rows = html_rows([(f, c['entries'], c['hits'], c['misses'],
+                             '-' if c['hit_ratio'] is None else f"{c['hit_ratio']:.1%}")
+                            for f, c in sorted(report['cache'].items())], 5)
+    recent_rows = html_rows([(r['feature'], r['key'], local_time(r['ts']), local_time(r['last_access']))
+                             for r in report['recently_used']], 4)
+    event_rows = html_rows([(local_time(e['ts']), e['endpoint'], e['ip'], e['location'])
+                            for e in report['events']], 4)
+    upstream_rows = html_rows([(u['host'], u['state'], f"{u['tripped_for']}s" if u['state'] != 'closed' else '-',
+                                f"{u['retry_in']}s" if u['state'] != 'closed' else '-', u['calls'], u['failures'],
+                                u['reason'] or '') for u in report['upstream']], 7)
 
     html = f"""
     <html>
@@ -167,165 +278,157 @@ def api_usage_html():
         <div class="section">
             <h2>Usage</h2>
             <table>
-                <tr><th>Date</th><td>{today}</td></tr>
-                <tr><th>API Requests Today</th><td>{count}</td></tr>
+                <tr><th>Date</th><td>{report['date']}</td></tr>
+                <tr><th>API Requests Today</th><td>{report['api_requests_today']}</td></tr>
                 <tr><th>API Daily Limit</th><td>{API_DAILY_LIMIT}</td></tr>
             </table>
         </div>
         <div class="section">
-            <h2>Recent API Usage Log (IP & Location)</h2>
+            <h2>Upstream Services (last {breaker.WINDOW} seconds)</h2>
             <table>
-                <tr><th>Date/Time</th><th>Endpoint</th><th>IP</th><th>Location</th></tr>
-                {usage_log_rows}
+                <tr><th>Host</th><th>Circuit</th><th>Tripped For</th><th>Next Trial In</th><th>Calls</th><th>Failures</th><th>Reason</th></tr>
+                {upstream_rows}
             </table>
         </div>
         <div class="section">
-            <h2>Cache Contents</h2>
+            <h2>Requests per Endpoint (last {report['hours']} hours)</h2>
             <table>
-                <tr><th>Feature</th><th>Key</th><th>Timestamp</th><th>Data (truncated)</th></tr>
-    """
-    for feature, items in cache.items():
-        for key, (ts, data) in items.items():
-            short_data = str(data)
-            if len(short_data) > 100:
-                short_data = short_data[:100] + '...'
-            html += f"<tr><td>{feature}</td><td>{key}</td><td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))}</td><td>{short_data}</td></tr>"
-    html += """
+                <tr><th>Endpoint</th><th>Requests</th></tr>
+                {requests_rows}
+            </table>
+        </div>
+        <div class="section">
+            <h2>Requests per Hour</h2>
+            <table>
+                <tr><th>Hour</th><th>Requests</th><th>Cache Hits</th><th>Cache Misses</th></tr>
+                {hourly_rows}
+            </table>
+        </div>
+        <div class="section">
+            <h2>Cache</h2>
+            <table>
+                <tr><th>Feature</th><th>Entries</th><th>Hits</th><th>Misses</th><th>Hit Ratio</th></tr>
+                {cache_rows}
+            </table>
+            <table>
+                <tr><th>Feature</th><th>Key</th><th>Fetched</th><th>Last Used</th></tr>
+                {recent_rows}
             </table>
         </div>
+        <div class="section">
+            <h2>Top Client Locations</h2>
+            <table>
+                <tr><th>Location</th><th>Requests</th></tr>
+                {location_rows}
+            </table>
+        </div>
+        <div class="section">
+            <h2>Most Requested Locations Today</h2>
+            <table>
+                <tr><th>Feature</th><th>Key</th><th>Requests</th></tr>
+                {demand_rows}
+            </table>
+        </div>
+        <div class="section">
+            <h2>Recent API Usage Log (IP & Location)</h2>
+            <table>
+                <tr><th>Date/Time</th><th>Endpoint</th><th>IP</th><th>Location</th></tr>
+                {event_rows}
+            </table>
+            {older}
+        </div>
     </body>
     </html>
     """
     return html
 
-# Endpoint to view API usage and cache contents
+# Endpoint to view API usage and cache statistics
+# Query parameters: hours (aggregation window), limit and before (event page cursor)
 @app.route('/api/usage', methods=['GET'])
 def api_usage():
-    today, count = get_api_usage()
-    cache = load_cache()
-    return jsonify({
-        'date': today,
-        'api_requests_today': count,
-        'api_daily_limit': API_DAILY_LIMIT,
-        'cache': cache
-    })
+    return jsonify(usage_report())
 
-# --- File-based API usage counter ---
-API_COUNTER_FILE = os.path.join(os.path.dirname(__file__), 'api_counter.txt')
-API_DAILY_LIMIT = 1000
+# --- Upstream quota (see quota.py) ---
+# Charged only when a request actually goes upstream, never on cache hits.
+API_DAILY_LIMIT = quota.API_DAILY_LIMIT
 # --- API usage log with IP and location ---
-API_USAGE_LOG_FILE = os.path.join(os.path.dirname(__file__), 'api_usage_log.txt')
+# Events are queued and written by usage_log.py, so the ip-api.com lookup and the
+# database write never delay the response.
+@metrics.timed('log')
 def log_api_usage(endpoint):
-    ip = request.remote_addr or 'unknown'
-    location = 'unknown'
-    try:
-        geo_resp = requests.get(f'http://ip-api.com/json/{ip}', timeout=3)
-        if geo_resp.ok:
-            geo = geo_resp.json()
-            if geo.get('status') == 'success':
-                location = f"{geo.get('city','')}, {geo.get('regionName','')}, {geo.get('country','')}"
-    except Exception:
-        pass
-    log_line = f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {endpoint} | {ip} | {location}\n"
-    try:
-        with open(API_USAGE_LOG_FILE, 'a') as f:
-            f.write(log_line)
-    except Exception:
-        pass
+    usage_log.record(endpoint, request.remote_addr)
 
 # --- Daily Reset Logic ---
-def daily_reset():
-    today = time.strftime('%Y-%m-%d')
-    # Reset API usage log if date changed
-    log_path = API_USAGE_LOG_FILE
-    counter_path = API_COUNTER_FILE
-    cache_path = CACHE_FILE
-    # Check counter file for date
-    last_date = None
-    if os.path.exists(counter_path):
-        try:
-            with open(counter_path, 'r') as f:
-                line = f.read().strip()
-                if line:
-                    last_date = line.split(',')[0]
-        except Exception:
-            pass
-    if last_date != today:
-        # Clear log file
-        try:
-            with open(log_path, 'w') as f:
-                f.write('')
-        except Exception:
-            pass
-        # Clear cache file
-        try:
-            with open(cache_path, 'w') as f:
-                json.dump({}, f)
-        except Exception:
-            pass
-        # Reset counter file
-        try:
-            with open(counter_path, 'w') as f:
-                f.write(f'{today},0')
-        except Exception:
-            pass
+# Runs once, in whichever process first sees the new day
+def daily_reset(day):
+    # Drop usage events and counters past their retention
+    usage_log.prune()
+    usage_log.prune_demand()
+    spatial.prune()
+    history_store.prune()
+    breaker.prune()
+quota.ROLLOVER_HOOKS.append(daily_reset)
 
-def get_api_usage():
-    daily_reset()
-    today = time.strftime('%Y-%m-%d')
-    if not os.path.exists(API_COUNTER_FILE):
-        return today, 0
-    try:
-        with open(API_COUNTER_FILE, 'r') as f:
-            line = f.read().strip()
-            if line:
-                date, count = line.split(',')
-                if date == today:
-                    return date, int(count)
-    except Exception:
-        pass
-    return today, 0
+# --- Request timing and metrics (see metrics.py) ---
+# Every response carries a Server-Timing header with the time spent in each
+# phase (log, location, cache, upstream, render) and in total.
+@app.before_request
+def start_timing():
+    metrics.begin()
+    ttl_policy.begin()
+
+@app.after_request
+def add_server_timing(resp):
+    timing = metrics.finish(request.url_rule.rule if request.url_rule else 'unmatched')
+    if timing:
+        resp.headers['Server-Timing'] = timing
+    if ttl_policy.stale_age() is not None:
+        resp.headers['Warning'] = ttl_policy.STALE_WARNING
+    return resp
 
-def increment_api_counter():
+# Prometheus scrape endpoint: totals over every process sharing api_cache.db
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
     today, count = get_api_usage()
-    if count >= API_DAILY_LIMIT:
-        return False, count
-    count += 1
-    with open(API_COUNTER_FILE, 'w') as f:
-        f.write(f'{today},{count}')
-    return True, count
-
-# --- File-based cache ---
-CACHE_FILE = os.path.join(os.path.dirname(__file__), 'api_cache.json')
-CACHE_TTL = 900  # 15 minutes
-def load_cache():
-    if not os.path.exists(CACHE_FILE):
-        return {}
-    try:
-        with open(CACHE_FILE, 'r') as f:
-            return json.load(f)
-    except Exception:
-        return {}
+    gauges = [
+        ('weather_quota_daily_limit', 'Upstream calls allowed per day', API_DAILY_LIMIT),
+        ('weather_quota_used', 'Upstream calls charged today', count),
+        ('weather_quota_remaining', 'Upstream calls left today', max(0, API_DAILY_LIMIT - count)),
+        ('weather_ttl_stretch', 'Factor cache TTLs are stretched by to pace the daily quota', ttl_policy.stretch()),
+        ('weather_upstream_circuits_open', 'Upstream hosts whose circuit breaker is open or half-open', len(breaker.status())),
+    ]
+    return Response(metrics.exposition(gauges), mimetype='text/plain; version=0.0.4')
+
+def get_api_usage():
+    return quota.usage()
+
+def client_ip():
+    return request.remote_addr if has_request_context() else None
 
-def save_cache(cache):
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(cache, f)
+# --- Keyed cache (see cache_store.py) ---
+# Entries survive the daily reset and the store itself is size-bounded with LRU
+# eviction. How long an entry counts as fresh depends on the view asking for it
+# and on how much of the daily budget is left (see ttl_policy.py).
+# Past its TTL an entry is still served for up to this long while it is
+# refreshed in the background (stale-while-revalidate)
+STALE_MAX_AGE = 3600
+REFRESH_LEASE_TTL = 30
 
-def get_cached_result(feature, key):
-    cache = load_cache()
-    entry = cache.get(feature, {}).get(key)
+def get_cached_result(feature, key, ttl=None):
+    ttl = ttl or ttl_policy.ttl(feature)
+    entry = cache_store.get_entry(feature, key, max_age=ttl)
     if entry:
         ts, data = entry
-        if time.time() - ts < CACHE_TTL:
+        if time.time() - ts < ttl:
             return data
     return None
 
-def set_cached_result(feature, key, data):
-    cache = load_cache()
-    if feature not in cache:
-        cache[feature] = {}
-    cache[feature][key] = [time.time(), data]
-    save_cache(cache)
+def set_cached_result(feature, key, data, ts=None):
+    cache_store.set_entry(feature, key, data, ts)
+    spatial.index(feature, key)
+    # New One Call data (not a copy from a nearby cell) also goes into the history
+    if feature == 'onecall' and ts is None:
+        history_store.record(key, data)
 
 API_KEY = None
 API_KEY_PATH = os.path.join(os.path.dirname(__file__), 'apikey.txt')
@@ -336,199 +439,562 @@ if os.path.exists(API_KEY_PATH):
 
 # Helper to get lat/lon from city/state/zip
 
+GEOCODE_TIMEOUT = 5
+
+# lookup_zip/lookup_city return (lat, lon, city, state) on success, None when the
+# service says the place does not exist (cached as a failure), or False when the
+# lookup could not be made (rate limit, timeout, server error; not cached).
+@metrics.timed('location')
 def get_location(city, state, zip_code, country=None):
     # Default country to US if state is provided and country is missing
     if not country and state:
         country = 'US'
-    # Try zip code lookup (US only, fallback to global if country provided)
+    # Try zip code lookup: the local postal index, then zippopotam for codes it lacks
     if zip_code:
-        if country and country.upper() != 'US':
-            # Try Zippopotam.us for other countries
-            resp = requests.get(f'https://api.zippopotam.us/{country.lower()}/{zip_code}')
-        else:
-            resp = requests.get(f'https://api.zippopotam.us/us/{zip_code}')
-        if resp.ok:
-            data = resp.json()
-            lat = float(data['places'][0]['latitude'])
-            lon = float(data['places'][0]['longitude'])
-            city = data['places'][0]['place name']
-            state = data['places'][0].get('state abbreviation', '')
-            return lat, lon, city, state
+        key = geocode_cache.zip_key(zip_code, country)
+        hit = postal_index.lookup(zip_code, country) or geocode_cache.lookup(key)
+        if hit is None:
+            hit = lookup_zip(zip_code, country)
+            if hit:
+                geocode_cache.store(key, *hit)
+            elif hit is None:
+                geocode_cache.store_failure(key, f'ZIP code not found: {zip_code} ({country or "US"})')
+            else:
+                geocode_cache.log_failure(f'{key} | ZIP lookup unavailable for {zip_code}')
+        if hit:
+            return hit
     # City/country/state lookup (global)
     if city:
-        city_clean = city.strip().title()
-        geo_url = 'https://api.openweathermap.org/geo/1.0/direct'
-        key = API_KEY or os.environ.get('OPENWEATHERMAP_API_KEY')
-        q = city_clean
-        if state:
-            q += f',{state.strip()}'
-        if country:
-            q += f',{country.strip()}'
-        params = {
-            'q': q,
-            'limit': 1,
-            'appid': key
-        }
-        print(f"DEBUG: Geocoding query: {params['q']}", file=sys.stderr)
-        resp = requests.get(geo_url, params=params)
-        try:
+        key = geocode_cache.city_key(city, state, country)
+        hit = geocode_cache.lookup(key)
+        if hit is None:
+            place = ', '.join(p for p in (city, state, country) if p)
+            hit = lookup_city(city, state, country)
+            if hit:
+                geocode_cache.store(key, *hit)
+            elif hit is None:
+                geocode_cache.store_failure(key, f'City not found: {place}')
+            else:
+                geocode_cache.log_failure(f'{key} | City lookup unavailable for {place}')
+        if hit:
+            return hit
+    return None, None, city, state
+
+def lookup_zip(zip_code, country):
+    # Zippopotam.us covers the US and many other countries
+    country_code = country.lower() if country and country.upper() != 'US' else 'us'
+    if not quota.charge('zippopotam', daily=False)[0]:
+        return False
+    try:
+        resp = upstream.get(f'{upstream.ZIPPOPOTAM_URL}/{country_code}/{zip_code}', timeout=GEOCODE_TIMEOUT)
+        if resp.status_code == 404:
+            return None
+        if resp.ok:
+            place = resp.json()['places'][0]
+            return float(place['latitude']), float(place['longitude']), place['place name'], place.get('state abbreviation', '')
+    except Exception:
+        pass
+    return False
+
+def lookup_city(city, state, country):
+    city_clean = city.strip().title()
+    geo_url = f'{upstream.OPENWEATHERMAP_URL}/geo/1.0/direct'
+    key = API_KEY or os.environ.get('OPENWEATHERMAP_API_KEY')
+    q = city_clean
+    if state:
+        q += f',{state.strip()}'
+    if country:
+        q += f',{country.strip()}'
+    params = {
+        'q': q,
+        'limit': 1,
+        'appid': key
+    }
+    if not quota.charge('geocode', daily=False)[0]:
+        return False
+    try:
+        resp = upstream.get(geo_url, params=params, timeout=GEOCODE_TIMEOUT)
+        if resp.ok:
             data = resp.json()
-        except Exception:
-            data = None
-        print(f"DEBUG: Geocoding API response: {data}", file=sys.stderr)
-        if resp.ok and data and len(data) > 0:
+            if not data:
+                return None
             d = data[0]
             return d['lat'], d['lon'], d.get('name', city_clean), d.get('state', state)
-    return None, None, city, state
+    except Exception:
+        pass
+    return False
+
+# --- Shared One Call fetch layer ---
+# /api/weather, /api/forecast, /api/alerts and /api/uv are all views over the same
+# One Call response, so it is fetched and cached once per grid cell (see
+# spatial.py), always in conversion.CANONICAL_UNITS; each response is converted
+# to the requested units.
+# A miss is answered from a nearby cell's entry when one is younger than
+# NEIGHBOR_MAX_AGE of the feature's TTL; the entry is copied to the requested
+# cell, which then keeps it until it expires like any other entry.
+ONECALL_URL = f'{upstream.OPENWEATHERMAP_URL}/data/3.0/onecall'
+AIR_POLLUTION_URL = f'{upstream.OPENWEATHERMAP_URL}/data/2.5/air_pollution'
+NEIGHBOR_MAX_AGE = 0.5
+
+def location_key(lat, lon):
+    """Cache key for a location: its grid cell."""
+    return spatial.cell_key(lat, lon)
+
+def upstream_error_message(resp):
+    try:
+        err = resp.json()
+        return err.get('message', str(err))
+    except Exception:
+        return resp.text
+
+def cached_hit(feature, cache_key, ttl=None):
+    cached = get_cached_result(feature, cache_key, ttl)
+    return (cached, True, None) if cached else None
+
+def fetch_upstream(feature, cache_key, endpoint, url, label, client=None, view=None):
+    """Return (result, cached, error) for url, cached under feature/cache_key.
+
+    client defaults to the address of the current request; pass it explicitly
+    when fetching from a worker thread. view selects the TTL (see ttl_policy.py).
+    """
+    usage_log.record_demand(feature, cache_key)
+    ttl = ttl_policy.ttl(view or feature)
+    with metrics.span('cache'):
+        entry = cache_store.get_entry(feature, cache_key, max_age=ttl)
+    if entry:
+        age = time.time() - entry[0]
+        if age < ttl:
+            usage_log.record_cache(feature, True)
+            return entry[1], True, None
+        if ttl_policy.exhausted():
+            # Nothing left to refresh it with today: serve it, marked stale
+            usage_log.record_cache(feature, True)
+            return stale_hit(feature, cache_key, entry)
+        if age < STALE_MAX_AGE + ttl:
+            # Answer with the stale copy now and refresh it off the request path
+            usage_log.record_cache(feature, True)
+            refresh_in_background(feature, cache_key)
+            return entry[1], True, None
+    usage_log.record_cache(feature, False)
+    client = client or client_ip()
+    # Identical misses in flight (other threads or processes) share one upstream call
+    return singleflight.do(f'{feature}:{cache_key}',
+                           lambda: fetch_and_cache(feature, cache_key, endpoint, url, label, client, ttl=ttl),
+                           lambda: cached_hit(feature, cache_key, ttl))
+
+def nearby_hit(feature, cache_key, refresh=False, ttl=None):
+    """Copy a young entry from a nearby cell to cache_key; return (result, True, None) or None."""
+    max_age = (ttl or ttl_policy.ttl(feature)) * NEIGHBOR_MAX_AGE
+    if refresh:
+        # A refresh must not copy back data as old as what it replaces
+        own = cache_store.get_entry(feature, cache_key)
+        if own:
+            max_age = min(max_age, time.time() - own[0])
+    near = spatial.nearest(feature, cache_key, max_age)
+    entry = cache_store.get_entry(feature, near[0]) if near else None
+    if not entry:
+        return None
+    set_cached_result(feature, cache_key, entry[1], ts=entry[0])
+    metrics.inc('weather_cache_nearby_total', feature=feature)
+    return entry[1], True, None
+
+def stale_hit(feature, cache_key, entry=None):
+    """Serve the newest data there is for cache_key (or, failing that, a nearby
+    cell), whatever its age, and mark the response stale. None if there is none."""
+    entry = entry or cache_store.get_entry(feature, cache_key)
+    if not entry:
+        near = spatial.nearest(feature, cache_key, ttl_policy.STALE_NEIGHBOR_MAX_AGE)
+        entry = cache_store.get_entry(feature, near[0]) if near else None
+    if not entry:
+        return None
+    ttl_policy.mark_stale(entry[0])
+    metrics.inc('weather_stale_responses_total', feature=feature)
+    return entry[1], True, None
+
+def unavailable(feature, cache_key, force, error):
+    """Out of quota or upstream down: old data beats an error (background refreshes just fail)."""
+    return (None if force else stale_hit(feature, cache_key)) or (None, False, error)
+
+def fetch_and_cache(feature, cache_key, endpoint, url, label, client, force=False, pool=None, ttl=None):
+    # Another process may have filled the cache while we waited for the lease
+    hit = None if force else cached_hit(feature, cache_key, ttl)
+    if hit:
+        return hit
+    hit = nearby_hit(feature, cache_key, refresh=force, ttl=ttl)
+    if hit:
+        return hit
+    host = upstream.host_of(url)
+    if breaker.refusing(host):
+        # Fail fast (and uncharged) while the host's circuit is open
+        return unavailable(feature, cache_key, force, f'{label} service unavailable: {host} is not responding')
+    allowed, error = quota.charge(endpoint, client, pool=pool)
+    if not allowed:
+        return unavailable(feature, cache_key, force, error)
+    try:
+        resp = upstream.get(url)
+    except Exception as e:
+        return unavailable(feature, cache_key, force, f'{label} API request failed: {str(e)}')
+    if resp.status_code in upstream.RETRY_STATUSES:
+        return unavailable(feature, cache_key, force, f'{label} API error: {upstream_error_message(resp)}')
+    if not resp.ok:
+        return None, False, f'{label} API error: {upstream_error_message(resp)}'
+    result = resp.json()
+    set_cached_result(feature, cache_key, result)
+    return result, False, None
+
+def onecall_url(lat, lon):
+    return f'{ONECALL_URL}?lat={lat}&lon={lon}&appid={API_KEY}&units={conversion.CANONICAL_UNITS}'
+
+def air_quality_url(lat, lon):
+    return f'{AIR_POLLUTION_URL}?lat={lat}&lon={lon}&appid={API_KEY}'
+
+def fetch_onecall(lat, lon, label='Weather', client=None):
+    """Return (result, cached, error) for the One Call data of lat/lon's grid cell, in canonical units.
+
+    The label ('Weather', 'Forecast', 'Alerts', 'UV') also names the view whose TTL applies.
+    """
+    key = location_key(lat, lon)
+    return fetch_upstream('onecall', key, 'onecall', onecall_url(*key.split(',')), label, client, view=label.lower())
+
+def fetch_air_quality(lat, lon):
+    """Return (result, cached, error) for the air pollution data of lat/lon's grid cell."""
+    key = location_key(lat, lon)
+    return fetch_upstream('air_quality', key, 'air_pollution', air_quality_url(*key.split(',')), 'Air Quality')
+
+def refresh(feature, cache_key, pool=None):
+    """Re-fetch one cache entry even if it is still fresh. Returns (result, cached, error)."""
+    # Older keys may be raw coordinates, or end in ',<units>' for One Call
+    cache_key = spatial.snap_key(cache_key)
+    if feature == 'onecall':
+        lat, lon = cache_key.split(',')
+        endpoint, url, label = 'onecall', onecall_url(lat, lon), 'Weather'
+    elif feature == 'air_quality':
+        lat, lon = cache_key.split(',')
+        endpoint, url, label = 'air_pollution', air_quality_url(lat, lon), 'Air Quality'
+    else:
+        return None, False, f'Unknown cache feature: {feature}'
+    return singleflight.do(f'{feature}:{cache_key}',
+                           lambda: fetch_and_cache(feature, cache_key, endpoint, url, label, None, force=True, pool=pool),
+                           lambda: cached_hit(feature, cache_key))
+
+def usable_entry(feature, cache_key):
+    """True if fetch_upstream would answer from the cache (fresh or stale)."""
+    ttl = ttl_policy.ttl(feature)
+    entry = cache_store.get_entry(feature, cache_key, max_age=ttl)
+    return bool(entry) and (ttl_policy.exhausted() or time.time() - entry[0] < STALE_MAX_AGE + ttl)
+
+def refresh_in_background(feature, cache_key):
+    # One refresh per key at a time, across processes
+    if not singleflight.acquire_lease(f'refresh:{feature}:{cache_key}', ttl=REFRESH_LEASE_TTL):
+        return
+    if PERSISTENT_MODE:
+        threading.Thread(target=refresh, args=(feature, cache_key), daemon=True).start()
+        return
+    # Under CGI a thread would hold the response open until it finished, so hand
+    # the refresh to a detached process instead
+    try:
+        subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prewarm.py'),
+                          'refresh', feature, cache_key],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         close_fds=True, start_new_session=True)
+    except Exception:
+        pass
+
+# --- Pre-rendered responses ---
+# A successful response is encoded once: the JSON body (as jsonify would write
+# it), a gzipped copy and a strong ETag. Cache-hit responses are stored next to
+# the cache entry they were built from (see cache_store.get_rendered), so later
+# hits send the stored bytes without rebuilding or re-serialising anything.
+# Entries are shared by a grid cell, so a variant names the requested lat/lon
+# as well as the place label: each place in a cell gets its own body and ETag.
+# GET clients can revalidate with If-None-Match / If-Modified-Since and get a 304.
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+def encode_json(payload):
+    return (app.json.dumps(payload, separators=(',', ':')) + '\n').encode('utf-8')
+
+@metrics.timed('render')
+def render(payload):
+    """Return (etag, body, gzip body or None) for a JSON payload."""
+    body = encode_json(dict(payload, **ttl_policy.stale_fields()))
+    packed = gzip.compress(body, GZIP_LEVEL, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+    return hashlib.sha1(body).hexdigest(), body, packed
+
+def request_data():
+    # GET (query string) requests can be revalidated by the browser; POST cannot
+    if request.method == 'GET':
+        return request.args.to_dict()
+    data = request.get_json(force=True, silent=True)
+    # Only an object holds parameters; any other JSON body counts as empty, as in asgi.py
+    return data if isinstance(data, dict) else {}
+
+def body_response(ts, etag, body, packed):
+    use_gzip = packed is not None and request.accept_encodings['gzip']
+    resp = Response(packed if use_gzip else body, mimetype='application/json')
+    # Always revalidate: the entry may be refreshed at any time
+    resp.headers['Cache-Control'] = 'no-cache'
+    # Each encoding is its own representation and gets its own strong ETag
+    resp.set_etag(etag + '-gz' if use_gzip else etag)
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    if packed is not None:
+        resp.vary.add('Accept-Encoding')
+    if ts:
+        resp.last_modified = ts
+    return resp.make_conditional(request)
+
+@metrics.timed('cache')
+def stored_hit(feature, cache_key, variant):
+    """Return (ts, etag, body, gzip) stored for a cache hit, or None (same freshness rules as fetch_upstream)."""
+    ttl = ttl_policy.ttl(ttl_policy.view_of(variant))
+    hit = cache_store.get_rendered(feature, cache_key, variant, max_age=ttl)
+    if not hit:
+        return None
+    age = time.time() - hit[0]
+    # Once the budget is spent, stale data goes through fetch_upstream to be marked
+    if age >= STALE_MAX_AGE + ttl or (age >= ttl and ttl_policy.exhausted()):
+        return None
+    usage_log.record_demand(feature, cache_key)
+    usage_log.record_cache(feature, True)
+    if age >= ttl:
+        refresh_in_background(feature, cache_key)
+    return hit
+
+def store_rendered(feature, cache_key, variant, result, payload):
+    """Encode payload, built from result, and keep it for later hits if variant is given."""
+    ts = cache_store.entry_ts(feature, cache_key, result)
+    etag, body, packed = render(payload)
+    if variant and ts and ttl_policy.stale_age() is None:
+        cache_store.set_rendered(feature, cache_key, variant, ts, etag, body, packed)
+    return ts, etag, body, packed
+
+def cached_response(feature, cache_key, variant):
+    hit = stored_hit(feature, cache_key, variant)
+    return body_response(*hit) if hit else None
+
+def rendered_response(feature, cache_key, variant, result, payload):
+    return body_response(*store_rendered(feature, cache_key, variant, result, payload))
+
+# --- Views built from a One Call result ---
+def deg_to_compass(deg):
+    dirs = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+            'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+    ix = int((deg/22.5)+0.5) % 16
+    return dirs[ix]
+
+def build_weather(result, city, state, lat, lon, country):
+    current = result.get('current', {})
+    wind_deg = current.get('wind_deg')
+    wind_dir = deg_to_compass(wind_deg) if wind_deg is not None else None
+    wind_speed_mps = current.get('wind_speed', 0)
+    wind_speed_mph = round(wind_speed_mps * 2.23694, 2)
+    pressure_hpa = current.get('pressure', 0)
+    pressure_inhg = round(pressure_hpa * 0.02953, 2)
+    # Build enhanced current data
+    enhanced_current = dict(current)
+    enhanced_current['wind_direction_degrees'] = wind_deg
+    enhanced_current['wind_direction_compass'] = wind_dir
+    enhanced_current['wind_speed_mph'] = wind_speed_mph
+    enhanced_current['pressure_inhg'] = pressure_inhg
+    return {
+        'current': enhanced_current,
+        'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon, 'country': country},
+        'timezone_offset': result.get('timezone_offset', 0)
+    }
+
+def build_forecast(result, city, state, lat, lon, country):
+    # Returns None when One Call did not include the forecast series
+    if 'hourly' not in result or 'daily' not in result:
+        return None
+    return {
+        'daily': result.get('daily', []),
+        'hourly': result.get('hourly', []),
+        'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon, 'country': country},
+        'timezone_offset': result.get('timezone_offset', 0)
+    }
+
+def build_alerts(result):
+    return {'alerts': result.get('alerts', [])}
+
+def build_uv(result, city, state, lat, lon):
+    current = result.get('current', {})
+    return {
+        'uvi': current.get('uvi', 0),
+        'sunrise': current.get('sunrise'),
+        'sunset': current.get('sunset'),
+        'clouds': current.get('clouds'),
+        'humidity': current.get('humidity'),
+        'pressure': current.get('pressure'),
+        'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon}
+    }
+
+# --- Persistent server mode (see weather.fcgi) ---
+# Under CGI every request is a new process, so no background work is started.
+# A long-running server calls enable_persistent_mode(); each worker process then
+# starts its background threads on its first request (this also covers children
+# forked by a preforking server).
+PERSISTENT_MODE = False
+SEED_PAUSE = 2.0  # seconds between seed lookups, to leave geocoding quota for users
+_background_pid = None
+
+def enable_persistent_mode(stream_slots=0):
+    """stream_slots: worker threads per process that alert streams may hold open."""
+    global PERSISTENT_MODE, STREAM_SLOTS
+    PERSISTENT_MODE = True
+    if stream_slots > 0:
+        STREAM_SLOTS = threading.BoundedSemaphore(stream_slots)
+
+def seed_geocode_cache():
+    geocode_cache.seed(lambda city, state, country: get_location(city, state, None, country), pause=SEED_PAUSE)
+
+@app.before_request
+def start_background():
+    global _background_pid
+    if PERSISTENT_MODE and _background_pid != os.getpid():
+        _background_pid = os.getpid()
+        usage_log.start_worker()
+        threading.Thread(target=seed_geocode_cache, name='geocode-seed', daemon=True).start()
+        threading.Thread(target=prewarm.run_forever, args=(refresh, ttl_policy.ttl), name='prewarm', daemon=True).start()
+        threading.Thread(target=alert_watch.run_forever, args=(refresh,), name='alert-watch', daemon=True).start()
+        threading.Thread(target=breaker.run_forever, args=(upstream.probe,), name='breaker-probe', daemon=True).start()
+
+# --- Page and static files ---
+# build_static.py writes content-hashed copies of the assets, precompressed
+# variants and the pre-rendered page to static/dist, normally served by the web
+# server itself. When requests do reach Python, they get the same treatment:
+# the built page (while it is newer than the template), .gz variants and
+# immutable caching for hashed names.
+STATIC_DIR = os.path.join(app.root_path, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TEMPLATE_PATH = os.path.join(app.root_path, 'templates', 'weather_alert_pro.html')
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{10}\.[^./]+$')
+IMMUTABLE_MAX_AGE = 31536000
+
+def send_static(directory, filename, immutable=False):
+    packed = filename + '.gz'
+    has_gzip = os.path.isfile(os.path.join(directory, packed))
+    use_gzip = has_gzip and request.accept_encodings['gzip']
+    resp = send_from_directory(directory, packed if use_gzip else filename,
+                               mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    if has_gzip:
+        resp.vary.add('Accept-Encoding')
+    if immutable:
+        resp.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return resp
+
+def built_page():
+    try:
+        return os.path.getmtime(os.path.join(DIST_DIR, 'index.html')) >= os.path.getmtime(TEMPLATE_PATH)
+    except OSError:
+        return False
 
 @app.route('/')
 def index():
+    if built_page():
+        resp = send_static(DIST_DIR, 'index.html')
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
     return render_template('weather_alert_pro.html')
 
 @app.route('/static/<path:filename>')
 def static_files(filename):
-    return send_from_directory(os.path.join(app.root_path, 'static'), filename)
+    return send_static(STATIC_DIR, filename, immutable=filename.startswith('dist/') and bool(HASHED_NAME_RE.search(filename)))
 
-@app.route('/api/weather', methods=['POST'])
+@app.route('/api/weather', methods=['GET', 'POST'])
 def api_weather():
     log_api_usage('/api/weather')
-    allowed, usage_count = increment_api_counter()
-    if not allowed:
-        return jsonify(success=False, error=f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow.")
     try:
-        data = request.get_json(force=True, silent=True) or {}
+        data = request_data()
         city = data.get('city')
         state = data.get('state')
         zip_code = data.get('zip_code')
         country = data.get('country')
-        units = data.get('units', 'imperial')
+        units = conversion.normalize(data.get('units', 'imperial'))
 
         if not API_KEY:
             return jsonify(success=False, error='API key not set')
+        try:
+            fields, fmt = projection.parse(data, 'weather')
+        except ValueError as e:
+            return jsonify(success=False, error=str(e))
 
         lat, lon, city, state = get_location(city, state, zip_code, country)
         if not lat or not lon:
             return jsonify(success=False, error='Location not found')
 
-        cache_key = f'{lat},{lon},{units}'
-        cached = get_cached_result('weather', cache_key)
-        if cached:
-            return jsonify(success=True, data=cached, city=city, state=state, country=country, cached=True)
+        cache_key = location_key(lat, lon)
+        variant = f'weather|{units}|{lat},{lon}|{city}|{state}|{country}' + projection.variant(fields, fmt)
+        hit = cached_response('onecall', cache_key, variant)
+        if hit:
+            return hit
 
-        url = f'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={API_KEY}&units={units}'
-        try:
-            resp = requests.get(url, timeout=10)
-        except Exception as e:
-            return jsonify(success=False, error=f'Weather API request failed: {str(e)}')
+        result, cached, error = fetch_onecall(lat, lon, 'Weather')
+        if error:
+            return jsonify(success=False, error=error)
 
-        if not resp.ok:
-            try:
-                err = resp.json()
-                err_msg = err.get('message', str(err))
-            except Exception:
-                err_msg = resp.text
-            return jsonify(success=False, error=f'Weather API error: {err_msg}')
-
-        result = resp.json()
-        current = result.get('current', {})
-        # Wind direction conversion
-        def deg_to_compass(deg):
-            dirs = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
-                    'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
-            ix = int((deg/22.5)+0.5) % 16
-            return dirs[ix]
-        wind_deg = current.get('wind_deg')
-        wind_dir = deg_to_compass(wind_deg) if wind_deg is not None else None
-        wind_speed_mps = current.get('wind_speed', 0)
-        wind_speed_mph = round(wind_speed_mps * 2.23694, 2)
-        pressure_hpa = current.get('pressure', 0)
-        pressure_inhg = round(pressure_hpa * 0.02953, 2)
-        # Build enhanced current data
-        enhanced_current = dict(current)
-        enhanced_current['wind_direction_degrees'] = wind_deg
-        enhanced_current['wind_direction_compass'] = wind_dir
-        enhanced_current['wind_speed_mph'] = wind_speed_mph
-        enhanced_current['pressure_inhg'] = pressure_inhg
-        response_data = {
-            'current': enhanced_current,
-            'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon, 'country': country},
-            'timezone_offset': result.get('timezone_offset', 0)
-        }
-        response_data = decode_bytes(response_data)
-        set_cached_result('weather', cache_key, response_data)
-        return jsonify(success=True, data=response_data, cached=False)
+        response_data = build_weather(result, city, state, lat, lon, country)
+        response_data = projection.apply(conversion.convert(response_data, units), fields, fmt)
+        if cached:
+            return rendered_response('onecall', cache_key, variant, result, dict(
+                success=True, data=response_data, city=city, state=state, country=country, cached=True))
+        return rendered_response('onecall', cache_key, None, result, dict(success=True, data=response_data, cached=False))
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
 
-@app.route('/api/forecast', methods=['POST'])
+@app.route('/api/forecast', methods=['GET', 'POST'])
 def api_forecast():
     log_api_usage('/api/forecast')
-    allowed, usage_count = increment_api_counter()
-    if not allowed:
-        return jsonify(success=False, error=f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow.")
     try:
-        data = request.get_json(force=True, silent=True) or {}
+        data = request_data()
         city = data.get('city')
         state = data.get('state')
         zip_code = data.get('zip_code')
         country = data.get('country')
-        units = data.get('units', 'imperial')
+        units = conversion.normalize(data.get('units', 'imperial'))
 
         if not API_KEY:
             return jsonify(success=False, error='API key not set')
+        try:
+            fields, fmt = projection.parse(data, 'forecast')
+        except ValueError as e:
+            return jsonify(success=False, error=str(e))
 
         lat, lon, city, state = get_location(city, state, zip_code, country)
         if not lat or not lon:
             return jsonify(success=False, error='Location not found')
 
-        cache_key = f'{lat},{lon},{units}'
-        cached = get_cached_result('forecast', cache_key)
-        if cached:
-            return jsonify(success=True, data=cached, city=city, state=state, country=country, cached=True)
+        cache_key = location_key(lat, lon)
+        variant = f'forecast|{units}|{lat},{lon}|{city}|{state}|{country}' + projection.variant(fields, fmt)
+        hit = cached_response('onecall', cache_key, variant)
+        if hit:
+            return hit
 
-        url = f'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={API_KEY}&units={units}'
-        try:
-            resp = requests.get(url, timeout=10)
-        except Exception as e:
-            return jsonify(success=False, error=f'Forecast API request failed: {str(e)}')
+        result, cached, error = fetch_onecall(lat, lon, 'Forecast')
+        if error:
+            return jsonify(success=False, error=error)
 
-        if not resp.ok:
-            try:
-                err = resp.json()
-                err_msg = err.get('message', str(err))
-            except Exception:
-                err_msg = resp.text
-            return jsonify(success=False, error=f'Forecast API error: {err_msg}')
-
-        result = resp.json()
-        if 'hourly' not in result or 'daily' not in result:
+        response_data = build_forecast(result, city, state, lat, lon, country)
+        if response_data is None:
             return jsonify(success=False, error=f"Forecast data missing from API response: {result}")
-
-        hourly = result.get('hourly', [])
-        daily = result.get('daily', [])
-        response_data = {
-            'daily': daily,
-            'hourly': hourly,
-            'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon, 'country': country},
-            'timezone_offset': result.get('timezone_offset', 0)
-        }
-        response_data = decode_bytes(response_data)
-        set_cached_result('forecast', cache_key, response_data)
-        return jsonify(success=True, data=response_data, cached=False)
+        response_data = projection.apply(conversion.convert(response_data, units), fields, fmt)
+        if cached:
+            return rendered_response('onecall', cache_key, variant, result, dict(
+                success=True, data=response_data, city=city, state=state, country=country, cached=True))
+        return rendered_response('onecall', cache_key, None, result, dict(success=True, data=response_data, cached=False))
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
 
 
-@app.route('/api/air_quality', methods=['POST'])
+@app.route('/api/air_quality', methods=['GET', 'POST'])
 def api_air_quality():
     log_api_usage('/api/air_quality')
-    allowed, usage_count = increment_api_counter()
-    if not allowed:
-        return jsonify(success=False, error=f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow.")
     try:
-        data = request.get_json()
+        data = request_data()
         city = data.get('city')
         state = data.get('state')
         zip_code = data.get('zip_code')
@@ -536,76 +1002,253 @@ def api_air_quality():
         lat, lon, city, state = get_location(city, state, zip_code, country)
         if not lat or not lon:
             return jsonify(success=False, error='Location not found')
-        cache_key = f'{lat},{lon}'
-        cached = get_cached_result('air_quality', cache_key)
+        cache_key = location_key(lat, lon)
+        variant = f'air_quality|{lat},{lon}|{city}|{state}'
+        hit = cached_response('air_quality', cache_key, variant)
+        if hit:
+            return hit
+        response_data, cached, error = fetch_air_quality(lat, lon)
+        if error:
+            return jsonify(success=False, error=error)
         if cached:
-            return jsonify(success=True, data=cached, city=city, state=state, cached=True)
-        url = f'https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={API_KEY}'
-        resp = requests.get(url)
-        if not resp.ok:
-            try:
-                err = resp.json()
-                err_msg = err.get('message', str(err))
-            except Exception:
-                err_msg = resp.text
-            return jsonify(success=False, error=f'Air Quality API error: {err_msg}')
-        result = resp.json()
-        response_data = decode_bytes(result)
-        set_cached_result('air_quality', cache_key, response_data)
-        return jsonify(success=True, data=response_data, cached=False)
+            return rendered_response('air_quality', cache_key, variant, response_data, dict(
+                success=True, data=response_data, city=city, state=state, cached=True))
+        return rendered_response('air_quality', cache_key, None, response_data, dict(success=True, data=response_data, cached=False))
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
 
-@app.route('/api/uv', methods=['POST'])
+@app.route('/api/uv', methods=['GET', 'POST'])
 def api_uv():
     log_api_usage('/api/uv')
     try:
-        data = request.get_json()
+        data = request_data()
+        city = data.get('city')
+        state = data.get('state')
+        zip_code = data.get('zip_code')
+        country = data.get('country')
+        # UV fields are the same in every unit system
+        lat, lon, city, state = get_location(city, state, zip_code, country)
+        if not lat or not lon:
+            return jsonify(success=False, error='Location not found')
+        cache_key = location_key(lat, lon)
+        variant = f'uv|{lat},{lon}|{city}|{state}'
+        hit = cached_response('onecall', cache_key, variant)
+        if hit:
+            return hit
+        result, cached, error = fetch_onecall(lat, lon, 'UV')
+        if error:
+            return jsonify(success=False, error=error)
+        response_data = build_uv(result, city, state, lat, lon)
+        return rendered_response('onecall', cache_key, variant if cached else None, result,
+                                 dict(success=True, data=response_data, cached=cached))
+    except Exception as e:
+        tb = traceback.format_exc()
+        return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# Combined endpoint: every view for one location in a single round trip
+@app.route('/api/bundle', methods=['POST'])
+def api_bundle():
+    log_api_usage('/api/bundle')
+    try:
+        data = request_data()
         city = data.get('city')
         state = data.get('state')
         zip_code = data.get('zip_code')
         country = data.get('country')
+        units = conversion.normalize(data.get('units', 'imperial'))
+
+        if not API_KEY:
+            return jsonify(success=False, error='API key not set')
+
         lat, lon, city, state = get_location(city, state, zip_code, country)
         if not lat or not lon:
             return jsonify(success=False, error='Location not found')
-        url = f'https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={API_KEY}'
-        resp = requests.get(url)
-        log_api_usage('/api/alerts')
-        allowed, usage_count = increment_api_counter()
-        if not allowed:
-            return jsonify(success=False, error=f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow.")
-        if not resp.ok:
+
+        result, cached, error = fetch_onecall(lat, lon, 'Weather')
+        if error:
+            return jsonify(success=False, error=error)
+
+        # Air quality is a separate upstream; report its failure without failing the bundle
+        errors = {}
+        air_quality, aq_cached, aq_error = fetch_air_quality(lat, lon)
+        if aq_error:
+            errors['air_quality'] = aq_error
+        forecast = conversion.convert(build_forecast(result, city, state, lat, lon, country), units)
+        if forecast is None:
+            errors['forecast'] = 'Forecast data missing from API response'
+        response_data = {
+            'weather': conversion.convert(build_weather(result, city, state, lat, lon, country), units),
+            'forecast': forecast,
+            'alerts': build_alerts(result),
+            'uv': build_uv(result, city, state, lat, lon),
+            'air_quality': air_quality
+        }
+        return jsonify(success=True, data=response_data, errors=errors,
+                       city=city, state=state, country=country, cached=cached and aq_cached,
+                       **ttl_policy.stale_fields())
+    except Exception as e:
+        tb = traceback.format_exc()
+        return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# --- History (see history_store.py) ---
+# Answered from the history files alone: no upstream call and no quota. Series
+# are returned as columns (ts, temp, ...), averaged down to at most `points`
+# values each for graphs.
+HISTORY_DEFAULT_DAYS = 7
+HISTORY_DEFAULT_POINTS = 200
+HISTORY_MAX_POINTS = 2000
+
+def history_columns(result, units):
+    """Convert the columns of a history_store.query() result from canonical units."""
+    for name, quantity in history_store.QUANTITIES.items():
+        if name in result:
+            scale, offset = conversion.SCALES[quantity][units]
+            result[name] = [None if v is None else round(v * scale + offset, conversion.PRECISION)
+                            for v in result[name]]
+    return result
+
+@app.route('/api/history', methods=['GET', 'POST'])
+def api_history():
+    log_api_usage('/api/history')
+    try:
+        data = request_data()
+        series = data.get('series', 'observed')
+        if series not in history_store.SERIES:
+            return jsonify(success=False, error=f"series must be one of {', '.join(history_store.SERIES)}")
+        units = conversion.normalize(data.get('units', 'imperial'))
+        fields = [f for f in str(data.get('fields') or '').split(',') if f] or list(history_store.COLUMNS)
+        unknown = [f for f in fields if f not in history_store.COLUMNS]
+        if unknown:
+            return jsonify(success=False, error=f"Unknown fields: {', '.join(unknown)}")
+        now = int(time.time())
+        try:
+            # Default: the past week, plus the forecast ahead for the forecast series
+            start = int(data.get('start') or now - HISTORY_DEFAULT_DAYS * 86400)
+            end = int(data.get('end') or (now if series == 'observed' else now + HISTORY_DEFAULT_DAYS * 86400))
+            points = min(HISTORY_MAX_POINTS, max(1, int(data.get('points') or HISTORY_DEFAULT_POINTS)))
+        except (TypeError, ValueError):
+            return jsonify(success=False, error='start, end and points must be integers')
+        # Nothing older than HISTORY_MAX_DAYS is kept anyway
+        start = max(start, end - history_store.HISTORY_MAX_DAYS * 86400)
+
+        lat, lon, city, state = get_location(data.get('city'), data.get('state'), data.get('zip_code'), data.get('country'))
+        if not lat or not lon:
+            return jsonify(success=False, error='Location not found')
+        columns = history_store.query(series, location_key(lat, lon), start, end, points, fields)
+        return jsonify(success=True, data=dict(history_columns(columns, units), series=series, units=units,
+                                               start=start, end=end, location={'city': city, 'state': state, 'lat': lat, 'lon': lon}))
+    except Exception as e:
+        tb = traceback.format_exc()
+        return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# Postal codes for the page's ZIP search, from the same index and cache as get_location
+GEOCODE_MAX_AGE = 86400
+
+@app.route('/api/geocode', methods=['GET', 'POST'])
+def api_geocode():
+    log_api_usage('/api/geocode')
+    try:
+        data = request_data()
+        zip_code = str(data.get('zip_code') or data.get('zip') or '').strip()
+        if not zip_code:
+            return jsonify(success=False, error='zip_code is required')
+        country = data.get('country')
+        lat, lon, city, state = get_location(None, None, zip_code, country)
+        if not lat or not lon:
+            return jsonify(success=False, error=f'ZIP code not found: {zip_code}')
+        resp = jsonify(success=True, data={'zip_code': zip_code, 'country': (country or 'US').upper(),
+                                           'city': city, 'state': state, 'lat': lat, 'lon': lon})
+        resp.headers['Cache-Control'] = f'public, max-age={GEOCODE_MAX_AGE}'
+        return resp
+    except Exception as e:
+        tb = traceback.format_exc()
+        return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# --- Batch endpoints (favorites) ---
+# Locations are resolved and fetched on a small thread pool. Cached entries are
+# free; at most BATCH_MAX_UPSTREAM misses per batch go upstream (each still
+# charged to the quota and the client's bucket), the rest report an error so
+# one large batch cannot drain the daily limit.
+BATCH_MAX_LOCATIONS = 25
+BATCH_MAX_UPSTREAM = 10
+BATCH_WORKERS = 4
+
+def resolve_batch_location(loc):
+    if not isinstance(loc, dict):
+        return None, None, None, None
+    return get_location(loc.get('city'), loc.get('state'), loc.get('zip_code'), loc.get('country'))
+
+def fetch_batch(locations, label, build, client):
+    """Return one result dict per location, in order."""
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        places = list(pool.map(resolve_batch_location, locations))
+        results = [None] * len(locations)
+        jobs = {}
+        misses = 0
+        for i, (lat, lon, city, state) in enumerate(places):
+            if not lat or not lon:
+                results[i] = {'success': False, 'error': 'Location not found'}
+                continue
+            if not usable_entry('onecall', location_key(lat, lon)):
+                misses += 1
+                if misses > BATCH_MAX_UPSTREAM:
+                    results[i] = {'success': False, 'error': 'Too many uncached locations in one batch. Try again shortly.'}
+                    continue
+            # In the request's context, so stale data marks the response
+            jobs[i] = pool.submit(contextvars.copy_context().run, fetch_onecall, lat, lon, label, client)
+        for i, job in jobs.items():
+            lat, lon, city, state = places[i]
+            country = locations[i].get('country')
             try:
-                err = resp.json()
-                err_msg = err.get('message', str(err))
-            except Exception:
-                err_msg = resp.text
-            return jsonify(success=False, error=f'UV API error: {err_msg}')
-        result = resp.json()
-        current = result.get('current', {})
-        uvi = current.get('uvi', 0)
-        sunrise = current.get('sunrise')
-        sunset = current.get('sunset')
-        clouds = current.get('clouds')
-        humidity = current.get('humidity')
-        pressure = current.get('pressure')
-        response_data = decode_bytes({
-            'uvi': uvi,
-            'sunrise': sunrise,
-            'sunset': sunset,
-            'clouds': clouds,
-            'humidity': humidity,
-            'pressure': pressure,
-            'location': {'city': city, 'state': state, 'lat': lat, 'lon': lon}
-        })
-        cache_key = f'{lat},{lon}'
-        set_cached_result('uv', cache_key, response_data)
-        return jsonify(success=True, data=response_data, cached=False)
+                result, cached, error = job.result()
+                if error:
+                    results[i] = {'success': False, 'error': error}
+                    continue
+                response_data = build(result, city, state, lat, lon, country)
+                if response_data is None:
+                    results[i] = {'success': False, 'error': f'{label} data missing from API response'}
+                    continue
+                results[i] = {'success': True, 'data': response_data, 'city': city, 'state': state,
+                              'country': country, 'cached': cached}
+            except Exception as e:
+                results[i] = {'success': False, 'error': f'Internal server error: {str(e)}'}
+    return results
+
+def api_batch(endpoint, view, label, build):
+    log_api_usage(endpoint)
+    try:
+        data = request_data()
+        locations = data.get('locations')
+        units = conversion.normalize(data.get('units', 'imperial'))
+
+        if not API_KEY:
+            return jsonify(success=False, error='API key not set')
+        try:
+            fields, fmt = projection.parse(data, view)
+        except ValueError as e:
+            return jsonify(success=False, error=str(e))
+        if not isinstance(locations, list) or not locations:
+            return jsonify(success=False, error='locations must be a non-empty list')
+        if len(locations) > BATCH_MAX_LOCATIONS:
+            return jsonify(success=False, error=f'At most {BATCH_MAX_LOCATIONS} locations per batch')
+
+        results = fetch_batch(locations, label,
+                              lambda *place: projection.apply(conversion.convert(build(*place), units), fields, fmt),
+                              client_ip())
+        return jsonify(success=True, results=results, **ttl_policy.stale_fields())
     except Exception as e:
         tb = traceback.format_exc()
         return jsonify(success=False, error=f"Internal server error: {str(e)}\n{tb}")
 
+@app.route('/api/weather/batch', methods=['POST'])
+def api_weather_batch():
+    return api_batch('/api/weather/batch', 'weather', 'Weather', build_weather)
+
+@app.route('/api/forecast/batch', methods=['POST'])
+def api_forecast_batch():
+    return api_batch('/api/forecast/batch', 'forecast', 'Forecast', build_forecast)
+
 if __name__ == '__main__':
     from flup.server.cgi import WSGIServer
     WSGIServer(app).run()
\ No newline at end of file
@@ -0,0 +1,587 @@
+# Weather Alert Pro - asyncio (ASGI) serving path
+# Copyright (c) 2025 Donald Bryant
+# Serves the upstream-bound /api/* routes from one event loop, so a request
+# waiting on geocoding or OpenWeatherMap costs a coroutine instead of a worker.
+#
+#     uvicorn asgi:application --host 127.0.0.1 --port 8000
+#
+# - Geocoding and One Call go through upstream.aget() (httpx); the bundle and
+#   batch endpoints run their upstream calls concurrently.
+# - Cache, quota, geocoding cache and single-flight are the same SQLite-backed
+#   modules app.py uses; their calls run on the default thread pool so a busy
+#   database never blocks the loop.
+# - Response bodies are produced with the Flask app's JSON settings and match the
+#   Flask handlers exactly, including the stored bodies, ETag and 304 handling
+#   for cache hits, and the same Server-Timing header. Every other route (the
+#   page, static files, the usage dashboards, /metrics) is passed to the Flask
+#   app on a worker thread.
+# - /api/alerts/stream (Server-Sent Events) is served natively, so open alert
+#   streams cost a coroutine each instead of a thread.
+# - Background work (usage log writer, geocode seeding, pre-warming, the alert
+#   poller, circuit-breaker probes) starts at lifespan start-up, as in
+#   persistent FastCGI mode.
+#
+# Requires httpx and an ASGI server such as uvicorn (see DEPLOYMENT.md).
+import io
+import sys
+import time
+import asyncio
+import traceback
+import contextvars
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qsl
+
+import app
+import alert_watch
+import breaker
+import cache_store
+import conversion
+import projection
+import geocode_cache
+import metrics
+import postal_index
+import quota
+import singleflight
+import ttl_policy
+import upstream
+import usage_log
+
+# --- JSON responses ---
+request_headers = contextvars.ContextVar('request_headers', default={})
+request_method = contextvars.ContextVar('request_method', default='POST')
+
+def json_body(**kwargs):
+    return app.encode_json(kwargs)
+
+def accepts_gzip(headers):
+    for part in headers.get('accept-encoding', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding.strip() in ('gzip', '*') and params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            return True
+    return False
+
+def not_modified(headers, etag, ts):
+    if request_method.get() != 'GET':
+        return False
+    if 'if-none-match' in headers:
+        tags = [t.strip() for t in headers['if-none-match'].split(',')]
+        return '*' in tags or f'"{etag}"' in tags
+    if 'if-modified-since' in headers and ts:
+        try:
+            return int(ts) <= parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def body_response(ts, etag, body, packed):
+    """(status, headers, body) for a rendered response; see app.body_response."""
+    headers = request_headers.get()
+    use_gzip = packed is not None and accepts_gzip(headers)
+    etag = etag + '-gz' if use_gzip else etag
+    out = [(b'content-type', b'application/json'), (b'cache-control', b'no-cache'), (b'etag', f'"{etag}"'.encode())]
+    if ts:
+        out.append((b'last-modified', formatdate(ts, usegmt=True).encode()))
+    if packed is not None:
+        out.append((b'vary', b'Accept-Encoding'))
+    if not_modified(headers, etag, ts):
+        return 304, out, b''
+    if use_gzip:
+        out.append((b'content-encoding', b'gzip'))
+    payload = packed if use_gzip else body
+    return 200, out + [(b'content-length', str(len(payload)).encode())], payload
+
+def error_body(e):
+    tb = traceback.format_exc()
+    return json_body(success=False, error=f"Internal server error: {str(e)}\n{tb}")
+
+# --- Geocoding ---
+@metrics.timed('location')
+async def get_location(city, state, zip_code, country=None):
+    """Coroutine version of app.get_location()."""
+    if not country and state:
+        country = 'US'
+    if zip_code:
+        key = geocode_cache.zip_key(zip_code, country)
+        hit = postal_index.lookup(zip_code, country) or await asyncio.to_thread(geocode_cache.lookup, key)
+        if hit is None:
+            hit = await lookup_zip(zip_code, country)
+            if hit:
+                await asyncio.to_thread(geocode_cache.store, key, *hit)
+            elif hit is None:
+                await asyncio.to_thread(geocode_cache.store_failure, key,
+                                        f'ZIP code not found: {zip_code} ({country or "US"})')
+            else:
+                geocode_cache.log_failure(f'{key} | ZIP lookup unavailable for {zip_code}')
+        if hit:
+            return hit
+    if city:
+        key = geocode_cache.city_key(city, state, country)
+        hit = await asyncio.to_thread(geocode_cache.lookup, key)
+        if hit is None:
+            place = ', '.join(p for p in (city, state, country) if p)
+            hit = await lookup_city(city, state, country)
+            if hit:
+                await asyncio.to_thread(geocode_cache.store, key, *hit)
+            elif hit is None:
+                await asyncio.to_thread(geocode_cache.store_failure, key, f'City not found: {place}')
+            else:
+                geocode_cache.log_failure(f'{key} | City lookup unavailable for {place}')
+        if hit:
+            return hit
+    return None, None, city, state
+
+async def lookup_zip(zip_code, country):
+    country_code = country.lower() if country and country.upper() != 'US' else 'us'
+    if not (await asyncio.to_thread(quota.charge, 'zippopotam', daily=False))[0]:
+        return False
+    try:
+        resp = await upstream.aget(f'{upstream.ZIPPOPOTAM_URL}/{country_code}/{zip_code}', timeout=app.GEOCODE_TIMEOUT)
+        if resp.status_code == 404:
+            return None
+        if resp.status_code < 400:
+            place = resp.json()['places'][0]
+            return float(place['latitude']), float(place['longitude']), place['place name'], place.get('state abbreviation', '')
+    except Exception:
+        pass
+    return False
+
+async def lookup_city(city, state, country):
+    city_clean = city.strip().title()
+    q = city_clean
+    if state:
+        q += f',{state.strip()}'
+    if country:
+        q += f',{country.strip()}'
+    params = {'q': q, 'limit': 1, 'appid': app.API_KEY}
+    if not (await asyncio.to_thread(quota.charge, 'geocode', daily=False))[0]:
+        return False
+    try:
+        resp = await upstream.aget(f'{upstream.OPENWEATHERMAP_URL}/geo/1.0/direct', params=params,
+                                   timeout=app.GEOCODE_TIMEOUT)
+        if resp.status_code < 400:
+            data = resp.json()
+            if not data:
+                return None
+            d = data[0]
+            return d['lat'], d['lon'], d.get('name', city_clean), d.get('state', state)
+    except Exception:
+        pass
+    return False
+
+# --- Shared fetch layer (see app.fetch_upstream) ---
+async def fetch_upstream(feature, cache_key, endpoint, url, label, client, view=None):
+    usage_log.record_demand(feature, cache_key)
+    ttl = ttl_policy.ttl(view or feature)
+    with metrics.span('cache'):
+        entry = await asyncio.to_thread(cache_store.get_entry, feature, cache_key, ttl)
+    if entry:
+        age = time.time() - entry[0]
+        if age < ttl:
+            usage_log.record_cache(feature, True)
+            return entry[1], True, None
+        if ttl_policy.exhausted():
+            usage_log.record_cache(feature, True)
+            return app.stale_hit(feature, cache_key, entry)
+        if age < app.STALE_MAX_AGE + ttl:
+            usage_log.record_cache(feature, True)
+            await asyncio.to_thread(app.refresh_in_background, feature, cache_key)
+            return entry[1], True, None
+    usage_log.record_cache(feature, False)
+    return await singleflight.do_async(f'{feature}:{cache_key}',
+                                       lambda: fetch_and_cache(feature, cache_key, endpoint, url, label, client, ttl),
+                                       lambda: asyncio.to_thread(app.cached_hit, feature, cache_key, ttl))
+
+async def unavailable(feature, cache_key, error):
+    # stale_hit marks the request's state, which the worker thread shares
+    return await asyncio.to_thread(app.stale_hit, feature, cache_key) or (None, False, error)
+
+async def fetch_and_cache(feature, cache_key, endpoint, url, label, client, ttl=None):
+    hit = await asyncio.to_thread(app.cached_hit, feature, cache_key, ttl)
+    if hit:
+        return hit
+    hit = await asyncio.to_thread(app.nearby_hit, feature, cache_key, False, ttl)
+    if hit:
+        return hit
+    host = upstream.host_of(url)
+    if await asyncio.to_thread(breaker.refusing, host):
+        return await unavailable(feature, cache_key, f'{label} service unavailable: {host} is not responding')
+    allowed, error = await asyncio.to_thread(quota.charge, endpoint, client)
+    if not allowed:
+        return await unavailable(feature, cache_key, error)
+    try:
+        resp = await upstream.aget(url)
+    except Exception as e:
+        return await unavailable(feature, cache_key, f'{label} API request failed: {str(e)}')
+    if resp.status_code in upstream.RETRY_STATUSES:
+        return await unavailable(feature, cache_key, f'{label} API error: {app.upstream_error_message(resp)}')
+    if resp.status_code >= 400:
+        return None, False, f'{label} API error: {app.upstream_error_message(resp)}'
+    result = resp.json()
+    await asyncio.to_thread(app.set_cached_result, feature, cache_key, result)
+    return result, False, None
+
+def fetch_onecall(lat, lon, label, client):
+    key = app.location_key(lat, lon)
+    return fetch_upstream('onecall', key, 'onecall', app.onecall_url(*key.split(',')), label, client, view=label.lower())
+
+def fetch_air_quality(lat, lon, client):
+    key = app.location_key(lat, lon)
+    return fetch_upstream('air_quality', key, 'air_pollution', app.air_quality_url(*key.split(',')),
+                          'Air Quality', client)
+
+# --- Handlers (mirror the Flask routes in app.py) ---
+async def stored_response(feature, cache_key, variant):
+    hit = await asyncio.to_thread(app.stored_hit, feature, cache_key, variant)
+    return body_response(*hit) if hit else None
+
+async def rendered_response(feature, cache_key, variant, result, payload):
+    return body_response(*await asyncio.to_thread(app.store_rendered, feature, cache_key, variant, result, payload))
+
+async def onecall_view(data, client, view, label, build, always_place):
+    city = data.get('city')
+    state = data.get('state')
+    zip_code = data.get('zip_code')
+    country = data.get('country')
+    units = conversion.normalize(data.get('units', 'imperial'))
+
+    if not app.API_KEY:
+        return json_body(success=False, error='API key not set')
+    fields, fmt = '', 'rows'
+    if view in projection.PROFILES:
+        try:
+            fields, fmt = projection.parse(data, view)
+        except ValueError as e:
+            return json_body(success=False, error=str(e))
+
+    lat, lon, city, state = await get_location(city, state, zip_code, country)
+    if not lat or not lon:
+        return json_body(success=False, error='Location not found')
+
+    cache_key = app.location_key(lat, lon)
+    # Alerts do not depend on the units; weather and forecast are converted
+    if view in projection.PROFILES:
+        variant = f'{view}|{units}|{lat},{lon}|{city}|{state}|{country}' + projection.variant(fields, fmt)
+    else:
+        variant = f'{view}|{lat},{lon}|{city}|{state}|{country}'
+    hit = await stored_response('onecall', cache_key, variant)
+    if hit:
+        return hit
+
+    result, cached, error = await fetch_onecall(lat, lon, label, client)
+    if error:
+        return json_body(success=False, error=error)
+
+    response_data = build(result, city, state, lat, lon, country)
+    if response_data is None:
+        return json_body(success=False, error=f"Forecast data missing from API response: {result}")
+    response_data = projection.apply(conversion.convert(response_data, units), fields, fmt)
+    if cached or always_place:
+        payload = dict(success=True, data=response_data, city=city, state=state, country=country, cached=cached)
+    else:
+        payload = dict(success=True, data=response_data, cached=False)
+    return await rendered_response('onecall', cache_key, variant if cached else None, result, payload)
+
+async def api_weather(data, client):
+    return await onecall_view(data, client, 'weather', 'Weather', app.build_weather, False)
+
+async def api_forecast(data, client):
+    return await onecall_view(data, client, 'forecast', 'Forecast', app.build_forecast, False)
+
+async def api_alerts(data, client):
+    return await onecall_view(data, client, 'alerts', 'Alerts', lambda result, *place: app.build_alerts(result), True)
+
+async def api_uv(data, client):
+    # /api/uv does not check the API key first; a missing key surfaces as an upstream error
+    lat, lon, city, state = await get_location(data.get('city'), data.get('state'), data.get('zip_code'),
+                                               data.get('country'))
+    if not lat or not lon:
+        return json_body(success=False, error='Location not found')
+    cache_key = app.location_key(lat, lon)
+    variant = f'uv|{lat},{lon}|{city}|{state}'
+    hit = await stored_response('onecall', cache_key, variant)
+    if hit:
+        return hit
+    result, cached, error = await fetch_onecall(lat, lon, 'UV', client)
+    if error:
+        return json_body(success=False, error=error)
+    return await rendered_response('onecall', cache_key, variant if cached else None, result, dict(
+        success=True, data=app.build_uv(result, city, state, lat, lon), cached=cached))
+
+async def api_air_quality(data, client):
+    lat, lon, city, state = await get_location(data.get('city'), data.get('state'), data.get('zip_code'),
+                                               data.get('country'))
+    if not lat or not lon:
+        return json_body(success=False, error='Location not found')
+    cache_key = app.location_key(lat, lon)
+    variant = f'air_quality|{lat},{lon}|{city}|{state}'
+    hit = await stored_response('air_quality', cache_key, variant)
+    if hit:
+        return hit
+    response_data, cached, error = await fetch_air_quality(lat, lon, client)
+    if error:
+        return json_body(success=False, error=error)
+    if cached:
+        return await rendered_response('air_quality', cache_key, variant, response_data, dict(
+            success=True, data=response_data, city=city, state=state, cached=True))
+    return await rendered_response('air_quality', cache_key, None, response_data, dict(
+        success=True, data=response_data, cached=False))
+
+async def api_bundle(data, client):
+    city = data.get('city')
+    state = data.get('state')
+    zip_code = data.get('zip_code')
+    country = data.get('country')
+    units = conversion.normalize(data.get('units', 'imperial'))
+
+    if not app.API_KEY:
+        return json_body(success=False, error='API key not set')
+
+    lat, lon, city, state = await get_location(city, state, zip_code, country)
+    if not lat or not lon:
+        return json_body(success=False, error='Location not found')
+
+    # One Call and air pollution are independent upstreams: fetch both at once
+    (result, cached, error), (air_quality, aq_cached, aq_error) = await asyncio.gather(
+        fetch_onecall(lat, lon, 'Weather', client), fetch_air_quality(lat, lon, client))
+    if error:
+        return json_body(success=False, error=error)
+
+    errors = {}
+    if aq_error:
+        errors['air_quality'] = aq_error
+    forecast = conversion.convert(app.build_forecast(result, city, state, lat, lon, country), units)
+    if forecast is None:
+        errors['forecast'] = 'Forecast data missing from API response'
+    response_data = {
+        'weather': conversion.convert(app.build_weather(result, city, state, lat, lon, country), units),
+        'forecast': forecast,
+        'alerts': app.build_alerts(result),
+        'uv': app.build_uv(result, city, state, lat, lon),
+        'air_quality': air_quality
+    }
+    return json_body(success=True, data=response_data, errors=errors,
+                     city=city, state=state, country=country, cached=cached and aq_cached,
+                     **ttl_policy.stale_fields())
+
+async def batch_item(loc, label, build, client, budget):
+    if not isinstance(loc, dict):
+        return {'success': False, 'error': 'Location not found'}
+    country = loc.get('country')
+    lat, lon, city, state = await get_location(loc.get('city'), loc.get('state'), loc.get('zip_code'), country)
+    if not lat or not lon:
+        return {'success': False, 'error': 'Location not found'}
+    if not await asyncio.to_thread(app.usable_entry, 'onecall', app.location_key(lat, lon)):
+        if budget[0] <= 0:
+            return {'success': False, 'error': 'Too many uncached locations in one batch. Try again shortly.'}
+        budget[0] -= 1
+    try:
+        result, cached, error = await fetch_onecall(lat, lon, label, client)
+        if error:
+            return {'success': False, 'error': error}
+        response_data = build(result, city, state, lat, lon, country)
+        if response_data is None:
+            return {'success': False, 'error': f'{label} data missing from API response'}
+        return {'success': True, 'data': response_data, 'city': city, 'state': state,
+                'country': country, 'cached': cached}
+    except Exception as e:
+        return {'success': False, 'error': f'Internal server error: {str(e)}'}
+
+async def api_batch(data, client, view, label, build):
+    locations = data.get('locations')
+    units = conversion.normalize(data.get('units', 'imperial'))
+
+    if not app.API_KEY:
+        return json_body(success=False, error='API key not set')
+    try:
+        fields, fmt = projection.parse(data, view)
+    except ValueError as e:
+        return json_body(success=False, error=str(e))
+
+    def projected(*place):
+        return projection.apply(conversion.convert(build(*place), units), fields, fmt)
+    if not isinstance(locations, list) or not locations:
+        return json_body(success=False, error='locations must be a non-empty list')
+    if len(locations) > app.BATCH_MAX_LOCATIONS:
+        return json_body(success=False, error=f'At most {app.BATCH_MAX_LOCATIONS} locations per batch')
+
+    # Unlike the thread-pool version the budget is taken in completion order,
+    # but the number of misses sent upstream is bounded the same way
+    budget = [app.BATCH_MAX_UPSTREAM]
+    results = await asyncio.gather(*(batch_item(loc, label, projected, client, budget) for loc in locations))
+    return json_body(success=True, results=list(results), **ttl_policy.stale_fields())
+
+async def api_weather_batch(data, client):
+    return await api_batch(data, client, 'weather', 'Weather', app.build_weather)
+
+async def api_forecast_batch(data, client):
+    return await api_batch(data, client, 'forecast', 'Forecast', app.build_forecast)
+
+# endpoint -> (handler, logged endpoint name); /api/alerts is not logged by the Flask app either
+ROUTES = {
+    '/api/weather': (api_weather, '/api/weather'),
+    '/api/forecast': (api_forecast, '/api/forecast'),
+    '/api/alerts': (api_alerts, None),
+    '/api/air_quality': (api_air_quality, '/api/air_quality'),
+    '/api/uv': (api_uv, '/api/uv'),
+    '/api/bundle': (api_bundle, '/api/bundle'),
+    '/api/weather/batch': (api_weather_batch, '/api/weather/batch'),
+    '/api/forecast/batch': (api_forecast_batch, '/api/forecast/batch'),
+}
+
+# Views of a single cached entry also answer GET, so browsers can revalidate them
+GET_ROUTES = {'/api/weather', '/api/forecast', '/api/alerts', '/api/air_quality', '/api/uv'}
+
+# --- ASGI plumbing ---
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+def wsgi_environ(scope, path, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def call_wsgi(environ):
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    result = app.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+# --- Alert streams (see alert_watch.py) ---
+# A held-open stream is a coroutine that reads this process's event buffer once
+# per tick, so thousands of them cost no threads and no database reads.
+SSE_HEADERS = [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no')]
+
+async def alert_stream(scope, receive, send):
+    query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+    token = query.get('watch', '')
+    locations, cursor, chunk = await asyncio.to_thread(
+        alert_watch.opening, token, headers.get('last-event-id') or query.get('last_event_id'))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+    if not locations:
+        return await send({'type': 'http.response.body', 'body': chunk.encode('utf-8')})
+    alert_watch.start_reader()
+    alert_watch.hold(token)
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        idle = 0
+        while True:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            done, _ = await asyncio.wait([disconnected], timeout=alert_watch.STREAM_TICK)
+            if done:
+                return
+            if alert_watch.covered(cursor):
+                chunk, cursor = alert_watch.pending(locations, cursor)
+            else:
+                chunk, cursor = await asyncio.to_thread(alert_watch.pending, locations, cursor)
+            idle = 0 if chunk else idle + alert_watch.STREAM_TICK
+            if idle >= alert_watch.HEARTBEAT:
+                chunk, idle = ': keep-alive\n\n', 0
+    except OSError:
+        pass
+    finally:
+        disconnected.cancel()
+        alert_watch.release(token)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            app.enable_persistent_mode()
+            app.start_background()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    body = await read_body(receive)
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if root_path and scope['path'].startswith(root_path) else scope['path']
+    method = scope['method']
+    if method == 'GET' and path == '/api/alerts/stream':
+        return await alert_stream(scope, receive, send)
+    route = ROUTES.get(path) if method == 'POST' or (method == 'GET' and path in GET_ROUTES) else None
+    if route is None:
+        status, headers, payload = await asyncio.to_thread(call_wsgi, wsgi_environ(scope, path, body))
+        return await send_response(send, status, headers, payload)
+    handler, endpoint = route
+    metrics.begin()
+    ttl_policy.begin()
+    client = (scope.get('client') or (None, 0))[0]
+    if endpoint:
+        with metrics.span('log'):
+            usage_log.record(endpoint, client)
+    request_headers.set({k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])})
+    request_method.set(method)
+    try:
+        if method == 'GET':
+            data = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        else:
+            try:
+                data = app.app.json.loads(body) if body else None
+            except ValueError:
+                data = None
+        if not isinstance(data, dict):
+            data = {}
+        payload = await handler(data, client)
+    except Exception as e:
+        payload = error_body(e)
+    # Rendered responses come with their own status and headers
+    if isinstance(payload, tuple):
+        status, headers, payload = payload
+    else:
+        status, headers = 200, [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(payload)).encode())]
+    timing = metrics.finish(path)
+    headers = headers + [(b'server-timing', timing.encode())]
+    if ttl_policy.stale_age() is not None:
+        headers.append((b'warning', ttl_policy.STALE_WARNING.encode()))
+    await send_response(send, status, headers, payload)
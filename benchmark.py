@@ -0,0 +1,401 @@
+# Weather Alert Pro - offline benchmark
+# Copyright (c) 2025 Donald Bryant
+# Runs repeatable load profiles against each deployment mode, with
+# fake_upstream.py standing in for OpenWeatherMap, zippopotam.us and ip-api.com,
+# so it needs no network access and spends no API quota.
+#
+#     python3 benchmark.py                                  # every available mode
+#     python3 benchmark.py --modes fcgi,asgi --requests 1000 --concurrency 32 --latency 120
+#     python3 benchmark.py --quick --max-failure-rate 0     # CI smoke run
+#
+# - Each mode runs a fresh copy of the app in a temporary directory (its own
+#   api_cache.db and apikey.txt). The WEATHER_*_URL settings point it at the
+#   stand-ins, and the quota limits are raised so they do not throttle the load.
+# - Modes: cgi (one weather.cgi process per request), fcgi (weather.fcgi,
+#   threaded), fcgi-prefork, and asgi (uvicorn). Modes whose server package is
+#   not installed are skipped.
+# - Profiles:
+#   cold: every request is for a new location
+#   warm: a small set of pre-fetched locations across all five views
+#   storm: bursts of identical requests for one uncached location
+#   units: warm locations in rotating units and field profiles
+# - For each mode and profile it reports requests/s, p50/p95/p99 latency, failed
+#   requests and upstream calls (One Call and in total).
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import signal
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ('cgi', 'fcgi', 'fcgi-prefork', 'asgi')
+PROFILES = ('cold', 'warm', 'storm', 'units')
+VIEWS = ('/api/weather', '/api/forecast', '/api/uv', '/api/alerts', '/api/air_quality')
+WARM_LOCATIONS = 20
+START_TIMEOUT = 30
+REQUEST_TIMEOUT = 60
+APP_FILES = ('.py', '.cgi', '.fcgi')
+APP_DIRS = ('templates', 'static')
+
+# --- Load profiles ---
+# A request is (method, path, params); params go in the query string for GET
+def location(name):
+    return {'city': name, 'state': 'CO'}
+
+def warm_locations():
+    return [location(f'Warmtown {i}') for i in range(WARM_LOCATIONS)]
+
+def profile_cold(n, concurrency):
+    return [], [[('GET', '/api/weather', location(f'Coldville {i}')) for i in range(n)]]
+
+def profile_warm(n, concurrency):
+    places = warm_locations()
+    warmup = [('GET', view, place) for place in places for view in VIEWS]
+    return warmup, [[('GET', VIEWS[i % len(VIEWS)], places[i // len(VIEWS) % len(places)]) for i in range(n)]]
+
+def profile_storm(n, concurrency):
+    # One burst per round: every worker asks for the same uncached location at once
+    rounds = max(1, n // concurrency)
+    return [], [[('GET', '/api/weather', location(f'Stormville {r}'))] * concurrency for r in range(rounds)]
+
+def profile_units(n, concurrency):
+    places = warm_locations()
+    warmup = [('GET', '/api/weather', place) for place in places]
+    variants = [
+        ('/api/weather', {}), ('/api/weather', {'profile': 'summary'}),
+        ('/api/forecast', {}), ('/api/forecast', {'profile': 'page'}),
+        ('/api/forecast', {'profile': 'chart', 'format': 'columns'}),
+    ]
+    units = ('metric', 'imperial', 'standard')
+    batch = []
+    for i in range(n):
+        path, extra = variants[i % len(variants)]
+        params = dict(places[i // len(variants) % len(places)], units=units[i // 7 % len(units)], **extra)
+        batch.append(('GET', path, params))
+    return warmup, [batch]
+
+PROFILE_BUILDERS = {'cold': profile_cold, 'warm': profile_warm, 'storm': profile_storm, 'units': profile_units}
+
+# --- FastCGI client (one connection per request, as the web server would do) ---
+def fcgi_record(kind, content):
+    out = b''
+    while True:
+        chunk, content = content[:65535], content[65535:]
+        padding = -len(chunk) % 8
+        out += struct.pack('!BBHHBx', 1, kind, 1, len(chunk), padding) + chunk + b'\0' * padding
+        if not content:
+            return out
+
+def fcgi_pair(name, value):
+    name, value = name.encode('latin-1'), value.encode('latin-1')
+    size = lambda n: bytes([n]) if n < 128 else struct.pack('!I', n | 0x80000000)
+    return size(len(name)) + size(len(value)) + name + value
+
+def fcgi_request(address, environ, body):
+    params = b''.join(fcgi_pair(k, v) for k, v in environ.items())
+    message = (fcgi_record(1, struct.pack('!HB5x', 1, 0)) + fcgi_record(4, params) + fcgi_record(4, b'')
+               + (fcgi_record(5, body) if body else b'') + fcgi_record(5, b''))
+    with socket.create_connection(address, timeout=REQUEST_TIMEOUT) as sock:
+        sock.sendall(message)
+        stdout, buf = b'', b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            buf += data
+            while len(buf) >= 8:
+                _, kind, _, length, padding = struct.unpack('!BBHHBx', buf[:8])
+                if len(buf) < 8 + length + padding:
+                    break
+                content, buf = buf[8:8 + length], buf[8 + length + padding:]
+                if kind == 6:
+                    stdout += content
+                elif kind == 3:
+                    return parse_cgi_output(stdout)
+    return parse_cgi_output(stdout)
+
+def parse_cgi_output(output):
+    """Return (status, body) from CGI-style output (headers, blank line, body)."""
+    head, sep, body = output.partition(b'\r\n\r\n')
+    if not sep:
+        head, _, body = output.partition(b'\n\n')
+    status = 200
+    for line in head.splitlines():
+        if line.lower().startswith(b'status:'):
+            status = int(line.split()[1])
+    return status, body
+
+def cgi_environ(method, path, params, script):
+    query = urlencode(params) if method == 'GET' else ''
+    body = b'' if method == 'GET' else json.dumps(params).encode()
+    environ = {
+        'GATEWAY_INTERFACE': 'CGI/1.1', 'REQUEST_METHOD': method, 'SCRIPT_NAME': script, 'PATH_INFO': path,
+        'QUERY_STRING': query, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1', 'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': 'application/json',
+    }
+    return environ, body
+
+# --- Deployment modes ---
+# Each returns a client: a function (method, path, params) -> (status, body)
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def mode_available(mode):
+    module = {'cgi': 'flup', 'fcgi': 'flup', 'fcgi-prefork': 'flup', 'asgi': 'uvicorn'}[mode]
+    try:
+        __import__(module)
+        if mode == 'asgi':
+            __import__('httpx')
+        return True
+    except ImportError:
+        return False
+
+def start_mode(mode, workdir, env, concurrency):
+    """Start the server for mode; return (client, process or None)."""
+    if mode == 'cgi':
+        def client(method, path, params):
+            environ, body = cgi_environ(method, path, params, '/cgi-bin/weather.cgi')
+            proc = subprocess.run([sys.executable, 'weather.cgi'], input=body, cwd=workdir, capture_output=True,
+                                  env=dict(env, **environ), timeout=REQUEST_TIMEOUT)
+            return parse_cgi_output(proc.stdout)
+        return client, None
+    port = free_port()
+    if mode in ('fcgi', 'fcgi-prefork'):
+        # flup resets connections that find no idle worker, so leave some headroom
+        server_env = dict(env, WEATHER_FCGI_BIND=f'127.0.0.1:{port}', WEATHER_WORKERS=str(max(16, 2 * concurrency)),
+                          WEATHER_SERVER_MODE='prefork' if mode == 'fcgi-prefork' else 'threaded')
+        proc = subprocess.Popen([sys.executable, 'weather.fcgi'], cwd=workdir, env=server_env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        def client(method, path, params):
+            environ, body = cgi_environ(method, path, params, '/cgi-bin/weather.fcgi')
+            return fcgi_request(('127.0.0.1', port), environ, body)
+    else:
+        proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                                 '--port', str(port), '--log-level', 'warning', '--no-access-log'],
+                                cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                start_new_session=True)
+        local = threading.local()
+
+        def client(method, path, params):
+            # One keep-alive connection per worker thread, like a browser or proxy
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                conn = local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=REQUEST_TIMEOUT)
+            try:
+                if method == 'GET':
+                    conn.request('GET', f'{path}?{urlencode(params)}')
+                else:
+                    conn.request(method, path, json.dumps(params), {'Content-Type': 'application/json'})
+                resp = conn.getresponse()
+                return resp.status, resp.read()
+            except (http.client.HTTPException, OSError):
+                local.conn = None
+                raise
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            if client('GET', '/api/usage', {'limit': 1})[0] == 200:
+                return client, proc
+        except Exception:
+            pass
+        if proc.poll() is not None or time.time() > deadline:
+            stop_process(proc)
+            raise RuntimeError(f'{mode} server did not start')
+        time.sleep(0.2)
+
+def stop_process(proc):
+    if proc is None or proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(10)
+    except Exception:
+        proc.kill()
+
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix='weather-bench-')
+    for name in os.listdir(BASE_DIR):
+        source = os.path.join(BASE_DIR, name)
+        if name in APP_DIRS:
+            shutil.copytree(source, os.path.join(workdir, name))
+        elif name.endswith(APP_FILES) and os.path.isfile(source):
+            shutil.copy(source, workdir)
+    with open(os.path.join(workdir, 'apikey.txt'), 'w') as f:
+        f.write('benchmark')
+    return workdir
+
+# --- Running and reporting ---
+def run_requests(client, requests, concurrency):
+    """Send requests from concurrency threads; return ([latency seconds], failures, elapsed)."""
+    latencies, failures = [], [0]
+    lock = threading.Lock()
+    position = iter(range(len(requests)))
+
+    def worker():
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                return
+            method, path, params = requests[index]
+            start = time.perf_counter()
+            try:
+                status, body = client(method, path, params)
+                ok = status in (200, 304) and json.loads(body).get('success') is True
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                failures[0] += not ok
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, len(requests)))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, failures[0], time.perf_counter() - start
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1))]
+
+def upstream_stats(fake_env):
+    url = fake_env['WEATHER_OPENWEATHERMAP_URL'].split('//', 1)[1]
+    conn = http.client.HTTPConnection(url, timeout=10)
+    conn.request('GET', '/__stats')
+    stats = json.loads(conn.getresponse().read())
+    conn.close()
+    return stats
+
+def run_profile(client, profile, n, concurrency, fake_env):
+    warmup, batches = PROFILE_BUILDERS[profile](n, concurrency)
+    if warmup:
+        run_requests(client, warmup, concurrency)
+    before = upstream_stats(fake_env)
+    latencies, failures, elapsed = [], 0, 0.0
+    for batch in batches:
+        lat, failed, took = run_requests(client, batch, concurrency)
+        latencies += lat
+        failures += failed
+        elapsed += took
+    after = upstream_stats(fake_env)
+    calls = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    return {
+        'requests': len(latencies),
+        'failed': failures,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'onecall_calls': calls.get('openweathermap:/data/3.0/onecall', 0),
+        'upstream_calls': sum(calls.values()),
+    }
+
+def run_mode(mode, args, fake_env):
+    workdir = prepare_workdir()
+    env = dict(os.environ, **fake_env)
+    # Raise the quota so the benchmark measures the app, not the rate limiter
+    env.update(WEATHER_API_DAILY_LIMIT=str(10 ** 9), WEATHER_RATE_LIMIT_SCALE=str(10 ** 6))
+    n = args.cgi_requests if mode == 'cgi' else args.requests
+    concurrency = min(args.concurrency, args.cgi_concurrency) if mode == 'cgi' else args.concurrency
+    proc = None
+    try:
+        client, proc = start_mode(mode, workdir, env, concurrency)
+        results = {}
+        for profile in args.profiles:
+            results[profile] = run_profile(client, profile, n, concurrency, fake_env)
+            print_row(mode, profile, results[profile])
+        return results
+    finally:
+        stop_process(proc)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+HEADER = f"{'mode':<13} {'profile':<6} {'requests':>8} {'failed':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'onecall':>7} {'upstream':>8}"
+
+def print_row(mode, profile, r):
+    print(f"{mode:<13} {profile:<6} {r['requests']:>8} {r['failed']:>6} {r['rps']:>8} {r['p50_ms']:>8} "
+          f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['onecall_calls']:>7} {r['upstream_calls']:>8}")
+    sys.stdout.flush()
+
+def csv_list(allowed):
+    def parse(value):
+        items = [v.strip() for v in value.split(',') if v.strip()]
+        unknown = [v for v in items if v not in allowed]
+        if unknown:
+            raise argparse.ArgumentTypeError(f"unknown: {', '.join(unknown)} (choose from {', '.join(allowed)})")
+        return items
+    return parse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark for Weather Alert Pro')
+    parser.add_argument('--modes', type=csv_list(MODES), default=list(MODES))
+    parser.add_argument('--profiles', type=csv_list(PROFILES), default=list(PROFILES))
+    parser.add_argument('--requests', type=int, default=400, help='requests per profile')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--cgi-requests', type=int, default=40, help='requests per profile in cgi mode')
+    parser.add_argument('--cgi-concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=80.0, help='fake upstream latency, ms')
+    parser.add_argument('--jitter', type=float, default=20.0, help='extra random upstream latency, up to ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream requests that fail with 500')
+    parser.add_argument('--hourly', type=int, default=48, help='One Call hourly entries')
+    parser.add_argument('--daily', type=int, default=8, help='One Call daily entries')
+    parser.add_argument('--quick', action='store_true', help='small run for CI')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--max-failure-rate', type=float,
+                        help='exit with status 1 if any profile fails more than this share of requests')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.requests, args.concurrency, args.cgi_requests, args.latency = 60, 4, 8, 20.0
+
+    fake = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'fake_upstream.py'),
+                             '--latency', str(args.latency), '--jitter', str(args.jitter),
+                             '--error-rate', str(args.error_rate), '--hourly', str(args.hourly),
+                             '--daily', str(args.daily)],
+                            stdout=subprocess.PIPE, text=True, start_new_session=True)
+    fake_env = dict(fake.stdout.readline().strip().split('=', 1) for _ in range(3))
+    results, status = {}, 0
+    print(f'upstream latency {args.latency:g}+{args.jitter:g} ms, error rate {args.error_rate:g}, '
+          f'concurrency {args.concurrency}')
+    print(HEADER)
+    try:
+        for mode in args.modes:
+            if not mode_available(mode):
+                print(f'{mode:<13} skipped (server package not installed)')
+                continue
+            try:
+                results[mode] = run_mode(mode, args, fake_env)
+            except Exception as e:
+                print(f'{mode:<13} failed: {e}')
+                status = 1
+    finally:
+        stop_process(fake)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    if args.max_failure_rate is not None:
+        for mode, profiles in results.items():
+            for profile, r in profiles.items():
+                if r['requests'] and r['failed'] / r['requests'] > args.max_failure_rate:
+                    print(f'{mode} {profile}: {r["failed"]} of {r["requests"]} requests failed')
+                    status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
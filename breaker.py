@@ -0,0 +1,179 @@
+# Weather Alert Pro - circuit breakers for upstream hosts
+# Copyright (c) 2025 Donald Bryant
+# Stops sending requests to an upstream host that is failing or too slow, so
+# workers answer at once (from stale cache where there is any) instead of each
+# waiting out the timeouts.
+#
+# - Every attempt upstream.get()/aget() makes is recorded per host in buckets
+#   of BUCKET seconds. Once a host has had MIN_CALLS calls in the last WINDOW
+#   seconds and at least FAILURE_RATE of them failed (connection errors,
+#   timeouts, 429 or 5xx) or took longer than SLOW_CALL, its circuit opens.
+# - While a circuit is open, requests to that host fail at once with
+#   upstream.CircuitOpenError.
+# - After OPEN_SECONDS the circuit is half-open. One trial request at a time
+#   may go through. If it succeeds the circuit closes. If it fails the circuit
+#   opens again for twice as long, up to MAX_OPEN_SECONDS.
+# - In a persistent server, run_forever() sends the trial itself: a cheap
+#   probe that costs no quota (see upstream.probe). Under CGI, the next real
+#   request is the trial.
+# - State lives in the shared SQLite database, so every process and thread sees
+#   the same circuits.
+import time
+import threading
+
+import cache_store
+import metrics
+
+WINDOW = 60
+BUCKET = 10
+MIN_CALLS = 5
+FAILURE_RATE = 0.5
+SLOW_CALL = 4.0  # seconds; a call this slow counts as a failure
+OPEN_SECONDS = 30
+MAX_OPEN_SECONDS = 300
+TRIAL_TTL = 20  # seconds before an unfinished trial may be retried (longer than any timeout)
+PROBE_TICK = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS breaker_calls (
+    host TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    calls INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    PRIMARY KEY (host, bucket)
+);
+CREATE TABLE IF NOT EXISTS breaker_state (
+    host TEXT PRIMARY KEY,
+    opened REAL NOT NULL,      -- when the circuit first tripped
+    retry_at REAL NOT NULL,    -- when it turns half-open
+    trips INTEGER NOT NULL,    -- consecutive trips, for the back-off
+    trial_until REAL NOT NULL, -- a trial is in progress until then
+    reason TEXT
+);
+"""
+
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def admit(host):
+    """Return (allowed, trial): whether a request to host may go out, and
+    whether it is the trial of a half-open circuit."""
+    now = time.time()
+    try:
+        conn = connect()
+        row = conn.execute('SELECT retry_at FROM breaker_state WHERE host = ?', (host,)).fetchone()
+        if row is None:
+            return True, False
+        if now < row[0]:
+            return False, False
+        # Half-open: the first to claim the trial sends it
+        claimed = conn.execute('UPDATE breaker_state SET trial_until = ? WHERE host = ? AND trial_until < ?',
+                               (now + TRIAL_TTL, host, now)).rowcount == 1
+        return claimed, claimed
+    except Exception:
+        return True, False
+
+def refusing(host):
+    """True if a request to host would be refused right now (no trial claimed)."""
+    now = time.time()
+    try:
+        row = connect().execute('SELECT retry_at, trial_until FROM breaker_state WHERE host = ?', (host,)).fetchone()
+    except Exception:
+        return False
+    return row is not None and (now < row[0] or now < row[1])
+
+def record(host, ok, seconds, trial=False):
+    """Record one attempt; open, re-open or close host's circuit as needed."""
+    failed = not ok or seconds >= SLOW_CALL
+    now = time.time()
+    try:
+        conn = connect()
+        if trial:
+            if failed:
+                reopen(conn, host, now, 'trial failed' if not ok else f'trial took {seconds:.1f}s')
+            else:
+                conn.execute('DELETE FROM breaker_state WHERE host = ?', (host,))
+                conn.execute('DELETE FROM breaker_calls WHERE host = ?', (host,))
+                metrics.inc('weather_breaker_transitions_total', host=host, state='closed')
+            return
+        bucket = int(now // BUCKET)
+        conn.execute('INSERT INTO breaker_calls (host, bucket, calls, failures) VALUES (?, ?, 1, ?) '
+                     'ON CONFLICT (host, bucket) DO UPDATE SET calls = calls + 1, failures = failures + excluded.failures',
+                     (host, bucket, int(failed)))
+        if failed:
+            calls, failures = conn.execute(
+                'SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(failures), 0) FROM breaker_calls '
+                'WHERE host = ? AND bucket > ?', (host, bucket - WINDOW // BUCKET)).fetchone()
+            if calls >= MIN_CALLS and failures >= calls * FAILURE_RATE:
+                trip(conn, host, now, f'{failures} of {calls} calls failed or were slow')
+    except Exception:
+        pass
+
+def trip(conn, host, now, reason):
+    if conn.execute('INSERT OR IGNORE INTO breaker_state (host, opened, retry_at, trips, trial_until, reason) '
+                    'VALUES (?, ?, ?, 1, 0, ?)', (host, now, now + OPEN_SECONDS, reason)).rowcount:
+        metrics.inc('weather_breaker_transitions_total', host=host, state='open')
+
+def reopen(conn, host, now, reason):
+    conn.execute('UPDATE breaker_state SET trips = trips + 1, trial_until = 0, reason = ?, '
+                 'retry_at = ? + MIN(?, ? * (1 << MIN(trips, 10))) WHERE host = ?',
+                 (reason, now, MAX_OPEN_SECONDS, OPEN_SECONDS, host))
+    metrics.inc('weather_breaker_transitions_total', host=host, state='open')
+
+def status():
+    """Return one dict per circuit that is not closed: state (open or half-open),
+    seconds tripped and until the next trial, trips in a row, the reason."""
+    now = time.time()
+    try:
+        rows = connect().execute('SELECT host, opened, retry_at, trips, trial_until, reason FROM breaker_state '
+                                 'ORDER BY host').fetchall()
+    except Exception:
+        return []
+    return [dict(host=host, state='open' if now < retry_at else 'half-open', tripped_for=int(now - opened),
+                 retry_in=max(0, int(retry_at - now)), trips=trips, trial=now < trial_until, reason=reason)
+            for host, opened, retry_at, trips, trial_until, reason in rows]
+
+def recent_calls():
+    """Return {host: (calls, failures)} over the last WINDOW seconds."""
+    try:
+        rows = connect().execute('SELECT host, SUM(calls), SUM(failures) FROM breaker_calls WHERE bucket > ? '
+                                 'GROUP BY host', (int(time.time() // BUCKET) - WINDOW // BUCKET,)).fetchall()
+    except Exception:
+        return {}
+    return {host: (calls, failures) for host, calls, failures in rows}
+
+def prune():
+    try:
+        connect().execute('DELETE FROM breaker_calls WHERE bucket <= ?', (int(time.time() // BUCKET) - WINDOW // BUCKET,))
+    except Exception:
+        pass
+
+def run_pass(probe):
+    """Send the trial for every half-open circuit no one else is trying."""
+    now = time.time()
+    try:
+        hosts = [h for h, in connect().execute('SELECT host FROM breaker_state WHERE retry_at <= ? AND trial_until < ?',
+                                                (now, now)).fetchall()]
+    except Exception:
+        return
+    for host in hosts:
+        try:
+            probe(host)
+        except Exception:
+            pass
+
+def run_forever(probe):
+    """Probe half-open circuits every PROBE_TICK seconds (persistent mode)."""
+    last_prune = 0
+    while True:
+        run_pass(probe)
+        if time.time() - last_prune > WINDOW:
+            prune()
+            last_prune = time.time()
+        time.sleep(PROBE_TICK)
@@ -0,0 +1,143 @@
+# Weather Alert Pro - static asset build
+# Copyright (c) 2025 Donald Bryant
+# Prepares the page and its assets so the web server can serve them directly,
+# with long-lived caching, instead of starting Python for each of them.
+#
+#     python3 build_static.py [--static-url /cgi-bin/static/dist] [--clean]
+#
+# - Every file in static/ is copied to static/dist/ under a content-hashed name
+#   (noaa-thunder.<hash>.jpg). A changed file gets a new name, so these can be
+#   cached forever (Cache-Control: immutable).
+# - Text assets and JSON (and the icon) also get a precompressed .gz copy.
+# - templates/weather_alert_pro.html is rendered once to static/dist/index.html
+#   (plus index.html.gz) with the hashed asset URLs. index() serves it while it
+#   is newer than the template; the page itself is always revalidated.
+# - manifest.json maps each original name to its hashed name, and .htaccess
+#   sets the caching headers and serves the .gz copies on Apache.
+# Run it again after changing the template or an asset; --clean removes hashed
+# files the new build no longer references.
+import os
+import sys
+import json
+import gzip
+import hashlib
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TEMPLATE = 'weather_alert_pro.html'
+PAGE = 'index.html'
+MANIFEST = 'manifest.json'
+# URL prefix the page uses for static/ today, and where dist/ is served from
+SOURCE_URL = '/cgi-bin/static'
+DEFAULT_STATIC_URL = '/cgi-bin/static/dist'
+# Served under their own names (linked from elsewhere, or fetched by crawlers)
+UNHASHED = {'LICENSE', 'robots.txt', '.htaccess'}
+COMPRESSIBLE = ('.json', '.html', '.css', '.js', '.txt', '.svg', '.ico')
+GZIP_LEVEL = 9
+GZIP_MIN_SAVING = 0.1  # keep a .gz copy only if it is at least 10% smaller
+HASH_LENGTH = 10
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+HTACCESS = r"""# Written by build_static.py
+Options -Indexes
+Require all granted
+<IfModule mod_headers.c>
+    # Hashed names change with their content, so they never need revalidating
+    <FilesMatch "\.[0-9a-f]{%(length)d}\.[^.]+(\.gz)?$">
+        Header set Cache-Control "%(immutable)s"
+    </FilesMatch>
+    <FilesMatch "^index\.html(\.gz)?$">
+        Header set Cache-Control "no-cache"
+    </FilesMatch>
+    <FilesMatch "\.gz$">
+        Header append Vary Accept-Encoding
+    </FilesMatch>
+</IfModule>
+<IfModule mod_rewrite.c>
+    # Send the precompressed copy to clients that accept gzip
+    RewriteEngine On
+    RewriteCond %%{HTTP:Accept-Encoding} gzip
+    RewriteCond %%{REQUEST_FILENAME}.gz -f
+    RewriteRule ^(.+)$ $1.gz [L]
+    RewriteRule \.json\.gz$ - [T=application/json,E=no-gzip:1]
+    RewriteRule \.html\.gz$ - [T=text/html;charset=utf-8,E=no-gzip:1]
+    RewriteRule \.ico\.gz$ - [T=image/x-icon,E=no-gzip:1]
+    RewriteRule \.(txt|css|js|svg)\.gz$ - [E=no-gzip:1]
+    <FilesMatch "\.gz$">
+        <IfModule mod_headers.c>
+            Header set Content-Encoding gzip
+        </IfModule>
+    </FilesMatch>
+</IfModule>
+""" % {'length': HASH_LENGTH, 'immutable': IMMUTABLE}
+
+def hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha1(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+def write(path, data):
+    # Write beside the target and rename, so the web server never sees half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def write_with_gzip(name, data):
+    """Write name (and name.gz if worthwhile) to dist/; return the names written."""
+    write(os.path.join(DIST_DIR, name), data)
+    written = [name]
+    if name.endswith(COMPRESSIBLE):
+        packed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+        if len(packed) <= len(data) * (1 - GZIP_MIN_SAVING):
+            write(os.path.join(DIST_DIR, name + '.gz'), packed)
+            written.append(name + '.gz')
+    return written
+
+def render_page():
+    import app
+    with app.app.test_request_context('/'):
+        return app.render_template(TEMPLATE)
+
+def build(static_url=DEFAULT_STATIC_URL, clean=False):
+    """Build static/dist; return the manifest {original name: hashed name}."""
+    os.makedirs(DIST_DIR, exist_ok=True)
+    manifest, written = {}, set()
+    for name in sorted(os.listdir(STATIC_DIR)):
+        path = os.path.join(STATIC_DIR, name)
+        if name in UNHASHED or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        manifest[name] = hashed_name(name, data)
+        written.update(write_with_gzip(manifest[name], data))
+
+    page = render_page()
+    for name, hashed in manifest.items():
+        page = page.replace(f'{SOURCE_URL}/{name}', f'{static_url.rstrip("/")}/{hashed}')
+    written.update(write_with_gzip(PAGE, page.encode('utf-8')))
+    write(os.path.join(DIST_DIR, '.htaccess'), HTACCESS.encode('utf-8'))
+    write(os.path.join(DIST_DIR, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    written.update(('.htaccess', MANIFEST))
+
+    if clean:
+        for name in os.listdir(DIST_DIR):
+            if name not in written:
+                os.remove(os.path.join(DIST_DIR, name))
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build hashed, precompressed static assets and the pre-rendered page')
+    parser.add_argument('--static-url', default=DEFAULT_STATIC_URL,
+                        help=f'URL that static/dist is served from (default {DEFAULT_STATIC_URL})')
+    parser.add_argument('--clean', action='store_true', help='remove files from earlier builds')
+    args = parser.parse_args(argv)
+    manifest = build(args.static_url, args.clean)
+    for name, hashed in sorted(manifest.items()):
+        print(f'{name} -> {hashed}')
+    print(f'{PAGE} written to {os.path.relpath(DIST_DIR, BASE_DIR)}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
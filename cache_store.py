@@ -0,0 +1,257 @@
+# Weather Alert Pro - keyed response cache
+# Copyright (c) 2025 Donald Bryant
+# SQLite-backed store behind get_cached_result/set_cached_result in app.py.
+#
+# - One row per (feature, key), so lookups are a primary-key probe instead of
+#   parsing the whole cache file.
+# - Writes are SQLite transactions in WAL mode: crash-safe and safe to share
+#   between concurrent CGI processes and threads of a persistent server.
+# - The store is bounded to CACHE_MAX_ENTRIES rows; the least recently used
+#   rows are evicted first. Freshness (TTL) is decided by the caller.
+# - Reads do not write: the access times of entries read (from SQLite or the
+#   memory tier) are collected and written in one transaction every
+#   ACCESS_FLUSH_INTERVAL seconds, before an eviction and at exit. The row
+#   count is checked on one write in EVICT_CHECK_EVERY, not on every write.
+# - A long-running process also keeps the last MEMORY_MAX_ENTRIES entries it
+#   read or wrote in memory, so warm lookups skip SQLite entirely.
+# - Encoded response bodies built from an entry (plain and gzipped, with their
+#   ETag) are stored next to it in the rendered table, tagged with the entry's
+#   timestamp. They are only returned while the entry still has that timestamp,
+#   and are dropped when it is replaced or evicted.
+import os
+import json
+import time
+import atexit
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+
+CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_cache.db')
+CACHE_MAX_ENTRIES = 5000
+# Evict down to this fraction of the limit so eviction does not run on every write
+CACHE_EVICT_TO = 0.9
+MEMORY_MAX_ENTRIES = 512
+ACCESS_FLUSH_INTERVAL = 30
+EVICT_CHECK_EVERY = 50
+
+_local = threading.local()
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+_rendered = OrderedDict()
+_accessed = {}  # (feature, key) -> last read, not yet written
+_access_flushed = time.time()
+# Start each process at a random point, so short-lived CGI processes check too
+_writes = random.randrange(EVICT_CHECK_EVERY)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    feature TEXT NOT NULL,
+    key TEXT NOT NULL,
+    ts REAL NOT NULL,
+    last_access REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (feature, key)
+);
+CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access);
+CREATE TABLE IF NOT EXISTS rendered (
+    feature TEXT NOT NULL,
+    key TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    ts REAL NOT NULL,
+    etag TEXT NOT NULL,
+    body BLOB NOT NULL,
+    gzip BLOB,
+    PRIMARY KEY (feature, key, variant)
+);
+"""
+
+def connect():
+    """Return this thread's connection to the cache database."""
+    conn = getattr(_local, 'conn', None)
+    # Connections must not cross a fork (preforking servers)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(CACHE_DB, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+def remember(feature, key, ts, data):
+    with _memory_lock:
+        _memory[(feature, key)] = (ts, data)
+        _memory.move_to_end((feature, key))
+        while len(_memory) > MEMORY_MAX_ENTRIES:
+            _memory.popitem(last=False)
+
+def get_entry(feature, key, max_age=None):
+    """Return (ts, data) for feature/key, or None.
+
+    With max_age, an in-memory copy younger than max_age is returned without
+    touching SQLite; otherwise the stored entry is returned regardless of age.
+    """
+    if max_age is not None:
+        with _memory_lock:
+            entry = _memory.get((feature, key))
+        if entry and time.time() - entry[0] < max_age:
+            accessed(feature, key)
+            return entry
+    try:
+        conn = connect()
+        row = conn.execute('SELECT ts, data FROM cache WHERE feature = ? AND key = ?',
+                           (feature, key)).fetchone()
+        if row is None:
+            return None
+        accessed(feature, key)
+        entry = row[0], json.loads(row[1])
+        remember(feature, key, *entry)
+        return entry
+    except Exception:
+        return None
+
+def set_entry(feature, key, data, ts=None):
+    global _writes
+    ts = time.time() if ts is None else ts
+    remember(feature, key, ts, data)
+    with _memory_lock:
+        _writes += 1
+        check = _writes % EVICT_CHECK_EVERY == 0
+    try:
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('INSERT OR REPLACE INTO cache (feature, key, ts, last_access, data) '
+                         'VALUES (?, ?, ?, ?, ?)', (feature, key, ts, ts, json.dumps(data)))
+            conn.execute('DELETE FROM rendered WHERE feature = ? AND key = ? AND ts != ?', (feature, key, ts))
+            if check:
+                evict(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception:
+        pass
+
+def evict(conn):
+    # Drop least recently used rows once the store grows past its limit
+    count = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    if count <= CACHE_MAX_ENTRIES:
+        return
+    write_access(conn)
+    keep = int(CACHE_MAX_ENTRIES * CACHE_EVICT_TO)
+    conn.execute('DELETE FROM cache WHERE rowid IN '
+                 '(SELECT rowid FROM cache ORDER BY last_access ASC LIMIT ?)', (count - keep,))
+    conn.execute('DELETE FROM rendered WHERE NOT EXISTS (SELECT 1 FROM cache c '
+                 'WHERE c.feature = rendered.feature AND c.key = rendered.key AND c.ts = rendered.ts)')
+
+# --- Access times ---
+def accessed(feature, key):
+    """Note a read of feature/key; written out with the others every ACCESS_FLUSH_INTERVAL."""
+    now = time.time()
+    with _memory_lock:
+        _accessed[(feature, key)] = now
+        due = now - _access_flushed >= ACCESS_FLUSH_INTERVAL
+    if due:
+        flush_access()
+
+def write_access(conn):
+    global _access_flushed
+    with _memory_lock:
+        pending = list(_accessed.items())
+        _accessed.clear()
+        _access_flushed = time.time()
+    conn.executemany('UPDATE cache SET last_access = MAX(last_access, ?) WHERE feature = ? AND key = ?',
+                     [(ts, feature, key) for (feature, key), ts in pending])
+
+@atexit.register
+def flush_access():
+    """Write the access times collected since the last flush."""
+    if not _accessed:
+        return
+    try:
+        conn = connect()
+        if conn.in_transaction:
+            # Read inside another transaction: the times go out with it
+            write_access(conn)
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            write_access(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception:
+        pass
+
+def entry_ts(feature, key, data):
+    """Return the timestamp of the entry holding this very data object, or None.
+
+    Every read and write goes through the memory tier, so right after a lookup
+    this identifies exactly which version of the entry a response was built from.
+    """
+    with _memory_lock:
+        entry = _memory.get((feature, key))
+    return entry[0] if entry and entry[1] is data else None
+
+def get_rendered(feature, key, variant, max_age=None):
+    """Return (ts, etag, body, gzip) rendered from the current feature/key entry, or None.
+
+    max_age works as in get_entry().
+    """
+    if max_age is not None:
+        with _memory_lock:
+            hit = _rendered.get((feature, key, variant))
+            entry = _memory.get((feature, key))
+        if hit and time.time() - hit[0] < max_age and (entry is None or entry[0] == hit[0]):
+            accessed(feature, key)
+            return hit
+    try:
+        conn = connect()
+        row = conn.execute('SELECT r.ts, r.etag, r.body, r.gzip FROM rendered r JOIN cache c '
+                           'ON c.feature = r.feature AND c.key = r.key AND c.ts = r.ts '
+                           'WHERE r.feature = ? AND r.key = ? AND r.variant = ?',
+                           (feature, key, variant)).fetchone()
+        if row is None:
+            return None
+        accessed(feature, key)
+        hit = row[0], row[1], bytes(row[2]), bytes(row[3]) if row[3] is not None else None
+        _remember_rendered(feature, key, variant, hit)
+        return hit
+    except Exception:
+        return None
+
+def set_rendered(feature, key, variant, ts, etag, body, gzip=None):
+    _remember_rendered(feature, key, variant, (ts, etag, body, gzip))
+    try:
+        # Only attach it if the entry has not been replaced in the meantime
+        connect().execute('INSERT OR REPLACE INTO rendered (feature, key, variant, ts, etag, body, gzip) '
+                          'SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS '
+                          '(SELECT 1 FROM cache WHERE feature = ? AND key = ? AND ts = ?)',
+                          (feature, key, variant, ts, etag, body, gzip, feature, key, ts))
+    except Exception:
+        pass
+
+def _remember_rendered(feature, key, variant, hit):
+    with _memory_lock:
+        _rendered[(feature, key, variant)] = hit
+        _rendered.move_to_end((feature, key, variant))
+        while len(_rendered) > MEMORY_MAX_ENTRIES:
+            _rendered.popitem(last=False)
+
+def stats():
+    """Return {feature: number of entries}."""
+    try:
+        return dict(connect().execute('SELECT feature, COUNT(*) FROM cache GROUP BY feature'))
+    except Exception:
+        return {}
+
+def recent(limit=20):
+    """Return [(feature, key, ts, last_access)] for the most recently used entries."""
+    try:
+        return connect().execute('SELECT feature, key, ts, last_access FROM cache '
+                                 'ORDER BY last_access DESC LIMIT ?', (limit,)).fetchall()
+    except Exception:
+        return []
@@ -0,0 +1,88 @@
+# Weather Alert Pro - unit conversion for One Call data
+# Copyright (c) 2025 Donald Bryant
+# One Call is always fetched and cached in CANONICAL_UNITS; metric, imperial and
+# standard responses are all converted from that single entry, so users with
+# different units share one upstream call and one cache entry.
+#
+# - Every converted quantity is a linear map (scale, offset) looked up once per
+#   request in SCALES.
+# - The hourly and daily series are converted a column at a time (one list
+#   comprehension per field over all rows) instead of walking each entry.
+# - Pressure (hPa), visibility (m), precipitation (mm), humidity, clouds and UV
+#   are the same in every unit system and are left alone.
+CANONICAL_UNITS = 'metric'
+UNITS = ('metric', 'imperial', 'standard')
+DEFAULT_UNITS = 'standard'  # what OpenWeatherMap used for an unknown units value
+
+# quantity -> units -> (scale, offset) applied to the metric value
+SCALES = {
+    'temperature': {'metric': (1.0, 0.0), 'imperial': (1.8, 32.0), 'standard': (1.0, 273.15)},
+    'speed': {'metric': (1.0, 0.0), 'imperial': (2.23694, 0.0), 'standard': (1.0, 0.0)},
+}
+# Field paths (within current / one hourly or daily entry) -> quantity
+CURRENT_FIELDS = {
+    ('temp',): 'temperature',
+    ('feels_like',): 'temperature',
+    ('dew_point',): 'temperature',
+    ('wind_speed',): 'speed',
+    ('wind_gust',): 'speed',
+}
+SERIES_FIELDS = {
+    'hourly': CURRENT_FIELDS,
+    'daily': {
+        ('temp', 'day'): 'temperature',
+        ('temp', 'min'): 'temperature',
+        ('temp', 'max'): 'temperature',
+        ('temp', 'night'): 'temperature',
+        ('temp', 'eve'): 'temperature',
+        ('temp', 'morn'): 'temperature',
+        ('feels_like', 'day'): 'temperature',
+        ('feels_like', 'night'): 'temperature',
+        ('feels_like', 'eve'): 'temperature',
+        ('feels_like', 'morn'): 'temperature',
+        ('dew_point',): 'temperature',
+        ('wind_speed',): 'speed',
+        ('wind_gust',): 'speed',
+    },
+}
+PRECISION = 2  # OpenWeatherMap's own precision for converted values
+
+def normalize(units):
+    return units if units in UNITS else DEFAULT_UNITS
+
+def convert_rows(rows, fields, units):
+    """Convert a list of entries; returns new entries, the input is not modified."""
+    rows = [dict(row) for row in rows]
+    # Nested groups (daily temp / feels_like) are copied once, then filled in place
+    for group in {path[0] for path in fields if len(path) > 1}:
+        for row in rows:
+            if isinstance(row.get(group), dict):
+                row[group] = dict(row[group])
+    for path, quantity in fields.items():
+        scale, offset = SCALES[quantity][units]
+        if scale == 1.0 and offset == 0.0:
+            continue
+        *parents, name = path
+        holders = [row.get(parents[0]) if parents else row for row in rows]
+        holders = [h for h in holders if isinstance(h, dict) and isinstance(h.get(name), (int, float))]
+        values = [round(h[name] * scale + offset, PRECISION) for h in holders]
+        for h, value in zip(holders, values):
+            h[name] = value
+    return rows
+
+def convert(data, units):
+    """Return One Call data (or a view built from it) in units.
+
+    data holds canonical values and is never modified; keys other than
+    current/hourly/daily are shared with the result.
+    """
+    units = normalize(units)
+    if units == CANONICAL_UNITS or not isinstance(data, dict):
+        return data
+    out = dict(data)
+    if isinstance(data.get('current'), dict):
+        out['current'] = convert_rows([data['current']], CURRENT_FIELDS, units)[0]
+    for series, fields in SERIES_FIELDS.items():
+        if isinstance(data.get(series), list):
+            out[series] = convert_rows(data[series], fields, units)
+    return out
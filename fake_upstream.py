@@ -0,0 +1,223 @@
+# Weather Alert Pro - local stand-ins for the upstream services
+# Copyright (c) 2025 Donald Bryant
+# Serves the parts of OpenWeatherMap (One Call 3.0, air pollution, direct
+# geocoding), zippopotam.us and ip-api.com that the app calls, so it can be
+# benchmarked or developed without network access or API quota.
+#
+#     python3 fake_upstream.py --latency 80 --error-rate 0.01
+#
+# prints the WEATHER_*_URL settings that point the app at it (see upstream.py).
+#
+# - Each service listens on its own port, so the app's per-host connection pools
+#   and concurrency limits behave as they do against the real hosts.
+# - Answers are deterministic: a city, zip code or coordinate pair always gets
+#   the same place and the same data. 'Nowhere' and zip code 00000 are unknown.
+# - Latency (plus random jitter), the share of requests answered with a 500 and
+#   the size of the One Call payload (hourly, daily and alert entries) are set on
+#   the command line.
+# - GET /__stats on any of the ports returns the request counts per service path.
+import sys
+import json
+import time
+import random
+import zlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+SERVICES = ('openweathermap', 'zippopotam', 'ip-api')
+ENV_NAMES = {
+    'openweathermap': 'WEATHER_OPENWEATHERMAP_URL',
+    'zippopotam': 'WEATHER_ZIPPOPOTAM_URL',
+    'ip-api': 'WEATHER_IP_API_URL',
+}
+DEFAULTS = {
+    'latency': 50.0,  # ms
+    'jitter': 20.0,  # ms, uniform on top of latency
+    'error_rate': 0.0,
+    'hourly': 48,
+    'daily': 8,
+    'alerts': 1,
+}
+WEATHER = [
+    {'id': 800, 'main': 'Clear', 'description': 'clear sky', 'icon': '01d'},
+    {'id': 802, 'main': 'Clouds', 'description': 'scattered clouds', 'icon': '03d'},
+    {'id': 500, 'main': 'Rain', 'description': 'light rain', 'icon': '10d'},
+    {'id': 600, 'main': 'Snow', 'description': 'light snow', 'icon': '13d'},
+]
+BODY_CACHE_MAX = 10000
+
+STATS = Counter()
+_stats_lock = threading.Lock()
+_bodies = {}
+
+def seed_of(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+def place_coords(name):
+    h = seed_of(name.lower())
+    return round(-60 + (h % 12000) / 100.0, 4), round(-180 + (h // 12000 % 36000) / 100.0, 4)
+
+# --- Payloads ---
+def weather_entry(rng, dt, temp):
+    return {
+        'dt': dt, 'temp': round(temp, 2), 'feels_like': round(temp - rng.uniform(0, 3), 2),
+        'pressure': rng.randint(990, 1030), 'humidity': rng.randint(20, 100),
+        'dew_point': round(temp - rng.uniform(2, 10), 2), 'uvi': round(rng.uniform(0, 10), 2),
+        'clouds': rng.randint(0, 100), 'visibility': 10000, 'wind_speed': round(rng.uniform(0, 15), 2),
+        'wind_deg': rng.randint(0, 359), 'wind_gust': round(rng.uniform(0, 20), 2),
+        'weather': [rng.choice(WEATHER)],
+    }
+
+def onecall(lat, lon, config):
+    rng = random.Random(seed_of(f'{lat},{lon}'))
+    now = int(time.time()) // 3600 * 3600
+    base = rng.uniform(-10, 30)
+    current = weather_entry(rng, now, base)
+    current.update(sunrise=now - 21600, sunset=now + 21600)
+    hourly = [dict(weather_entry(rng, now + i * 3600, base + rng.uniform(-3, 3)), pop=round(rng.random(), 2))
+              for i in range(config['hourly'])]
+    daily = []
+    for i in range(config['daily']):
+        day = weather_entry(rng, now + i * 86400, base)
+        low, high = base - rng.uniform(2, 8), base + rng.uniform(2, 8)
+        day['temp'] = {'day': round(base, 2), 'min': round(low, 2), 'max': round(high, 2),
+                       'night': round(low + 1, 2), 'eve': round(high - 2, 2), 'morn': round(low + 2, 2)}
+        day['feels_like'] = {'day': round(base - 1, 2), 'night': round(low, 2), 'eve': round(high - 3, 2),
+                             'morn': round(low + 1, 2)}
+        day.update(sunrise=now + i * 86400 - 21600, sunset=now + i * 86400 + 21600, moonrise=now, moonset=now,
+                   moon_phase=0.5, pop=round(rng.random(), 2), summary='Benchmark weather')
+        daily.append(day)
+    alerts = [{'sender_name': 'Fake NWS', 'event': f'Test Advisory {i + 1}', 'start': now, 'end': now + 43200,
+               'description': 'Issued by fake_upstream.py for testing.', 'tags': ['Test']}
+              for i in range(config['alerts'])]
+    data = {'lat': lat, 'lon': lon, 'timezone': 'UTC', 'timezone_offset': 0,
+            'current': current, 'hourly': hourly, 'daily': daily}
+    if alerts:
+        data['alerts'] = alerts
+    return data
+
+def air_pollution(lat, lon):
+    rng = random.Random(seed_of(f'air {lat},{lon}'))
+    components = {name: round(rng.uniform(0, 50), 2) for name in ('co', 'no', 'no2', 'o3', 'so2', 'pm2_5', 'pm10', 'nh3')}
+    return {'coord': {'lon': lon, 'lat': lat},
+            'list': [{'main': {'aqi': rng.randint(1, 5)}, 'components': components, 'dt': int(time.time())}]}
+
+def answer(service, path, query, config):
+    """Return (status, body object) for one request."""
+    parts = [p for p in path.split('/') if p]
+    if service == 'openweathermap':
+        if path == '/geo/1.0/direct':
+            q = query.get('q', '')
+            city, _, rest = q.partition(',')
+            if not city or city.strip().lower().startswith('nowhere'):
+                return 200, []
+            state, _, country = rest.partition(',')
+            lat, lon = place_coords(q)
+            return 200, [{'name': city.strip(), 'lat': lat, 'lon': lon, 'state': state.strip(), 'country': country.strip() or 'US'}]
+        try:
+            lat, lon = float(query['lat']), float(query['lon'])
+        except (KeyError, ValueError):
+            return 400, {'cod': '400', 'message': 'wrong latitude or longitude'}
+        if path == '/data/3.0/onecall':
+            return 200, onecall(lat, lon, config)
+        if path == '/data/2.5/air_pollution':
+            return 200, air_pollution(lat, lon)
+    elif service == 'zippopotam' and len(parts) == 2:
+        country, zip_code = parts
+        if zip_code == '00000':
+            return 404, {}
+        lat, lon = place_coords(f'{country}/{zip_code}')
+        return 200, {'post code': zip_code, 'country abbreviation': country.upper(),
+                     'places': [{'place name': f'Zip {zip_code}', 'latitude': str(lat), 'longitude': str(lon),
+                                 'state': 'Benchmark', 'state abbreviation': 'BM'}]}
+    elif service == 'ip-api' and len(parts) == 2 and parts[0] == 'json':
+        return 200, {'status': 'success', 'city': 'Loopback', 'regionName': 'Local', 'country': 'Benchmark'}
+    return 404, {'message': 'Not found'}
+
+def make_handler(service, config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/__stats':
+                with _stats_lock:
+                    return self.send_json(200, json.dumps(dict(STATS)).encode())
+            label = f'{service}:{url.path}' if service == 'openweathermap' else service
+            with _stats_lock:
+                STATS[label] += 1
+            time.sleep((config['latency'] + random.uniform(0, config['jitter'])) / 1000.0)
+            if random.random() < config['error_rate']:
+                return self.send_json(500, b'{"cod":500,"message":"fake upstream error"}')
+            key = (service, self.path)
+            body = _bodies.get(key)
+            if body is None:
+                status, data = answer(service, url.path, dict(parse_qsl(url.query)), config)
+                body = (status, json.dumps(data).encode())
+                # One Call data changes hourly; only cache what is stable
+                if status == 200 and len(_bodies) < BODY_CACHE_MAX and '/onecall' not in url.path:
+                    _bodies[key] = body
+            self.send_json(*body)
+
+        def send_json(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+def start(config=None, host='127.0.0.1', ports=(0, 0, 0)):
+    """Start the three services on background threads.
+
+    Returns (servers, env) where env holds the WEATHER_*_URL settings for the app.
+    """
+    config = dict(DEFAULTS, **(config or {}))
+    servers, env = [], {}
+    for service, port in zip(SERVICES, ports):
+        server = Server((host, port), make_handler(service, config))
+        server.config = config  # live: change error_rate or latency while running
+        threading.Thread(target=server.serve_forever, name=f'fake-{service}', daemon=True).start()
+        servers.append(server)
+        env[ENV_NAMES[service]] = f'http://{host}:{server.server_address[1]}'
+    return servers, env
+
+def stop(servers):
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-ins for OpenWeatherMap, zippopotam.us and ip-api.com')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--ports', default='0,0,0', help='openweathermap,zippopotam,ip-api (0 picks a free port)')
+    parser.add_argument('--latency', type=float, default=DEFAULTS['latency'], help='ms per request')
+    parser.add_argument('--jitter', type=float, default=DEFAULTS['jitter'], help='extra random ms, up to this much')
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['error_rate'], help='share of requests answered with 500')
+    parser.add_argument('--hourly', type=int, default=DEFAULTS['hourly'], help='One Call hourly entries')
+    parser.add_argument('--daily', type=int, default=DEFAULTS['daily'], help='One Call daily entries')
+    parser.add_argument('--alerts', type=int, default=DEFAULTS['alerts'], help='One Call alerts')
+    args = parser.parse_args(argv)
+    config = {name: getattr(args, name) for name in DEFAULTS}
+    servers, env = start(config, args.host, [int(p) for p in args.ports.split(',')])
+    for name, url in env.items():
+        print(f'{name}={url}')
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop(servers)
+
+if __name__ == '__main__':
+    main()
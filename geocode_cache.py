@@ -0,0 +1,147 @@
+# Weather Alert Pro - persistent geocoding cache
+# Copyright (c) 2025 Donald Bryant
+# Remembers what get_location resolved so repeat lookups never leave the box.
+#
+# - Keys are normalized (zip, country) and (city, state, country) tuples.
+# - Successful lookups are kept for GEOCODE_TTL; failures are cached for
+#   GEOCODE_NEGATIVE_TTL and written to geocoding_failures.log.
+# - Seeded rows (the country capitals and top US cities offered by the UI) never
+#   expire. The static lists only carry names, so seeding resolves each name once:
+#
+#       python geocode_cache.py seed
+#
+#   Re-running only resolves names that are not cached yet. A persistent server
+#   (weather.fcgi) also runs the seed in the background at startup.
+import os
+import sys
+import json
+import time
+import threading
+
+import cache_store
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GEOCODE_TTL = 30 * 86400  # 30 days
+GEOCODE_NEGATIVE_TTL = 86400  # retry failed lookups after a day
+GEOCODE_FAILURE_LOG = os.path.join(BASE_DIR, 'geocoding_failures.log')
+US_CITIES_FILE = os.path.join(BASE_DIR, 'static', 'us_states_cities.json')
+COUNTRY_CAPITALS_FILE = os.path.join(BASE_DIR, 'static', 'country_capitals.json')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocode (
+    key TEXT PRIMARY KEY,
+    found INTEGER NOT NULL,
+    lat REAL,
+    lon REAL,
+    city TEXT,
+    state TEXT,
+    expires REAL
+);
+"""
+
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def _norm(value):
+    return ' '.join((value or '').split()).lower()
+
+def zip_key(zip_code, country):
+    return f"zip|{_norm(country) or 'us'}|{_norm(zip_code)}"
+
+def city_key(city, state, country):
+    return f'city|{_norm(city)}|{_norm(state)}|{_norm(country)}'
+
+def lookup(key):
+    """Return (lat, lon, city, state) on a hit, False for a cached failure, None if unknown."""
+    try:
+        row = connect().execute('SELECT found, lat, lon, city, state, expires FROM geocode WHERE key = ?',
+                                (key,)).fetchone()
+    except Exception:
+        return None
+    if row is None:
+        return None
+    found, lat, lon, city, state, expires = row
+    if expires is not None and expires < time.time():
+        return None
+    if not found:
+        return False
+    return lat, lon, city, state
+
+def store(key, lat, lon, city, state, ttl=GEOCODE_TTL):
+    # ttl=None pins the row (used for seeded locations)
+    expires = None if ttl is None else time.time() + ttl
+    try:
+        connect().execute('INSERT OR REPLACE INTO geocode (key, found, lat, lon, city, state, expires) '
+                          'VALUES (?, 1, ?, ?, ?, ?, ?)', (key, lat, lon, city, state, expires))
+    except Exception:
+        pass
+
+def store_failure(key, message):
+    try:
+        connect().execute('INSERT OR REPLACE INTO geocode (key, found, expires) VALUES (?, 0, ?)',
+                          (key, time.time() + GEOCODE_NEGATIVE_TTL))
+    except Exception:
+        pass
+    log_failure(f'{key} | {message}')
+
+def log_failure(message):
+    try:
+        with open(GEOCODE_FAILURE_LOG, 'a') as f:
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {message}\n")
+    except Exception:
+        pass
+
+def seed_locations():
+    """Yield (city, state, country) for every location the UI auto-selects."""
+    try:
+        with open(COUNTRY_CAPITALS_FILE) as f:
+            for country, capital in json.load(f).items():
+                yield capital, None, country
+    except Exception:
+        pass
+    try:
+        with open(US_CITIES_FILE) as f:
+            for state, cities in json.load(f).items():
+                for city in cities:
+                    yield city, state, 'US'
+    except Exception:
+        pass
+
+def seed(resolve, pause=0):
+    """Pin every seed location, calling resolve(city, state, country) for unknown ones.
+
+    resolve returns (lat, lon, city, state) or (None, None, ...) like get_location.
+    pause sleeps between network lookups. Returns (seeded, failed) counts.
+    """
+    seeded = failed = 0
+    for city, state, country in seed_locations():
+        key = city_key(city, state, country)
+        hit = lookup(key)
+        if not hit:
+            lat, lon, name, region = resolve(city, state, country)
+            if pause:
+                time.sleep(pause)
+            if lat is None or lon is None:
+                failed += 1
+                continue
+            hit = (lat, lon, name, region)
+        store(key, *hit, ttl=None)
+        if state is None:
+            # The UI sends capitals without a country, so pin that spelling too
+            store(city_key(city, None, None), *hit, ttl=None)
+        seeded += 1
+    return seeded, failed
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['seed']:
+        print('usage: geocode_cache.py seed', file=sys.stderr)
+        sys.exit(2)
+    import app
+    seeded, failed = seed(lambda city, state, country: app.get_location(city, state, None, country))
+    print(f'seeded {seeded} locations, {failed} failed')
@@ -0,0 +1,188 @@
+# Weather Alert Pro - hourly and daily weather history
+# Copyright (c) 2025 Donald Bryant
+# Keeps what One Call reported for each grid cell in fixed-width binary files,
+# so history can grow for months without ever being loaded whole.
+#
+# - Three series per location: 'observed' (current conditions, one slot per
+#   hour), 'hourly' (the latest forecast for each hour) and 'daily' (the latest
+#   forecast for each day). Values are in conversion.CANONICAL_UNITS.
+# - A series file is a header (magic, step, first slot) followed by one RECORD
+#   per slot: the timestamp and COLUMNS as float32, NaN where One Call had no
+#   value. Slot n covers [n * step, (n + 1) * step), so a record is found by
+#   arithmetic and written in place; empty slots are holes in a sparse file.
+#   History only grows forward: readings older than a file's first slot are
+#   ignored.
+# - A range query reads one contiguous slice and splits it into columns with
+#   array slicing, then averages it down to at most `points` buckets.
+# - record() is fed every One Call result fetched upstream (set_cached_result
+#   in app.py). Writers hold an exclusive flock on the file, so processes
+#   never interleave a batch; readers hold a shared one.
+# - prune() (daily reset) trims files to HISTORY_MAX_DAYS and deletes those of
+#   locations not updated for HISTORY_IDLE_DAYS.
+import os
+import sys
+import math
+import time
+import fcntl
+import struct
+from array import array
+
+import cache_store
+
+HISTORY_DIR = os.path.join(os.path.dirname(cache_store.CACHE_DB), 'history')
+HISTORY_MAX_DAYS = 90
+HISTORY_IDLE_DAYS = 14
+SERIES = {'observed': 3600, 'hourly': 3600, 'daily': 86400}  # series -> slot width in seconds
+COLUMNS = ('temp', 'temp_min', 'temp_max', 'humidity', 'pressure', 'wind_speed', 'uvi')
+QUANTITIES = {'temp': 'temperature', 'temp_min': 'temperature', 'temp_max': 'temperature', 'wind_speed': 'speed'}
+MAGIC = b'WAH1'
+HEADER = struct.Struct('<4sIq')  # magic, step, first slot
+RECORD = struct.Struct('<I%df' % len(COLUMNS))  # timestamp (0 = empty slot), columns
+WIDTH = RECORD.size // 4  # 4-byte words per record
+NAN = float('nan')
+
+def series_path(series, key):
+    return os.path.join(HISTORY_DIR, f"{series}-{key.replace(',', '_')}.bin")
+
+def number(value):
+    return float(value) if isinstance(value, (int, float)) else NAN
+
+def rows_from(data):
+    """Return {series: [(ts, values), ...]} from a One Call result."""
+    rows = {'observed': [], 'hourly': [], 'daily': []}
+    current = data.get('current') or {}
+    entries = [('observed', current)] if current.get('dt') else []
+    entries += [('hourly', hour) for hour in data.get('hourly') or []]
+    for series, entry in entries:
+        if isinstance(entry.get('dt'), int):
+            rows[series].append((entry['dt'], (
+                number(entry.get('temp')), NAN, NAN, number(entry.get('humidity')), number(entry.get('pressure')),
+                number(entry.get('wind_speed')), number(entry.get('uvi')))))
+    for day in data.get('daily') or []:
+        temp = day.get('temp') if isinstance(day.get('temp'), dict) else {}
+        if isinstance(day.get('dt'), int):
+            rows['daily'].append((day['dt'], (
+                number(temp.get('day')), number(temp.get('min')), number(temp.get('max')), number(day.get('humidity')),
+                number(day.get('pressure')), number(day.get('wind_speed')), number(day.get('uvi')))))
+    return rows
+
+def write(series, key, rows):
+    """Write (ts, values) rows into their slots of one series file."""
+    if not rows:
+        return
+    step = SERIES[series]
+    fd = os.open(series_path(series, key), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            first = min(ts for ts, values in rows) // step
+            os.pwrite(fd, HEADER.pack(MAGIC, step, first), 0)
+        else:
+            magic, step, first = HEADER.unpack(header)
+            if magic != MAGIC:
+                return
+        records = {}
+        for ts, values in sorted(rows):
+            if ts // step >= first:
+                records[ts // step - first] = RECORD.pack(ts, *values)  # the later reading in a slot wins
+        # Consecutive slots (a forecast) go out in one write
+        slots = sorted(records)
+        i = 0
+        while i < len(slots):
+            j = i + 1
+            while j < len(slots) and slots[j] == slots[j - 1] + 1:
+                j += 1
+            os.pwrite(fd, b''.join(records[slot] for slot in slots[i:j]), HEADER.size + slots[i] * RECORD.size)
+            i = j
+    finally:
+        os.close(fd)
+
+def record(key, data):
+    """Add a One Call result (canonical units) to the history of key's grid cell."""
+    try:
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        for series, rows in rows_from(data).items():
+            write(series, key, rows)
+    except Exception:
+        pass
+
+def read_slice(series, key, start, end):
+    """Return (timestamps, {column: values}) for the slots of start..end, empty slots included."""
+    try:
+        f = open(series_path(series, key), 'rb')
+    except OSError:
+        return array('I'), {}
+    with f:
+        # Shared with other readers; trim() rewrites the file in place under an exclusive lock
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            return array('I'), {}
+        magic, step, first = HEADER.unpack(header)
+        count = (os.fstat(f.fileno()).st_size - HEADER.size) // RECORD.size
+        lo = max(0, start // step - first)
+        hi = min(count, end // step - first + 1)
+        if hi <= lo:
+            return array('I'), {}
+        f.seek(HEADER.size + lo * RECORD.size)
+        chunk = f.read((hi - lo) * RECORD.size)
+    # Records are WIDTH 4-byte words; every WIDTH-th word is one column
+    words = array('I', chunk)
+    values = array('f', chunk)
+    if sys.byteorder != 'little':
+        words.byteswap()
+        values.byteswap()
+    return words[0::WIDTH], {name: values[i + 1::WIDTH] for i, name in enumerate(COLUMNS)}
+
+def query(series, key, start, end, points=None, columns=COLUMNS):
+    """Return {'ts': [...], column: [...]} for start <= ts <= end, averaged into
+    at most points buckets (None where a bucket has no value)."""
+    stamps, values = read_slice(series, key, start, end)
+    keep = [i for i, ts in enumerate(stamps) if ts and start <= ts <= end]
+    size = max(1, math.ceil(len(keep) / points)) if points else 1
+    result = {'ts': []}
+    result.update((name, []) for name in columns)
+    for b in range(0, len(keep), size):
+        bucket = keep[b:b + size]
+        result['ts'].append(round(sum(stamps[i] for i in bucket) / len(bucket)))
+        for name in columns:
+            column = values[name]
+            found = [column[i] for i in bucket if column[i] == column[i]]  # NaN != NaN
+            result[name].append(round(sum(found) / len(found), 2) if found else None)
+    return result
+
+def trim(path, keep_slots):
+    # In place, under the writers' lock: a renamed copy would strand a writer
+    # waiting on the old file's lock, and its rows with it
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        magic, step, first = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+        count = (os.fstat(fd).st_size - HEADER.size) // RECORD.size
+        if magic != MAGIC or count <= keep_slots:
+            return
+        tail = os.pread(fd, keep_slots * RECORD.size, HEADER.size + (count - keep_slots) * RECORD.size)
+        os.pwrite(fd, HEADER.pack(MAGIC, step, first + count - keep_slots) + tail, 0)
+        os.ftruncate(fd, HEADER.size + len(tail))
+    finally:
+        os.close(fd)
+
+def prune():
+    """Drop history older than HISTORY_MAX_DAYS and of locations idle for HISTORY_IDLE_DAYS."""
+    try:
+        names = os.listdir(HISTORY_DIR)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(HISTORY_DIR, name)
+        try:
+            if os.path.getmtime(path) < now - HISTORY_IDLE_DAYS * 86400:
+                os.remove(path)
+                continue
+            series = name.split('-', 1)[0]
+            if series in SERIES and name.endswith('.bin'):
+                trim(path, HISTORY_MAX_DAYS * 86400 // SERIES[series])
+        except Exception:
+            pass
@@ -0,0 +1,199 @@
+# Weather Alert Pro - request timing and Prometheus metrics
+# Copyright (c) 2025 Donald Bryant
+# Cheap enough to leave on: a span is two clock reads and a counter update in
+# memory; the database is only touched when the buffered counts are flushed.
+#
+# - span('name') times one phase of a request (log, location, cache, upstream,
+#   render). The phases of the current request are returned by finish() as a
+#   Server-Timing header; spans may nest (a location lookup contains its own
+#   upstream call). The request context is a contextvar, so this works for
+#   server threads and for asyncio tasks alike.
+# - Counters and histograms are buffered per process and added to the shared
+#   metrics table by flush() (called with every usage log batch, and at exit
+#   under CGI), so /metrics shows totals over every process and serving mode.
+# - exposition() returns everything in the Prometheus text format, plus the
+#   remaining upstream quota read at scrape time.
+import json
+import time
+import bisect
+import inspect
+import threading
+import functools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+import cache_store
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKET_LABELS = tuple(repr(b) for b in BUCKETS) + ('+Inf',)
+METRICS = {
+    'weather_request_seconds': ('histogram', 'Time to handle a request, by route'),
+    'weather_phase_seconds': ('histogram', 'Time spent in one phase of a request'),
+    'weather_upstream_seconds': ('histogram', 'Duration of one upstream HTTP attempt, by host'),
+    'weather_upstream_requests_total': ('counter', 'Upstream HTTP responses, by host and status'),
+    'weather_upstream_errors_total': ('counter', 'Failed upstream attempts (exceptions and 4xx/5xx statuses), by host'),
+    'weather_cache_requests_total': ('counter', 'Cache lookups by feature and result (hit or miss)'),
+    'weather_cache_nearby_total': ('counter', 'Misses answered from a nearby grid cell instead of upstream'),
+    'weather_stale_responses_total': ('counter', 'Expired entries served because the upstream quota was spent or the service failed'),
+    'weather_quota_errors_total': ('counter', 'Upstream calls refused because the quota counters could not be updated'),
+    'weather_breaker_transitions_total': ('counter', 'Circuit breaker state changes, by host and new state (open or closed)'),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,  -- JSON list of [label, value] pairs
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+_pending = Counter()
+_lock = threading.Lock()
+_schema_ready = threading.local()
+_request = contextvars.ContextVar('metrics_request', default=None)
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+# --- Recording ---
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _pending[key] += value
+
+def observe(name, seconds, **labels):
+    pairs = tuple(sorted(labels.items()))
+    le = BUCKET_LABELS[bisect.bisect_left(BUCKETS, seconds)]
+    with _lock:
+        # Buckets are kept non-cumulative and summed up in exposition()
+        _pending[(name + '_bucket', pairs + (('le', le),))] += 1
+        _pending[(name + '_sum', pairs)] += seconds
+        _pending[(name + '_count', pairs)] += 1
+
+# --- Request timing ---
+def begin():
+    """Start timing a request in the current context."""
+    _request.set({'start': time.perf_counter(), 'spans': {}})
+
+@contextmanager
+def span(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('weather_phase_seconds', elapsed, phase=phase)
+        current = _request.get()
+        if current is not None:
+            current['spans'][phase] = current['spans'].get(phase, 0.0) + elapsed
+
+def timed(phase):
+    """Decorator: run the function (or coroutine function) inside span(phase)."""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                with span(phase):
+                    return await func(*args, **kwargs)
+            return timed_coroutine
+
+        @functools.wraps(func)
+        def timed_function(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+        return timed_function
+    return decorate
+
+def finish(route):
+    """Record the request's total time; return its Server-Timing header value, or None."""
+    current = _request.get()
+    if current is None:
+        return None
+    _request.set(None)
+    total = time.perf_counter() - current['start']
+    observe('weather_request_seconds', total, route=route)
+    parts = [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in current['spans'].items()]
+    return ', '.join(parts + [f'total;dur={total * 1000:.1f}'])
+
+# --- Shared totals ---
+def flush():
+    """Add this process's buffered counts to the shared metrics table."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return
+    rows = [(name, json.dumps(labels), value) for (name, labels), value in pending.items()]
+    try:
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value', rows)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception:
+        # Keep the counts for the next flush rather than losing them
+        with _lock:
+            _pending.update(pending)
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def format_value(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+def exposition(gauges=()):
+    """Return all metrics in the Prometheus text format.
+
+    gauges is a list of (name, help, value) read by the caller at scrape time.
+    """
+    flush()
+    try:
+        rows = connect().execute('SELECT name, labels, value FROM metrics').fetchall()
+    except Exception:
+        rows = []
+    families = {}
+    for name, labels, value in rows:
+        pairs = tuple(tuple(p) for p in json.loads(labels))
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                family = name[:-len(suffix)]
+        families.setdefault(family, []).append((name, pairs, value))
+    lines = []
+    for family in sorted(families):
+        kind, help_text = METRICS.get(family, ('untyped', family))
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        buckets = {}
+        others = []
+        for name, pairs, value in sorted(families[family]):
+            if name.endswith('_bucket') and kind == 'histogram':
+                le = dict(pairs)['le']
+                buckets.setdefault(tuple(p for p in pairs if p[0] != 'le'), {})[le] = value
+            else:
+                others.append(f'{name}{format_labels(pairs)} {format_value(value)}')
+        for pairs, counts in sorted(buckets.items()):
+            running = 0
+            for le in BUCKET_LABELS:
+                running += counts.get(le, 0)
+                lines.append(f"{family}_bucket{format_labels(pairs + (('le', le),))} {format_value(running)}")
+        lines.extend(others)
+    for name, help_text, value in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
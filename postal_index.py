@@ -0,0 +1,170 @@
+# Weather Alert Pro - offline postal-code index
+# Copyright (c) 2025 Donald Bryant
+# Resolves (country, postal code) -> (lat, lon, place, state) from a local
+# file, so ZIP lookups no longer need a request to zippopotam.us.
+#
+#     python3 postal_index.py build [allCountries.zip | allCountries.txt | URL]
+#
+# - The source is the GeoNames postal-code dump (GEONAMES_URL by default; a
+#   single-country file such as US.zip works too). Build it once and again
+#   whenever you want fresher data.
+# - postal_index.bin is a header (magic, record count, string table offset),
+#   then one fixed-width RECORD per code sorted by (country, code), then a
+#   table of "place<TAB>state" strings the records point into.
+# - lookup() maps the file with mmap and binary-searches the records, so the
+#   pages are shared by every process and only the ones touched are read.
+#   A rebuilt file is picked up within CHECK_INTERVAL seconds.
+# - A code the index does not know returns None; get_location() then asks
+#   zippopotam as before.
+import os
+import sys
+import mmap
+import time
+import struct
+import zipfile
+import threading
+import urllib.request
+
+import cache_store
+
+INDEX_PATH = os.path.join(os.path.dirname(cache_store.CACHE_DB), 'postal_index.bin')
+GEONAMES_URL = 'https://download.geonames.org/export/zip/allCountries.zip'
+MAGIC = b'WAP1'
+HEADER = struct.Struct('<4sIQ')  # magic, record count, string table offset
+KEY_SIZE = 12  # 2-byte country code + postal code padded to 10 bytes
+RECORD = struct.Struct('<12sffIH')  # key, lat, lon, string offset, string length
+CHECK_INTERVAL = 60
+
+_index = None  # (mmap, count, strings offset, (inode, mtime), checked at)
+_index_lock = threading.Lock()
+
+def normalize(zip_code):
+    return ' '.join(str(zip_code).upper().split())
+
+def make_key(country, zip_code):
+    """Return the sort key of a code, or None if it does not fit a record."""
+    country = (country or 'US').upper()
+    code = normalize(zip_code).encode('utf-8')
+    if len(country) != 2 or not code or len(code) > KEY_SIZE - 2:
+        return None
+    return country.encode('ascii', 'replace') + code.ljust(KEY_SIZE - 2, b'\0')
+
+# --- Build ---
+def source_lines(source):
+    """Yield the text lines of a GeoNames dump (.txt, or the .zip it ships in)."""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            name = next(n for n in archive.namelist() if n.endswith('.txt') and not n.lower().startswith('readme'))
+            with archive.open(name) as f:
+                for line in f:
+                    yield line.decode('utf-8', 'replace')
+    else:
+        with open(source, encoding='utf-8', errors='replace') as f:
+            yield from f
+
+def build(source, path=INDEX_PATH):
+    """Write the index for a GeoNames dump; return the number of codes."""
+    entries = {}
+    for line in source_lines(source):
+        # country, code, place, admin1 name, admin1 code, ..., lat (9), lon (10)
+        cols = line.rstrip('\n').split('\t')
+        if len(cols) < 11:
+            continue
+        key = make_key(cols[0], cols[1])
+        if key is None or key in entries:
+            continue  # the first place listed for a code wins, as on zippopotam
+        try:
+            lat, lon = float(cols[9]), float(cols[10])
+        except ValueError:
+            continue
+        state = cols[4] or cols[3]
+        entries[key] = (lat, lon, f'{cols[2]}\t{state}'.encode('utf-8'))
+
+    records, strings, offsets = [], [], {}
+    size = 0
+    for key in sorted(entries):
+        lat, lon, text = entries[key]
+        if text not in offsets:
+            offsets[text] = size
+            strings.append(text)
+            size += len(text)
+        records.append(RECORD.pack(key, lat, lon, offsets[text], len(text)))
+
+    # Write beside the target and rename; processes still mapping the old file keep it
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records), HEADER.size + len(records) * RECORD.size))
+        f.write(b''.join(records))
+        f.write(b''.join(strings))
+    os.replace(tmp, path)
+    return len(records)
+
+# --- Lookup ---
+def open_index():
+    """Return the mapped index, remapping it if the file was rebuilt (None if absent)."""
+    global _index
+    now = time.time()
+    if _index is not None and now - _index[4] < CHECK_INTERVAL:
+        return _index
+    with _index_lock:
+        if _index is not None and now - _index[4] < CHECK_INTERVAL:
+            return _index
+        try:
+            st = os.stat(INDEX_PATH)
+        except OSError:
+            _index = None
+            return None
+        if _index is not None and _index[3] == (st.st_ino, st.st_mtime):
+            _index = _index[:4] + (now,)
+            return _index
+        try:
+            with open(INDEX_PATH, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count, strings = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                data.close()
+                _index = None
+                return None
+            # An old mapping is left to the garbage collector: a reader may still hold it
+            _index = (data, count, strings, (st.st_ino, st.st_mtime), now)
+        except (OSError, ValueError, struct.error):
+            _index = None
+        return _index
+
+def lookup(zip_code, country=None):
+    """Return (lat, lon, place, state) for a postal code, or None if the index lacks it."""
+    key = make_key(country, zip_code)
+    index = open_index() if key else None
+    if index is None:
+        return None
+    data, count, strings = index[:3]
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        at = HEADER.size + mid * RECORD.size
+        probe = data[at:at + KEY_SIZE]
+        if probe < key:
+            lo = mid + 1
+        elif probe > key:
+            hi = mid
+        else:
+            _, lat, lon, offset, length = RECORD.unpack_from(data, at)
+            place, state = data[strings + offset:strings + offset + length].decode('utf-8').split('\t')
+            # float32 keeps ~1 m; round so keys match what zippopotam returned
+            return round(lat, 4), round(lon, 4), place, state
+    return None
+
+def main(argv):
+    if len(argv) < 1 or argv[0] != 'build':
+        print('usage: postal_index.py build [allCountries.zip | allCountries.txt | URL]')
+        return 2
+    source = argv[1] if len(argv) > 1 else GEONAMES_URL
+    if source.startswith(('http://', 'https://')):
+        print(f'Downloading {source}...')
+        source, _ = urllib.request.urlretrieve(source)
+    count = build(source)
+    print(f'{count} postal codes written to {INDEX_PATH}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
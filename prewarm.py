@@ -0,0 +1,110 @@
+# Weather Alert Pro - pre-warming of hot locations
+# Copyright (c) 2025 Donald Bryant
+# Keeps the most requested locations fresh so users rarely pay upstream latency.
+#
+# - Candidates are ranked by recent demand (usage_log.top_demand), followed by
+#   the country capitals the page selects by default that were requested in
+#   the last PREWARM_CAPITAL_DAYS days; an idle site spends nothing on them.
+# - An entry is refreshed when it is missing or within PREWARM_LEAD seconds of
+#   its TTL.
+# - Refreshes draw from a 'prewarm' pool limited to PREWARM_QUOTA_SHARE of the
+#   daily quota, released evenly over the day, so pre-warming can never starve
+#   user requests.
+#
+# A persistent server (weather.fcgi) runs run_forever() in a background thread.
+# Under CGI, run a pass from cron instead:
+#
+#     */5 * * * * cd /path/to/cgi-bin && python3 prewarm.py
+#
+# 'python3 prewarm.py refresh <feature> <key>' refreshes a single entry; the CGI
+# stale-while-revalidate path uses it to refresh outside the request process.
+import sys
+import time
+
+import cache_store
+import geocode_cache
+import quota
+import spatial
+import usage_log
+
+PREWARM_QUOTA_SHARE = 0.2
+PREWARM_INTERVAL = 60  # seconds between passes
+PREWARM_LEAD = 120  # refresh this many seconds before an entry expires
+PREWARM_TOP_N = 50
+PREWARM_BURST = 5
+PREWARM_CAPITAL_DAYS = 2  # capitals nobody asked for in this many days are left cold
+FEATURES = ('onecall', 'air_quality')  # the entries app.refresh() can re-fetch
+
+def budget_now():
+    """Return how many pre-warm calls may have been spent by this time of day."""
+    budget = int(quota.API_DAILY_LIMIT * PREWARM_QUOTA_SHARE)
+    t = time.localtime()
+    elapsed = (t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec) / 86400.0
+    return min(budget, int(budget * elapsed) + PREWARM_BURST)
+
+def capital_keys():
+    demanded = {(feature, spatial.snap_key(key)) for feature, key in usage_log.demanded(PREWARM_CAPITAL_DAYS)
+                if feature == 'onecall'}
+    if not demanded:
+        return
+    for city, state, country in geocode_cache.seed_locations():
+        if state is not None:
+            continue
+        hit = geocode_cache.lookup(geocode_cache.city_key(city, None, None))
+        if not hit:
+            continue
+        key = spatial.cell_key(hit[0], hit[1])
+        if ('onecall', key) in demanded:
+            yield 'onecall', key
+
+def candidates():
+    seen = set()
+    for feature, key, hits in usage_log.top_demand(limit=PREWARM_TOP_N):
+        if feature not in FEATURES:
+            continue
+        # Older demand has raw coordinates (and for One Call a units suffix)
+        key = spatial.snap_key(key)
+        if (feature, key) in seen:
+            continue
+        seen.add((feature, key))
+        yield feature, key
+    for feature, key in capital_keys():
+        if (feature, key) not in seen:
+            seen.add((feature, key))
+            yield feature, key
+
+def run_pass(refresh, ttl_of):
+    """Refresh expiring hot entries (ttl_of(feature) gives the current TTL). Returns the number refreshed."""
+    limit = budget_now()
+    refreshed = 0
+    for feature, key in candidates():
+        ttl = ttl_of(feature)
+        entry = cache_store.get_entry(feature, key)
+        if entry and time.time() - entry[0] < ttl - PREWARM_LEAD:
+            continue
+        result, cached, error = refresh(feature, key, pool=('prewarm', limit))
+        if error:
+            # Out of budget (or upstream trouble): try again next pass
+            break
+        refreshed += 1
+    return refreshed
+
+def run_forever(refresh, ttl_of):
+    while True:
+        time.sleep(PREWARM_INTERVAL)
+        try:
+            run_pass(refresh, ttl_of)
+        except Exception:
+            pass
+
+if __name__ == '__main__':
+    import app
+    import ttl_policy
+    args = sys.argv[1:]
+    if not args:
+        print(f'refreshed {run_pass(app.refresh, ttl_policy.ttl)} entries')
+    elif len(args) == 3 and args[0] == 'refresh':
+        app.refresh(args[1], args[2])
+    else:
+        print('usage: prewarm.py [refresh <feature> <key>]', file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,99 @@
+# Weather Alert Pro - field projection and compact payloads
+# Copyright (c) 2025 Donald Bryant
+# Lets /api/weather and /api/forecast return only what a client uses. The views
+# are projected after they are built from the cached One Call result, so every
+# shape is served from the same upstream fetch.
+#
+# - fields=hourly.dt,hourly.temp,daily.temp keeps only those dotted paths of
+#   the response data; a path through a list applies to every element.
+# - profile=<name> picks a predefined field list from PROFILES.
+# - format=columns turns every list of objects into parallel arrays:
+#   [{'dt': 1, 'temp': 20}, {'dt': 2, 'temp': 21}] -> {'dt': [1, 2], 'temp': [20, 21]}
+#   Nested objects become nested columns (daily.temp.max is data.daily.temp.max[i]).
+import re
+
+PROFILES = {
+    'weather': {
+        # One line per location, e.g. the favorites overview
+        'summary': 'current.dt,current.temp,current.feels_like,current.humidity,current.weather,location',
+    },
+    'forecast': {
+        # What the forecast page draws: day cards and the hourly temperature chart
+        'page': 'daily.dt,daily.temp.min,daily.temp.max,daily.humidity,daily.weather,hourly.dt,hourly.temp,location',
+        'chart': 'hourly.dt,hourly.temp',
+        'daily': 'daily,location,timezone_offset',
+    },
+}
+FORMATS = ('rows', 'columns')
+MAX_FIELDS = 50
+FIELD_RE = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$')
+
+def parse(data, view):
+    """Return (fields, format) requested in data for view.
+
+    fields is a normalised comma-separated list ('' for everything). Raises
+    ValueError with a message for the client on a bad request.
+    """
+    profile = data.get('profile')
+    spec = data.get('fields') or ''
+    if profile:
+        if profile not in PROFILES.get(view, {}):
+            raise ValueError(f"Unknown profile '{profile}'. Available: {', '.join(sorted(PROFILES.get(view, {}))) or 'none'}")
+        spec = PROFILES[view][profile] + (',' + spec if spec else '')
+    fields = sorted(set(f.strip() for f in spec.split(',') if f.strip()))
+    if len(fields) > MAX_FIELDS:
+        raise ValueError(f'At most {MAX_FIELDS} fields')
+    for field in fields:
+        if not FIELD_RE.match(field):
+            raise ValueError(f"Invalid field '{field}'")
+    fmt = data.get('format') or 'rows'
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'. Available: {', '.join(FORMATS)}")
+    return ','.join(fields), fmt
+
+def variant(fields, fmt):
+    """Suffix that tells cached renderings of different shapes apart."""
+    return '' if not fields and fmt == 'rows' else f'|{fields}|{fmt}'
+
+def field_tree(fields):
+    # 'daily' and 'daily.temp' -> {'daily': True}; True means keep the whole value
+    tree = {}
+    for path in sorted((f.split('.') for f in fields.split(',') if f), key=len):
+        node = tree
+        for name in path[:-1]:
+            child = node.setdefault(name, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[path[-1]] = True
+    return tree
+
+def project(value, tree):
+    if tree is True:
+        return value
+    if isinstance(value, list):
+        return [project(v, tree) for v in value]
+    if isinstance(value, dict):
+        return {k: project(value[k], sub) for k, sub in tree.items() if k in value}
+    return value
+
+def columns(value):
+    if isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+        keys = {}
+        for row in value:
+            keys.update(dict.fromkeys(row))
+        return {k: columns([row.get(k) for row in value]) for k in keys}
+    if isinstance(value, dict):
+        return {k: columns(v) for k, v in value.items()}
+    return value
+
+def apply(data, fields, fmt):
+    """Return the view data reduced to fields and laid out in fmt."""
+    if data is None:
+        return None
+    if fields:
+        data = project(data, field_tree(fields))
+    if fmt == 'columns':
+        data = columns(data)
+    return data
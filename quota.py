@@ -0,0 +1,182 @@
+# Weather Alert Pro - upstream quota and rate limiting
+# Copyright (c) 2025 Donald Bryant
+# Counters live in the shared SQLite database (see cache_store.py), so concurrent
+# CGI processes and server threads all see the same totals.
+#
+# - charge() is called right before a real upstream request. In a single
+#   transaction it takes a token from the client's bucket, the upstream
+#   endpoint's bucket and (for billed calls) the daily counter; if any of them
+#   is empty nothing is taken.
+# - The current day is computed once per process per day; the first process to
+#   see a new day runs the registered rollover hooks, on a background thread so
+#   no request waits for them (a CGI process finishes them at exit).
+# - If the counters cannot be read or written, charge() refuses the call:
+#   callers then serve stale data instead of going upstream uncounted.
+# - WEATHER_API_DAILY_LIMIT and WEATHER_RATE_LIMIT_SCALE (multiplies every
+#   bucket's rate and burst) override the limits, e.g. for benchmark.py.
+import os
+import time
+import atexit
+import threading
+
+import cache_store
+import metrics
+
+API_DAILY_LIMIT = int(os.environ.get('WEATHER_API_DAILY_LIMIT', '1000'))
+RATE_LIMIT_SCALE = float(os.environ.get('WEATHER_RATE_LIMIT_SCALE', '1'))
+# (tokens per second, burst) per upstream endpoint; OpenWeatherMap allows 60/min
+ENDPOINT_BUCKETS = {
+    'onecall': (1.0, 60),
+    'air_pollution': (1.0, 60),
+    'geocode': (1.0, 60),
+    'zippopotam': (2.0, 20),
+    'ip-api': (0.75, 45),
+}
+# Per client IP, applied to billed calls only
+CLIENT_BUCKET = (10 / 60.0, 20)
+if RATE_LIMIT_SCALE != 1:
+    ENDPOINT_BUCKETS = {name: (rate * RATE_LIMIT_SCALE, burst * RATE_LIMIT_SCALE)
+                        for name, (rate, burst) in ENDPOINT_BUCKETS.items()}
+    CLIENT_BUCKET = (CLIENT_BUCKET[0] * RATE_LIMIT_SCALE, CLIENT_BUCKET[1] * RATE_LIMIT_SCALE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_daily (
+    day TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quota_buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+ROLLOVER_HOOKS = []
+
+_day = None
+_day_ends = 0
+_day_lock = threading.Lock()
+_rollover_thread = None
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def today():
+    """Return the current local date; the date is only recomputed after midnight."""
+    global _day, _day_ends
+    if time.time() < _day_ends:
+        return _day
+    new_day = None
+    with _day_lock:
+        now = time.time()
+        if now >= _day_ends:
+            t = time.localtime(now)
+            _day = new_day = time.strftime('%Y-%m-%d', t)
+            _day_ends = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        day = _day
+    if new_day:
+        start_rollover(new_day)
+    return day
+
+def start_rollover(day):
+    """Run the rollover for day on a background thread, outside _day_lock."""
+    global _rollover_thread
+    _rollover_thread = threading.Thread(target=rollover, args=(day,), name='quota-rollover', daemon=True)
+    _rollover_thread.start()
+
+@atexit.register
+def finish_rollover():
+    # Under CGI the process would otherwise exit in the middle of the hooks
+    if _rollover_thread is not None:
+        _rollover_thread.join()
+
+def rollover(day):
+    try:
+        conn = connect()
+        first = conn.execute('INSERT OR IGNORE INTO quota_daily (day, count) VALUES (?, 0)', (day,)).rowcount
+        if not first:
+            return
+        # Idle client buckets are full again after a day; drop them
+        conn.execute('DELETE FROM quota_buckets WHERE updated < ?', (time.time() - 86400,))
+    except Exception:
+        return
+    for hook in ROLLOVER_HOOKS:
+        try:
+            hook(day)
+        except Exception:
+            pass
+
+def usage(pool=None):
+    """Return (today, upstream calls charged today), optionally for one named pool."""
+    day = today()
+    try:
+        row = connect().execute('SELECT count FROM quota_daily WHERE day = ?',
+                                (f'{day}|{pool}' if pool else day,)).fetchone()
+    except Exception:
+        row = None
+    return day, row[0] if row else 0
+
+def _take(conn, name, rate, burst, now):
+    row = conn.execute('SELECT tokens, updated FROM quota_buckets WHERE name = ?', (name,)).fetchone()
+    tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+    if tokens < 1:
+        return False
+    conn.execute('INSERT OR REPLACE INTO quota_buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                 (name, tokens - 1, now))
+    return True
+
+def charge(endpoint, client=None, daily=True, pool=None):
+    """Take one upstream call for endpoint. Returns (allowed, error message).
+
+    pool=(name, limit) additionally draws from a named share of today's quota,
+    e.g. the calls reserved for background pre-warming.
+    """
+    day = today()
+    now = time.time()
+    try:
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+    except Exception:
+        return counter_unavailable()
+    try:
+        if daily and client and not _take(conn, f'client:{client}', *CLIENT_BUCKET, now):
+            conn.execute('ROLLBACK')
+            return False, 'Too many requests from this address. Try again in a minute.'
+        bucket = ENDPOINT_BUCKETS.get(endpoint)
+        if bucket and not _take(conn, f'endpoint:{endpoint}', *bucket, now):
+            conn.execute('ROLLBACK')
+            return False, 'Upstream rate limit reached. Try again in a minute.'
+        if daily:
+            conn.execute('INSERT OR IGNORE INTO quota_daily (day, count) VALUES (?, 0)', (day,))
+            cur = conn.execute('UPDATE quota_daily SET count = count + 1 WHERE day = ? AND count < ?',
+                               (day, API_DAILY_LIMIT))
+            if cur.rowcount == 0:
+                conn.execute('ROLLBACK')
+                return False, f"API daily limit of {API_DAILY_LIMIT} reached. Try again tomorrow."
+        if pool:
+            name, limit = pool
+            conn.execute('INSERT OR IGNORE INTO quota_daily (day, count) VALUES (?, 0)', (f'{day}|{name}',))
+            cur = conn.execute('UPDATE quota_daily SET count = count + 1 WHERE day = ? AND count < ?',
+                               (f'{day}|{name}', limit))
+            if cur.rowcount == 0:
+                conn.execute('ROLLBACK')
+                return False, f'Daily {name} budget reached.'
+        conn.execute('COMMIT')
+        return True, None
+    except Exception:
+        try:
+            conn.execute('ROLLBACK')
+        except Exception:
+            pass
+        return counter_unavailable()
+
+def counter_unavailable():
+    # E.g. 'database is locked' after the busy timeout. An uncounted call could
+    # overshoot the daily limit, so refuse it; callers fall back to stale data.
+    metrics.inc('weather_quota_errors_total')
+    return False, 'Usage counter unavailable. Try again shortly.'
@@ -0,0 +1,144 @@
+# Weather Alert Pro - coalescing of identical in-flight upstream requests
+# Copyright (c) 2025 Donald Bryant
+# When many requests miss the cache for the same key at once, only one of them
+# calls upstream; the others wait and receive the same result.
+#
+# - Threads of one process share the leader's return value directly.
+# - Processes coordinate through a lease row in the shared SQLite database.
+#   The process holding the lease fetches; the others poll check() (normally a
+#   cache lookup) until the leader's result shows up or the lease expires, in
+#   which case one of them takes over.
+import os
+import time
+import asyncio
+import threading
+
+import cache_store
+
+LEASE_TTL = 15  # seconds; longer than the slowest upstream call we wait for
+POLL_INTERVAL = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+_calls = {}
+_lock = threading.Lock()
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def _owner():
+    return f'{os.getpid()}:{threading.get_ident()}'
+
+def acquire_lease(key, ttl=LEASE_TTL):
+    now = time.time()
+    try:
+        conn = connect()
+        conn.execute('DELETE FROM leases WHERE key = ? AND expires < ?', (key, now))
+        return conn.execute('INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                            (key, _owner(), now + ttl)).rowcount == 1
+    except Exception:
+        # Without the shared store, fall back to fetching ourselves
+        return True
+
+def release_lease(key):
+    try:
+        connect().execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, _owner()))
+    except Exception:
+        pass
+
+def lease_held(key):
+    try:
+        return connect().execute('SELECT 1 FROM leases WHERE key = ? AND expires >= ?',
+                                 (key, time.time())).fetchone() is not None
+    except Exception:
+        return False
+
+def _across_processes(key, fetch, check):
+    while True:
+        if acquire_lease(key):
+            try:
+                return fetch()
+            finally:
+                release_lease(key)
+        # Another process is fetching; wait for its result to land
+        while lease_held(key):
+            time.sleep(POLL_INTERVAL)
+            result = check()
+            if result is not None:
+                return result
+        result = check()
+        if result is not None:
+            return result
+
+def do(key, fetch, check):
+    """Return fetch(), running it at most once at a time per key.
+
+    check() returns a result another process has already produced (e.g. from
+    the cache) or None; it is polled while waiting on another process.
+    """
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+    if not leader:
+        if not call.done.wait(LEASE_TTL):
+            return fetch()
+        if call.error is not None:
+            raise call.error
+        return call.result
+    try:
+        call.result = _across_processes(key, fetch, check)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+
+# --- asyncio ---
+_tasks = {}
+
+async def _across_processes_async(key, fetch, check):
+    while True:
+        if await asyncio.to_thread(acquire_lease, key):
+            try:
+                return await fetch()
+            finally:
+                await asyncio.to_thread(release_lease, key)
+        while await asyncio.to_thread(lease_held, key):
+            await asyncio.sleep(POLL_INTERVAL)
+            result = await check()
+            if result is not None:
+                return result
+        result = await check()
+        if result is not None:
+            return result
+
+async def do_async(key, fetch, check):
+    """Coroutine version of do(); fetch and check are coroutine functions."""
+    task = _tasks.get(key)
+    if task is None:
+        task = _tasks[key] = asyncio.ensure_future(_across_processes_async(key, fetch, check))
+        task.add_done_callback(lambda t: _tasks.pop(key) if _tasks.get(key) is t else None)
+    # shield: a cancelled follower must not cancel the leader's fetch
+    return await asyncio.shield(task)
@@ -0,0 +1,118 @@
+# Weather Alert Pro - grid cache keys and nearby-entry lookup
+# Copyright (c) 2025 Donald Bryant
+# Forecasts do not change over a couple of kilometres, so locations are cached
+# per grid cell instead of per geocoded coordinate pair.
+#
+# - cell_key() snaps a coordinate pair to the centre of its GRID_DEGREES cell;
+#   the key keeps the 'lat,lon' form, so refreshes and pre-warming fetch the
+#   cell centre. Neighbouring ZIP codes and alternative spellings of a place
+#   share one entry.
+# - Every cached location is also recorded in the cache_locations table. On a
+#   miss, nearest() looks for a fresh entry within NEIGHBOR_RADIUS_KM (adjacent
+#   cells) with a bounding-box query, so a dense metro area costs one upstream
+#   call per neighbourhood rather than one per cell.
+# - WEATHER_GRID_DEGREES and WEATHER_NEIGHBOR_RADIUS_KM override the defaults;
+#   0 turns snapping or the neighbour search off.
+import os
+import math
+import time
+import threading
+
+import cache_store
+
+GRID_DEGREES = float(os.environ.get('WEATHER_GRID_DEGREES', '0.02'))  # ~2.2 km of latitude
+NEIGHBOR_RADIUS_KM = float(os.environ.get('WEATHER_NEIGHBOR_RADIUS_KM', '5'))
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_locations (
+    feature TEXT NOT NULL,
+    key TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    PRIMARY KEY (feature, key)
+);
+CREATE INDEX IF NOT EXISTS cache_locations_lat ON cache_locations (feature, lat);
+"""
+
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def snap(value):
+    return round(value / GRID_DEGREES) * GRID_DEGREES
+
+def cell_key(lat, lon):
+    """Return the cache key for lat/lon: 'lat,lon' of its grid cell centre."""
+    if GRID_DEGREES <= 0:
+        return f'{lat},{lon}'
+    return f'{snap(float(lat)):.4f},{snap(float(lon)):.4f}'
+
+def parse_key(key):
+    """Return (lat, lon) from a 'lat,lon' key (extra fields are ignored), or None."""
+    try:
+        lat, lon = key.split(',')[:2]
+        return float(lat), float(lon)
+    except ValueError:
+        return None
+
+def snap_key(key):
+    """Move a raw 'lat,lon' key (e.g. from before keys were snapped) to its cell."""
+    coords = parse_key(key)
+    return cell_key(*coords) if coords else key
+
+def distance_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def index(feature, key):
+    """Record where the entry feature/key is, for nearest()."""
+    coords = parse_key(key)
+    if not coords:
+        return
+    try:
+        connect().execute('INSERT OR IGNORE INTO cache_locations (feature, key, lat, lon) VALUES (?, ?, ?, ?)',
+                          (feature, key) + coords)
+    except Exception:
+        pass
+
+def nearest(feature, key, max_age):
+    """Return (key, ts) of the closest entry within NEIGHBOR_RADIUS_KM of key that
+    is younger than max_age seconds, or None. key itself is not considered."""
+    coords = parse_key(key)
+    if NEIGHBOR_RADIUS_KM <= 0 or not coords:
+        return None
+    lat, lon = coords
+    dlat = NEIGHBOR_RADIUS_KM / KM_PER_DEGREE
+    dlon = min(180.0, dlat / max(0.01, math.cos(math.radians(lat))))
+    try:
+        rows = connect().execute(
+            'SELECT l.key, l.lat, l.lon, c.ts FROM cache_locations l '
+            'JOIN cache c ON c.feature = l.feature AND c.key = l.key '
+            'WHERE l.feature = ? AND l.lat BETWEEN ? AND ? AND l.lon BETWEEN ? AND ? '
+            'AND c.ts > ? AND l.key != ?',
+            (feature, lat - dlat, lat + dlat, lon - dlon, lon + dlon, time.time() - max_age, key)).fetchall()
+    except Exception:
+        return None
+    best = None
+    for other, olat, olon, ts in rows:
+        d = distance_km(lat, lon, olat, olon)
+        if d <= NEIGHBOR_RADIUS_KM and (best is None or d < best[0]):
+            best = (d, other, ts)
+    return (best[1], best[2]) if best else None
+
+def prune():
+    """Forget locations whose cache entry has been evicted."""
+    try:
+        connect().execute('DELETE FROM cache_locations WHERE NOT EXISTS '
+                          '(SELECT 1 FROM cache c WHERE c.feature = cache_locations.feature AND c.key = cache_locations.key)')
+    except Exception:
+        pass
@@ -0,0 +1,64 @@
+# Weather Alert Pro - test fixtures
+# Copyright (c) 2025 Donald Bryant
+# - The upstream services are fake_upstream.py's local stand-ins, started once
+#   per session before any app module reads the WEATHER_*_URL settings.
+# - Every test gets its own api_cache.db (and history and postal index): the shared
+#   database path is moved to tmp_path and each module's per-thread connection
+#   and schema flags are reset.
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import fake_upstream
+
+FAKE_CONFIG = {'latency': 0.0, 'jitter': 0.0}
+
+def pytest_configure(config):
+    servers, env = fake_upstream.start(FAKE_CONFIG)
+    os.environ.update(env)
+    config.fake_upstream = servers
+
+def pytest_unconfigure(config):
+    fake_upstream.stop(getattr(config, 'fake_upstream', []))
+
+@pytest.fixture
+def fake_servers(request):
+    """The session's fake (openweathermap, zippopotam, ip-api) servers."""
+    return request.config.fake_upstream
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """Point every module at a fresh database for the duration of the test."""
+    import cache_store
+    import history_store
+    import postal_index
+    import quota
+    import ttl_policy
+    path = str(tmp_path / 'api_cache.db')
+    monkeypatch.setattr(cache_store, 'CACHE_DB', path)
+    monkeypatch.setattr(history_store, 'HISTORY_DIR', str(tmp_path / 'history'))
+    monkeypatch.setattr(postal_index, 'INDEX_PATH', str(tmp_path / 'postal_index.bin'))
+    monkeypatch.setattr(postal_index, '_index', None)
+    monkeypatch.setattr(cache_store, '_local', threading.local())
+    cache_store._memory.clear()
+    cache_store._rendered.clear()
+    monkeypatch.setattr(cache_store, '_accessed', {})
+    monkeypatch.setattr(cache_store, '_access_flushed', time.time())
+    for module in list(sys.modules.values()):
+        if isinstance(getattr(module, '_schema_ready', None), threading.local) and \
+                os.path.dirname(os.path.abspath(getattr(module, '__file__', '') or '')) == BASE_DIR:
+            monkeypatch.setattr(module, '_schema_ready', threading.local())
+    monkeypatch.setattr(quota, '_day_ends', 0)
+    monkeypatch.setattr(ttl_policy, '_pace', (0, 1.0, False))
+    yield path
+    if quota._rollover_thread is not None:
+        quota._rollover_thread.join()
+    # Write what the test queued now, not at exit into the real database
+    if 'usage_log' in sys.modules:
+        sys.modules['usage_log'].flush()
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+import pytest
+
+import fake_upstream
+import alert_watch
+
+ONECALL = 'openweathermap:/data/3.0/onecall'
+DENVER = '39.7400,-104.9800'
+BOULDER = '40.0200,-105.2800'
+END = int(time.time()) + 3600
+
+@pytest.fixture(autouse=True)
+def buffer(monkeypatch):
+    """Start every test with no event reader or buffer in this process."""
+    monkeypatch.setattr(alert_watch, '_buffer', deque())
+    monkeypatch.setattr(alert_watch, '_buffer_from', None)
+    monkeypatch.setattr(alert_watch, '_reader_pid', None)
+
+def alert(event='Winter Storm Warning', start=1000, end=END, description='Heavy snow.'):
+    return {'sender_name': 'NWS Boulder', 'event': event, 'start': start,
+            'end': end, 'description': description}
+
+def events(keys=(DENVER, BOULDER), cursor=0):
+    rows, cursor = alert_watch.events_after(list(keys), cursor)
+    return [(key, kind, json.loads(text)['event']) for _, key, kind, text in rows], cursor
+
+def test_diff_writes_only_changes():
+    storm, wind = alert(), alert('High Wind Watch')
+    assert alert_watch.diff(DENVER, [storm, wind]) == 2
+    assert alert_watch.diff(DENVER, [storm, wind]) == 0
+    # Same alert with new text: changed, not new
+    assert alert_watch.diff(DENVER, [dict(storm, description='Heavier snow.'), wind]) == 1
+    assert alert_watch.diff(DENVER, [wind]) == 1
+    assert events()[0] == [(DENVER, 'new', 'Winter Storm Warning'), (DENVER, 'new', 'High Wind Watch'),
+                           (DENVER, 'changed', 'Winter Storm Warning'), (DENVER, 'expired', 'Winter Storm Warning')]
+
+def test_diff_skips_alerts_past_their_end():
+    assert alert_watch.diff(DENVER, [alert(end=time.time() - 1)]) == 0
+    assert alert_watch.diff(DENVER, [alert()]) == 1
+    # An alert that ran out is reported expired on the next poll
+    assert alert_watch.diff(DENVER, [alert()], now=time.time() + 7200) == 1
+    assert events()[0][-1] == (DENVER, 'expired', 'Winter Storm Warning')
+
+def test_watches_expire_unless_touched():
+    token = alert_watch.register([(DENVER, 'Denver, CO')] + [(f'{i}.0000,0.0000', str(i)) for i in range(20)])
+    assert len(alert_watch.watched(token)) == alert_watch.WATCH_MAX_LOCATIONS
+    assert alert_watch.watched(token)[DENVER] == 'Denver, CO'
+    assert alert_watch.register([(BOULDER, 'Boulder, CO')], token) == token
+    assert alert_watch.watched(token) == {BOULDER: 'Boulder, CO'}
+    alert_watch.connect().execute('UPDATE alert_watches SET last_seen = last_seen - ?', (alert_watch.WATCH_TTL,))
+    assert alert_watch.watched(token) == {}
+    alert_watch.touch([token])
+    assert alert_watch.watched(token) == {BOULDER: 'Boulder, CO'}
+    assert alert_watch.watched('no-such-token') == {}
+
+def test_cursor_moves_past_other_locations_events():
+    alert_watch.diff(DENVER, [alert()])
+    alert_watch.diff(BOULDER, [alert('Red Flag Warning')])
+    found, cursor = events([DENVER])
+    assert found == [(DENVER, 'new', 'Winter Storm Warning')]
+    found, cursor = events([DENVER], cursor)
+    assert found == [] and cursor == alert_watch.latest_id()
+
+def test_event_written_during_a_read_is_not_skipped(monkeypatch):
+    alert_watch.diff(BOULDER, [alert('Red Flag Warning')])
+    latest_id = alert_watch.latest_id
+    def latest_then_write():
+        latest = latest_id()
+        # Lands after the cursor bound was taken, before the select
+        alert_watch.diff(DENVER, [alert()])
+        return latest
+    monkeypatch.setattr(alert_watch, 'latest_id', latest_then_write)
+    found, cursor = events([DENVER])
+    assert found == []
+    monkeypatch.setattr(alert_watch, 'latest_id', latest_id)
+    assert events([DENVER], cursor)[0] == [(DENVER, 'new', 'Winter Storm Warning')]
+
+def test_buffer_answers_like_the_database(monkeypatch):
+    alert_watch.diff(DENVER, [alert()])
+    start = alert_watch.latest_id()
+    monkeypatch.setattr(alert_watch, '_reader_pid', os.getpid())
+    monkeypatch.setattr(alert_watch, '_buffer_from', start)
+    alert_watch.diff(BOULDER, [alert('Red Flag Warning')])
+    alert_watch.diff(DENVER, [alert(), alert('High Wind Watch')])
+    alert_watch.read_events()
+    assert alert_watch.covered(start) and not alert_watch.covered(start - 1)
+    from_buffer = events([DENVER], start)
+    assert from_buffer == ([(DENVER, 'new', 'High Wind Watch')], alert_watch.latest_id())
+    # A cursor before the buffer starts goes to the database
+    assert events([DENVER], 0)[0] == [(DENVER, 'new', 'Winter Storm Warning')] + from_buffer[0]
+    monkeypatch.setattr(alert_watch, '_reader_pid', None)
+    assert events([DENVER], start) == from_buffer
+
+def test_stream_opens_with_a_snapshot_or_the_missed_events():
+    alert_watch.diff(DENVER, [alert()])
+    first = alert_watch.latest_id()
+    token = alert_watch.register([(DENVER, 'Denver, CO')])
+    locations, cursor, chunk = alert_watch.opening(token)
+    assert locations == {DENVER: 'Denver, CO'} and cursor == first
+    assert chunk.startswith(f'id: {first}\nevent: snapshot\n') and 'Winter Storm Warning' in chunk
+    alert_watch.diff(DENVER, [alert(), alert('High Wind Watch')])
+    # Reconnect with Last-Event-ID: only what was missed
+    locations, cursor, chunk = alert_watch.opening(token, str(first))
+    assert chunk.startswith(f'id: {first + 1}\nevent: alert\n')
+    assert 'High Wind Watch' in chunk and 'Winter Storm Warning' not in chunk
+    assert cursor == first + 1
+
+def test_bad_token_gets_watch_expired():
+    assert list(alert_watch.stream('no-such-token', keep_open=False)) == [
+        'event: watch-expired\ndata: {"error":"Unknown or expired watch token"}\n\n']
+
+def test_cgi_stream_closes_with_a_retry_hint():
+    token = alert_watch.register([(DENVER, 'Denver, CO')])
+    chunks = list(alert_watch.stream(token, keep_open=False))
+    assert chunks[0].startswith('id: 0\nevent: snapshot\n')
+    assert chunks[1:] == [f'retry: {alert_watch.RETRY_MS}\n\n']
+
+def test_held_stream_sends_changes(monkeypatch):
+    monkeypatch.setattr(alert_watch, 'STREAM_TICK', 0.01)
+    # The reader must not outlive this test's database
+    stop = threading.Event()
+    def run_reader():
+        while not stop.wait(alert_watch.STREAM_TICK):
+            alert_watch.read_events()
+    monkeypatch.setattr(alert_watch, 'run_reader', run_reader)
+    token = alert_watch.register([(DENVER, 'Denver, CO')])
+    stream = alert_watch.stream(token)
+    try:
+        assert 'event: snapshot' in next(stream)
+        alert_watch.diff(BOULDER, [alert('Red Flag Warning')])
+        alert_watch.diff(DENVER, [alert()])
+        chunk = next(stream)
+        assert chunk.count('event: alert') == 1 and '"kind":"new"' in chunk and 'Winter Storm Warning' in chunk
+        assert alert_watch._open[token] == 1
+        stream.close()
+        assert token not in alert_watch._open
+    finally:
+        stop.set()
+        for t in threading.enumerate():
+            if t.name == 'alert-reader':
+                t.join()
+
+def test_one_upstream_poll_per_watched_cell(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    for _ in range(3):
+        alert_watch.register([(DENVER, 'Denver, CO'), (BOULDER, 'Boulder, CO')])
+    before = fake_upstream.STATS[ONECALL]
+    assert alert_watch.run_pass(app.refresh) == 2 * fake_upstream.DEFAULTS['alerts']
+    assert fake_upstream.STATS[ONECALL] == before + 2
+    # Not due again until the alerts TTL has passed
+    assert alert_watch.run_pass(app.refresh) == 0
+    assert fake_upstream.STATS[ONECALL] == before + 2
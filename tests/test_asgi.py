@@ -0,0 +1,31 @@
+import asyncio
+
+import httpx
+import pytest
+
+ENDPOINTS = ['/api/weather', '/api/forecast', '/api/alerts', '/api/air_quality', '/api/uv', '/api/bundle',
+             '/api/weather/batch', '/api/forecast/batch']
+
+@pytest.fixture
+def apps(monkeypatch):
+    import app
+    import asgi
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    return app.app.test_client(), asgi.application
+
+def asgi_post(application, path, body):
+    async def post():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return await client.post(path, content=body, headers={'Content-Type': 'application/json'})
+    return asyncio.run(post())
+
+@pytest.mark.parametrize('body', [b'[1,2]', b'"80202"', b'42', b'null', b'not json', b''])
+def test_non_object_bodies_match(apps, body):
+    flask_client, application = apps
+    for path in ENDPOINTS:
+        flask = flask_client.post(path, data=body, content_type='application/json')
+        native = asgi_post(application, path, body)
+        assert flask.status_code == native.status_code == 200, path
+        assert flask.get_json() == native.json() == flask_client.post(path, json={}).get_json(), path
+        assert flask.get_json()['success'] is False
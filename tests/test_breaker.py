@@ -0,0 +1,142 @@
+import time
+import asyncio
+
+import httpx
+import pytest
+
+import fake_upstream
+import cache_store
+import breaker
+import quota
+import upstream
+
+ONECALL = 'openweathermap:/data/3.0/onecall'
+
+@pytest.fixture(scope='module')
+def flaky_servers():
+    servers, env = fake_upstream.start({'latency': 0.0, 'jitter': 0.0})
+    yield servers
+    fake_upstream.stop(servers)
+
+@pytest.fixture
+def flaky(flaky_servers):
+    """A fake OpenWeatherMap of its own (so a circuit of its own) that fails every request."""
+    config = flaky_servers[0].config
+    config.update(latency=0.0, error_rate=1.0)
+    base = 'http://%s:%d' % flaky_servers[0].server_address
+    return config, upstream.host_of(base), f'{base}/data/3.0/onecall?lat=1&lon=2'
+
+def call(url):
+    try:
+        return upstream.get(url, retries=0).status_code
+    except upstream.CircuitOpenError:
+        return 'open'
+
+def half_open(host):
+    breaker.connect().execute('UPDATE breaker_state SET retry_at = ? WHERE host = ?', (time.time(), host))
+
+def test_failures_open_the_circuit(flaky):
+    config, host, url = flaky
+    assert [call(url) for _ in range(breaker.MIN_CALLS)] == [500] * breaker.MIN_CALLS
+    state, = breaker.status()
+    assert (state['host'], state['state'], state['trips']) == (host, 'open', 1)
+    # Refused without a request
+    sent = fake_upstream.STATS[ONECALL]
+    assert call(url) == 'open'
+    assert fake_upstream.STATS[ONECALL] == sent
+
+def test_few_calls_or_client_errors_do_not_trip(flaky):
+    config, host, url = flaky
+    assert [call(url) for _ in range(breaker.MIN_CALLS - 1)] == [500] * (breaker.MIN_CALLS - 1)
+    assert breaker.status() == []
+    config['error_rate'] = 0.0
+    # 400: a bad request, not a failing host
+    assert [call(url.split('?')[0]) for _ in range(10)] == [400] * 10
+    assert breaker.status() == []
+    assert breaker.recent_calls()[host] == (breaker.MIN_CALLS + 9, breaker.MIN_CALLS - 1)
+
+def test_slow_calls_count_as_failures(flaky, monkeypatch):
+    config, host, url = flaky
+    monkeypatch.setattr(breaker, 'SLOW_CALL', 0.05)
+    config.update(error_rate=0.0, latency=100.0)
+    assert [call(url) for _ in range(breaker.MIN_CALLS)] == [200] * breaker.MIN_CALLS
+    assert breaker.status()[0]['state'] == 'open'
+
+def test_half_open_admits_one_trial(flaky):
+    config, host, url = flaky
+    for _ in range(breaker.MIN_CALLS):
+        call(url)
+    assert breaker.admit(host) == (False, False)
+    half_open(host)
+    assert breaker.admit(host) == (True, True)
+    assert breaker.admit(host) == (False, False)
+    assert breaker.refusing(host)
+    assert breaker.status()[0]['trial']
+
+def test_failed_trial_doubles_the_wait(flaky):
+    config, host, url = flaky
+    for _ in range(breaker.MIN_CALLS):
+        call(url)
+    for trips, wait in [(2, 2 * breaker.OPEN_SECONDS), (3, 4 * breaker.OPEN_SECONDS)]:
+        half_open(host)
+        sent = fake_upstream.STATS[ONECALL]
+        # The trial is a single attempt, whatever the retries
+        assert upstream.get(url).status_code == 500
+        assert fake_upstream.STATS[ONECALL] == sent + 1
+        state, = breaker.status()
+        assert state['trips'] == trips and wait - 2 <= state['retry_in'] <= wait
+
+def test_successful_trial_closes_the_circuit(flaky):
+    config, host, url = flaky
+    for _ in range(breaker.MIN_CALLS):
+        call(url)
+    half_open(host)
+    config['error_rate'] = 0.0
+    assert call(url) == 200
+    assert breaker.status() == [] and host not in breaker.recent_calls()
+    assert [call(url) for _ in range(3)] == [200] * 3
+
+def test_probe_closes_a_recovered_circuit(flaky, monkeypatch):
+    config, host, url = flaky
+    monkeypatch.setattr(upstream, 'PROBE_URLS', {host: url})
+    for _ in range(breaker.MIN_CALLS):
+        call(url)
+    # Not yet half-open: no probe
+    sent = fake_upstream.STATS[ONECALL]
+    breaker.run_pass(upstream.probe)
+    assert fake_upstream.STATS[ONECALL] == sent
+    half_open(host)
+    breaker.run_pass(upstream.probe)
+    assert breaker.status()[0]['trips'] == 2
+    half_open(host)
+    config['error_rate'] = 0.0
+    breaker.run_pass(upstream.probe)
+    assert breaker.status() == []
+
+def test_open_circuit_serves_stale_data_uncharged(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    key = app.location_key(39.7392, -104.9750)
+    cache_store.set_entry('onecall', key, {'current': {'temp': 1}}, ts=time.time() - 4 * 3600)
+    host = upstream.host_of(app.ONECALL_URL)
+    breaker.trip(breaker.connect(), host, time.time(), 'test')
+    sent = fake_upstream.STATS[ONECALL]
+    assert app.fetch_onecall(39.7392, -104.9750) == ({'current': {'temp': 1}}, True, None)
+    result, cached, error = app.fetch_onecall(40.0150, -105.2705)
+    assert result is None and error == f'Weather service unavailable: {host} is not responding'
+    assert fake_upstream.STATS[ONECALL] == sent
+    assert quota.usage()[1] == 0
+
+def test_async_get_fails_fast_while_open(flaky):
+    config, host, url = flaky
+    for _ in range(breaker.MIN_CALLS):
+        call(url)
+    sent = fake_upstream.STATS[ONECALL]
+    async def get():
+        try:
+            return await upstream.aget(url)
+        finally:
+            await upstream.aclose()
+    with pytest.raises(httpx.ConnectError, match='circuit open'):
+        asyncio.run(get())
+    assert fake_upstream.STATS[ONECALL] == sent
@@ -0,0 +1,56 @@
+import time
+
+import cache_store
+
+def last_access(key):
+    return cache_store.connect().execute("SELECT last_access FROM cache WHERE feature = 'onecall' AND key = ?",
+                                         (key,)).fetchone()[0]
+
+def keys():
+    return sorted(k for k, in cache_store.connect().execute('SELECT key FROM cache'))
+
+def test_reads_are_written_in_batches(monkeypatch):
+    before = time.time() - 100
+    cache_store.set_entry('onecall', 'a', {'n': 1}, ts=before)
+    cache_store.set_entry('onecall', 'b', {'n': 2}, ts=before)
+    cache_store._memory.clear()
+    assert cache_store.get_entry('onecall', 'a')[1] == {'n': 1}  # from SQLite
+    assert cache_store.get_entry('onecall', 'b', max_age=3600)[1] == {'n': 2}  # from memory
+    assert cache_store.get_entry('onecall', 'b', max_age=3600)[1] == {'n': 2}
+    assert last_access('a') == last_access('b') == before
+    monkeypatch.setattr(cache_store, 'ACCESS_FLUSH_INTERVAL', 0)
+    cache_store.get_entry('onecall', 'a', max_age=3600)
+    assert last_access('a') > before + 90 and last_access('b') > before + 90
+    assert cache_store._accessed == {}
+
+def test_stored_body_hits_count_as_reads():
+    ts = time.time() - 100
+    cache_store.set_entry('onecall', 'a', {'n': 1}, ts=ts)
+    cache_store.set_rendered('onecall', 'a', 'v', ts, 'etag', b'{}')
+    cache_store.get_rendered('onecall', 'a', 'v', max_age=3600)
+    assert ('onecall', 'a') in cache_store._accessed
+    cache_store.flush_access()
+    assert last_access('a') > time.time() - 5
+
+def test_eviction_keeps_entries_served_from_memory(monkeypatch):
+    monkeypatch.setattr(cache_store, 'CACHE_MAX_ENTRIES', 10)
+    monkeypatch.setattr(cache_store, 'EVICT_CHECK_EVERY', 1)
+    now = time.time()
+    for i in range(10):
+        cache_store.set_entry('onecall', f'k{i}', {'n': i}, ts=now - 1000 + i)
+    # The oldest entry is the hottest, but only ever read from memory
+    for _ in range(3):
+        assert cache_store.get_entry('onecall', 'k0', max_age=3600)
+    cache_store.set_entry('onecall', 'k10', {'n': 10})
+    assert keys() == ['k0', 'k10', 'k3', 'k4', 'k5', 'k6', 'k7', 'k8', 'k9']
+
+def test_row_count_is_checked_every_few_writes(monkeypatch):
+    monkeypatch.setattr(cache_store, 'CACHE_MAX_ENTRIES', 3)
+    monkeypatch.setattr(cache_store, 'EVICT_CHECK_EVERY', 5)
+    monkeypatch.setattr(cache_store, '_writes', 0)
+    now = time.time()
+    for i in range(4):
+        cache_store.set_entry('onecall', f'k{i}', {'n': i}, ts=now + i)
+    assert len(keys()) == 4
+    cache_store.set_entry('onecall', 'k4', {'n': 4}, ts=now + 4)
+    assert keys() == ['k3', 'k4']
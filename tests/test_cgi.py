@@ -0,0 +1,59 @@
+import os
+import sys
+import gzip
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import BASE_DIR
+
+pytest.importorskip('flup')
+
+@pytest.fixture
+def cgi_dir(tmp_path):
+    """A copy of the app (weather.cgi writes its database and logs next to itself)."""
+    for name in os.listdir(BASE_DIR):
+        source = os.path.join(BASE_DIR, name)
+        if name in ('templates', 'static'):
+            shutil.copytree(source, tmp_path / name, ignore=shutil.ignore_patterns('dist'))
+        elif name.endswith(('.py', '.cgi')) and os.path.isfile(source):
+            shutil.copy(source, tmp_path)
+    (tmp_path / 'apikey.txt').write_text('test-key')
+    return tmp_path
+
+def run_cgi(directory, path, query='', **headers):
+    """Run weather.cgi once; return (status, {header: value}, body bytes)."""
+    env = dict(os.environ, GATEWAY_INTERFACE='CGI/1.1', REQUEST_METHOD='GET', SCRIPT_NAME='/weather.cgi',
+               PATH_INFO=path, QUERY_STRING=query, SERVER_NAME='localhost', SERVER_PORT='80',
+               SERVER_PROTOCOL='HTTP/1.1', REMOTE_ADDR='127.0.0.1',
+               **{'HTTP_' + name.upper(): value for name, value in headers.items()})
+    out = subprocess.run([sys.executable, str(directory / 'weather.cgi')], env=env, cwd=directory,
+                         capture_output=True, timeout=60).stdout
+    head, _, body = out.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    fields = dict(line.split(': ', 1) for line in lines[1:])
+    assert not (directory / 'cgi_error.log').exists(), (directory / 'cgi_error.log').read_text()
+    return int(lines[0].split()[1]), fields, body
+
+def test_gzipped_json_through_cgi(cgi_dir):
+    status, fields, body = run_cgi(cgi_dir, '/api/forecast', 'zip_code=80202', accept_encoding='gzip')
+    assert status == 200 and fields['Content-Encoding'] == 'gzip'
+    assert len(body) == int(fields['Content-Length'])
+    assert b'"success":true' in gzip.decompress(body)
+    status, fields, plain = run_cgi(cgi_dir, '/api/forecast', 'zip_code=80202')
+    assert status == 200 and 'Content-Encoding' not in fields
+    assert b'"success":true' in plain
+
+def test_built_page_and_assets_through_cgi(cgi_dir):
+    subprocess.run([sys.executable, str(cgi_dir / 'build_static.py')], cwd=cgi_dir, check=True, capture_output=True)
+    dist = cgi_dir / 'static' / 'dist'
+    status, fields, body = run_cgi(cgi_dir, '/', accept_encoding='gzip')
+    assert status == 200 and fields['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == (dist / 'index.html').read_bytes()
+    manifest = json.loads((dist / 'manifest.json').read_text())
+    for name, encoding in [('us_states_cities.json', 'gzip'), ('noaa-thunder.jpg', None)]:
+        status, fields, body = run_cgi(cgi_dir, f'/static/dist/{manifest[name]}', accept_encoding='gzip')
+        assert status == 200 and fields.get('Content-Encoding') == encoding
+        assert (gzip.decompress(body) if encoding else body) == (cgi_dir / 'static' / name).read_bytes()
@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+
+import conversion
+
+DENVER = (39.7392, -104.9750)
+UNITS = ['metric', 'imperial', 'standard']
+DAILY_TEMPS = ['day', 'min', 'max', 'night', 'eve', 'morn']
+
+@pytest.fixture
+def client(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    monkeypatch.setattr(app, 'get_location', lambda city, state, zip_code, country=None: DENVER + ('Denver', 'CO'))
+    return app.app.test_client()
+
+def get(client, path, units):
+    resp = client.get(f'{path}?zip_code=80202&units={units}')
+    return resp.get_json()['data']
+
+def same(metric, converted, quantity, units):
+    """converted is metric in units, and converts back to it."""
+    scale, offset = conversion.SCALES[quantity][units]
+    assert converted == round(metric * scale + offset, conversion.PRECISION)
+    assert (converted - offset) / scale == pytest.approx(metric, abs=0.01)
+
+def test_tables_round_trip():
+    assert set(conversion.SCALES['temperature']) == set(conversion.SCALES['speed']) == set(UNITS)
+    for quantity, values in [('temperature', [-40.0, 0.0, 21.37]), ('speed', [0.0, 4.12, 33.3])]:
+        for units in UNITS:
+            for value in values:
+                row, = conversion.convert_rows([{'v': value}], {('v',): quantity}, units)
+                same(value, row['v'], quantity, units)
+    assert conversion.convert({'current': {'temp': 0.0}}, 'imperial')['current']['temp'] == 32.0
+    assert conversion.convert({'current': {'temp': 0.0}}, 'standard')['current']['temp'] == 273.15
+    assert conversion.convert({'current': {'temp': 100.0}}, 'kelvin')['current']['temp'] == 373.15
+
+def test_canonical_data_is_not_modified():
+    data = {'current': {'temp': 20.0, 'wind_speed': 5.0, 'pressure': 1013, 'humidity': 40, 'uvi': 3.1},
+            'hourly': [{'temp': 18.0, 'dew_point': 5.0, 'pop': 0.2}],
+            'daily': [{'temp': {'day': 20.0, 'min': 10.0}, 'feels_like': {'day': 19.0}, 'wind_gust': None}],
+            'location': {'lat': 39.74}}
+    before = copy.deepcopy(data)
+    assert conversion.convert(data, 'metric') is data
+    out = conversion.convert(data, 'imperial')
+    assert data == before
+    assert out['current'] == {'temp': 68.0, 'wind_speed': 11.18, 'pressure': 1013, 'humidity': 40, 'uvi': 3.1}
+    assert out['hourly'] == [{'temp': 64.4, 'dew_point': 41.0, 'pop': 0.2}]
+    assert out['daily'] == [{'temp': {'day': 68.0, 'min': 50.0}, 'feels_like': {'day': 66.2}, 'wind_gust': None}]
+    assert out['location'] is data['location']
+
+@pytest.mark.parametrize('units', UNITS)
+def test_weather_payload(client, units):
+    metric = get(client, '/api/weather', 'metric')['current']
+    current = get(client, '/api/weather', units)['current']
+    for name in ['temp', 'feels_like', 'dew_point']:
+        same(metric[name], current[name], 'temperature', units)
+    same(metric['wind_speed'], current['wind_speed'], 'speed', units)
+    for name in ['pressure', 'humidity', 'clouds', 'uvi', 'visibility', 'pressure_inhg', 'wind_direction_compass']:
+        assert current[name] == metric[name]
+    # Derived from the canonical m/s once, whatever the units (it was converted twice for imperial)
+    assert current['wind_speed_mph'] == metric['wind_speed_mph'] == round(metric['wind_speed'] * 2.23694, 2)
+    if units == 'imperial':
+        assert current['wind_speed'] == current['wind_speed_mph']
+
+@pytest.mark.parametrize('units', UNITS)
+def test_forecast_payload(client, units):
+    metric = get(client, '/api/forecast', 'metric')
+    forecast = get(client, '/api/forecast', units)
+    assert len(forecast['hourly']) == len(metric['hourly']) and len(forecast['daily']) == len(metric['daily'])
+    for m, row in zip(metric['hourly'], forecast['hourly']):
+        same(m['temp'], row['temp'], 'temperature', units)
+        same(m['wind_speed'], row['wind_speed'], 'speed', units)
+        assert row['pop'] == m['pop'] and row['pressure'] == m['pressure']
+    for m, row in zip(metric['daily'], forecast['daily']):
+        for name in DAILY_TEMPS:
+            same(m['temp'][name], row['temp'][name], 'temperature', units)
+        for name in ['day', 'night', 'eve', 'morn']:
+            same(m['feels_like'][name], row['feels_like'][name], 'temperature', units)
+        same(m['wind_speed'], row['wind_speed'], 'speed', units)
+        assert row['moon_phase'] == m['moon_phase']
+
+@pytest.mark.parametrize('units', UNITS)
+def test_bundle_payload(client, units):
+    def bundle(units):
+        return client.post('/api/bundle', json={'zip_code': '80202', 'units': units}).get_json()['data']
+    metric, data = bundle('metric'), bundle(units)
+    same(metric['weather']['current']['temp'], data['weather']['current']['temp'], 'temperature', units)
+    same(metric['weather']['current']['wind_speed'], data['weather']['current']['wind_speed'], 'speed', units)
+    assert data['weather']['current']['wind_speed_mph'] == metric['weather']['current']['wind_speed_mph']
+    same(metric['forecast']['hourly'][0]['temp'], data['forecast']['hourly'][0]['temp'], 'temperature', units)
+    same(metric['forecast']['daily'][-1]['temp']['max'], data['forecast']['daily'][-1]['temp']['max'],
+         'temperature', units)
+    # Views with no converted quantities are the same in every unit system
+    for name in ['uv', 'alerts', 'air_quality']:
+        assert data[name] == metric[name]
+    # The same entry as /api/weather
+    assert data['weather']['current'] == get(client, '/api/weather', units)['current']
@@ -0,0 +1,130 @@
+import os
+import math
+import time
+import fcntl
+import types
+import threading
+
+import pytest
+
+import fake_upstream
+import history_store
+
+KEY = '39.7400,-104.9800'
+HOUR = 3600
+T0 = 1_700_000_000 // HOUR * HOUR
+
+@pytest.fixture(autouse=True)
+def history_dir():
+    os.makedirs(history_store.HISTORY_DIR)
+    return history_store.HISTORY_DIR
+
+def values(temp, humidity=50.0):
+    return (temp, math.nan, math.nan, humidity, 1013.0, 3.5, 1.25)
+
+def hours(*temps, start=T0):
+    return [(start + i * HOUR, values(t)) for i, t in enumerate(temps) if t is not None]
+
+def path():
+    return history_store.series_path('observed', KEY)
+
+def header():
+    with open(path(), 'rb') as f:
+        return history_store.HEADER.unpack(f.read(history_store.HEADER.size))
+
+def temps(start=T0 - 10 * HOUR, end=T0 + 100 * HOUR):
+    result = history_store.query('observed', KEY, start, end, columns=('temp',))
+    return list(zip(result['ts'], result['temp']))
+
+def test_records_are_fixed_width_slots():
+    history_store.write('observed', KEY, hours(10.0, 11.0, None, 13.0))
+    assert header() == (history_store.MAGIC, HOUR, T0 // HOUR)
+    assert os.path.getsize(path()) == history_store.HEADER.size + 4 * history_store.RECORD.size
+    with open(path(), 'rb') as f:
+        f.seek(history_store.HEADER.size + 3 * history_store.RECORD.size)
+        ts, temp, temp_min, temp_max, *rest = history_store.RECORD.unpack(f.read(history_store.RECORD.size))
+    assert (ts, temp, rest) == (T0 + 3 * HOUR, 13.0, [50.0, 1013.0, 3.5, 1.25])
+    assert math.isnan(temp_min) and math.isnan(temp_max)
+    # The empty slot is a hole and is skipped
+    assert temps() == [(T0, 10.0), (T0 + HOUR, 11.0), (T0 + 3 * HOUR, 13.0)]
+
+def test_later_readings_win_and_older_ones_are_ignored():
+    history_store.write('observed', KEY, hours(10.0, 11.0))
+    history_store.write('observed', KEY, [(T0 + HOUR + 1800, values(11.5)), (T0 - HOUR, values(9.0)),
+                                          (T0 + 5 * HOUR, values(15.0))])
+    assert temps() == [(T0, 10.0), (T0 + HOUR + 1800, 11.5), (T0 + 5 * HOUR, 15.0)]
+
+def test_reads_stop_at_the_file_boundaries():
+    history_store.write('observed', KEY, hours(10.0, 11.0, 12.0, 13.0))
+    assert temps(T0 - 5 * HOUR, T0 + HOUR) == [(T0, 10.0), (T0 + HOUR, 11.0)]
+    assert temps(T0 + 2 * HOUR, T0 + 50 * HOUR) == [(T0 + 2 * HOUR, 12.0), (T0 + 3 * HOUR, 13.0)]
+    assert temps(T0 - 5 * HOUR, T0 - HOUR) == [] and temps(T0 + 4 * HOUR, T0 + 9 * HOUR) == []
+    stamps, columns = history_store.read_slice('observed', KEY, T0 + 3 * HOUR, T0 + 3 * HOUR)
+    assert list(stamps) == [T0 + 3 * HOUR] and list(columns['humidity']) == [50.0]
+    assert history_store.read_slice('observed', 'no,where', T0, T0 + HOUR) == (history_store.array('I'), {})
+
+def test_query_averages_into_buckets():
+    history_store.write('observed', KEY, hours(10.0, 12.0, 14.0, 16.0, 18.0))
+    result = history_store.query('observed', KEY, T0, T0 + 4 * HOUR, points=2)
+    assert result['ts'] == [T0 + HOUR, T0 + 3 * HOUR + 1800]
+    assert result['temp'] == [12.0, 17.0] and result['temp_min'] == [None, None]
+
+def test_trim_keeps_the_newest_slots():
+    history_store.write('observed', KEY, hours(*[float(i) for i in range(10)]))
+    history_store.trim(path(), 3)
+    assert header() == (history_store.MAGIC, HOUR, T0 // HOUR + 7)
+    assert os.path.getsize(path()) == history_store.HEADER.size + 3 * history_store.RECORD.size
+    assert temps() == [(T0 + 7 * HOUR, 7.0), (T0 + 8 * HOUR, 8.0), (T0 + 9 * HOUR, 9.0)]
+    # New rows land in the right slots; rows before the new start are ignored
+    history_store.write('observed', KEY, [(T0 + 2 * HOUR, values(-1.0)), (T0 + 11 * HOUR, values(11.0))])
+    assert temps()[-2:] == [(T0 + 9 * HOUR, 9.0), (T0 + 11 * HOUR, 11.0)] and len(temps()) == 4
+    history_store.trim(path(), 10)
+    assert len(temps()) == 4
+
+def test_trim_keeps_rows_of_a_writer_waiting_on_the_lock(monkeypatch):
+    history_store.write('observed', KEY, hours(*[float(i) for i in range(10)]))
+    # The writer has opened the file and waits for the lock while trim runs
+    waiting, trimmed = threading.Event(), threading.Event()
+    def flock(fd, operation):
+        if threading.current_thread() is writer:
+            waiting.set()
+            trimmed.wait()
+        fcntl.flock(fd, operation)
+    monkeypatch.setattr(history_store, 'fcntl', types.SimpleNamespace(flock=flock, LOCK_EX=fcntl.LOCK_EX,
+                                                                       LOCK_SH=fcntl.LOCK_SH))
+    writer = threading.Thread(target=history_store.write, args=('observed', KEY, [(T0 + 12 * HOUR, values(12.0))]))
+    writer.start()
+    assert waiting.wait(1)
+    history_store.trim(path(), 5)
+    trimmed.set()
+    writer.join()
+    assert header()[2] == T0 // HOUR + 5
+    assert temps()[-2:] == [(T0 + 9 * HOUR, 9.0), (T0 + 12 * HOUR, 12.0)]
+
+def test_trim_waits_for_the_lock():
+    history_store.write('observed', KEY, hours(*[float(i) for i in range(10)]))
+    with open(path(), 'rb') as held:
+        fcntl.flock(held.fileno(), fcntl.LOCK_EX)
+        trim = threading.Thread(target=history_store.trim, args=(path(), 5))
+        trim.start()
+        time.sleep(0.1)
+        assert trim.is_alive() and header()[2] == T0 // HOUR
+        fcntl.flock(held.fileno(), fcntl.LOCK_UN)
+    trim.join()
+    assert header()[2] == T0 // HOUR + 5
+
+def test_record_and_prune(monkeypatch):
+    data = fake_upstream.onecall(39.74, -104.98, fake_upstream.DEFAULTS)
+    history_store.record(KEY, data)
+    now = data['current']['dt']
+    result = history_store.query('hourly', KEY, now, now + 100 * HOUR, columns=('temp', 'uvi'))
+    assert result['temp'] == [round(h['temp'], 2) for h in data['hourly']]
+    daily = history_store.query('daily', KEY, now, now + 30 * 86400, columns=('temp_max',))
+    assert daily['temp_max'] == [round(d['temp']['max'], 2) for d in data['daily']]
+    monkeypatch.setattr(history_store, 'HISTORY_MAX_DAYS', 1)
+    history_store.prune()
+    assert len(history_store.query('hourly', KEY, now, now + 100 * HOUR)['ts']) == 24
+    old = history_store.series_path('daily', KEY)
+    os.utime(old, (time.time() - 15 * 86400,) * 2)
+    history_store.prune()
+    assert not os.path.exists(old) and os.path.exists(history_store.series_path('observed', KEY))
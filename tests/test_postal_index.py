@@ -0,0 +1,85 @@
+import os
+import zipfile
+
+import pytest
+
+import fake_upstream
+import postal_index
+
+# GeoNames columns: country, code, place, admin1 name, admin1 code, admin2 name,
+# admin2 code, admin3 name, admin3 code, lat, lon, accuracy
+ROWS = [('US', f'{80000 + i * 7:05d}', f'Place {i}', 'Colorado', 'CO', '', '', '', '', f'{39 + i / 100:.4f}',
+         f'{-105 + i / 100:.4f}', '4') for i in range(200)]
+ROWS += [('CA', 'K1A 0B1', 'Ottawa', 'Ontario', 'ON', '', '', '', '', '45.4215', '-75.6972', '6'),
+         ('DE', '10115', 'Berlin', 'Berlin', 'BE', '', '', '', '', '52.5323', '13.3846', '4'),
+         ('US', '00501', 'Holtsville', 'New York', 'NY', '', '', '', '', '40.8154', '-73.0451', '4'),
+         ('US', '99950', 'Ketchikan', 'Alaska', 'AK', '', '', '', '', '55.5422', '-131.4320', '1'),
+         # The first place listed for a code wins
+         ('US', '00501', 'Elsewhere', 'New York', 'NY', '', '', '', '', '0', '0', '4'),
+         # Not usable
+         ('US', '12345678901', 'Too long', 'X', 'X', '', '', '', '', '1', '1', '1'),
+         ('US', '55555', 'No coordinates', 'X', 'X', '', '', '', '', '', '', '1'),
+         ('US', '66666', 'Short line')]
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'US.txt'
+    path.write_text(''.join('\t'.join(row) + '\n' for row in ROWS), encoding='utf-8')
+    return str(path)
+
+@pytest.fixture
+def index(source):
+    assert postal_index.build(source, postal_index.INDEX_PATH) == 204
+    return postal_index.INDEX_PATH
+
+def test_build_writes_sorted_fixed_width_records(index):
+    with open(index, 'rb') as f:
+        data = f.read()
+    magic, count, strings = postal_index.HEADER.unpack_from(data, 0)
+    assert (magic, count) == (postal_index.MAGIC, 204)
+    assert strings == postal_index.HEADER.size + count * postal_index.RECORD.size
+    keys = [data[at:at + postal_index.KEY_SIZE] for at in range(postal_index.HEADER.size, strings, postal_index.RECORD.size)]
+    assert keys == sorted(keys) and len(set(keys)) == count
+    assert keys[0] == b'CAK1A 0B1\0\0\0' and keys[-1] == b'US99950\0\0\0\0\0'
+    # Places shared by several codes are stored once
+    assert data.count(b'Berlin\tBE') == 1
+
+def test_lookup_finds_every_code(index):
+    for country, code, place, _, state, *rest in ROWS[:200]:
+        assert postal_index.lookup(code) == (float(rest[4]), float(rest[5]), place, state)
+    # The first and last records, and codes around them
+    assert postal_index.lookup('k1a  0b1', 'ca') == (45.4215, -75.6972, 'Ottawa', 'ON')
+    assert postal_index.lookup('99950', 'US') == (55.5422, -131.432, 'Ketchikan', 'AK')
+    assert postal_index.lookup('00501') == (40.8154, -73.0451, 'Holtsville', 'NY')
+    assert postal_index.lookup('10115', 'DE')[2:] == ('Berlin', 'BE')
+
+def test_missing_codes(index):
+    for zip_code, country in [('00500', None), ('99951', None), ('80001', None), ('K1A 0B0', 'CA'),
+                              ('10115', 'FR'), ('10115', None), ('AAAAA', 'ZZ'), ('55555', None), ('66666', None),
+                              ('12345678901', None), ('', None), ('10115', 'DEU')]:
+        assert postal_index.lookup(zip_code, country) is None
+
+def test_builds_from_a_zip_and_picks_up_a_rebuild(source, tmp_path, monkeypatch):
+    assert postal_index.lookup('00501') is None
+    archive = tmp_path / 'US.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('readme.txt', 'not data\n')
+        z.write(source, 'US.txt')
+    assert postal_index.build(str(archive), postal_index.INDEX_PATH) == 204
+    monkeypatch.setattr(postal_index, 'CHECK_INTERVAL', 0)
+    assert postal_index.lookup('00501')[2] == 'Holtsville'
+    with open(source, 'w') as f:
+        f.write('\t'.join(('US', '00501', 'Rebuilt', 'New York', 'NY', '', '', '', '', '1', '2', '4')) + '\n')
+    postal_index.build(source, postal_index.INDEX_PATH)
+    os.utime(postal_index.INDEX_PATH, (1, 1))
+    assert postal_index.lookup('00501') == (1.0, 2.0, 'Rebuilt', 'NY')
+    assert postal_index.lookup('99950') is None
+
+def test_get_location_skips_the_network(index, monkeypatch):
+    import app
+    before = fake_upstream.STATS['zippopotam']
+    assert app.get_location(None, None, '80007') == (39.01, -104.99, 'Place 1', 'CO')
+    assert fake_upstream.STATS['zippopotam'] == before
+    # Codes the index lacks still go to zippopotam
+    app.get_location(None, None, '80001')
+    assert fake_upstream.STATS['zippopotam'] == before + 1
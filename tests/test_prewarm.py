@@ -0,0 +1,36 @@
+import geocode_cache
+import prewarm
+import spatial
+import usage_log
+
+CAPITALS = {'Paris': (48.8566, 2.3522), 'Tokyo': (35.6762, 139.6503), 'Ottawa': (45.4215, -75.6972)}
+DENVER = spatial.cell_key(39.7392, -104.9750)
+
+def capital(city):
+    return 'onecall', spatial.cell_key(*CAPITALS[city])
+
+def setup_function():
+    for city, (lat, lon) in CAPITALS.items():
+        geocode_cache.store(geocode_cache.city_key(city, None, None), lat, lon, city, None, ttl=None)
+
+def demand(*entries):
+    for feature, key in entries:
+        usage_log.record_demand(feature, key)
+    usage_log.write_demand()
+
+def test_capitals_nobody_asked_for_are_left_cold():
+    assert list(prewarm.candidates()) == []
+    calls = []
+    def refresh(feature, key, pool=None):
+        calls.append((feature, key))
+        return None, False, None
+    assert prewarm.run_pass(refresh, lambda feature: 600) == 0
+    assert calls == []
+
+def test_requested_capitals_follow_the_top_demand(monkeypatch):
+    monkeypatch.setattr(prewarm, 'PREWARM_TOP_N', 1)
+    # Older demand holds raw coordinates; they still count for the capital's cell
+    paris = '%.4f,%.4f' % CAPITALS['Paris']
+    demand(('onecall', DENVER), ('onecall', DENVER), ('onecall', paris), ('air_quality', capital('Tokyo')[1]))
+    # Tokyo was only asked for air quality and Ottawa not at all
+    assert list(prewarm.candidates()) == [('onecall', DENVER), capital('Paris')]
@@ -0,0 +1,83 @@
+import re
+
+import pytest
+
+import fake_upstream
+import projection
+
+DENVER = (39.7392, -104.9750)
+
+@pytest.fixture
+def app(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    monkeypatch.setattr(app, 'get_location', lambda city, state, zip_code, country=None: DENVER + ('Denver', 'CO'))
+    return app
+
+@pytest.fixture
+def forecast(app):
+    """A full /api/forecast payload."""
+    return app.build_forecast(fake_upstream.onecall(*DENVER, fake_upstream.DEFAULTS), 'Denver', 'CO', *DENVER, 'US')
+
+def row(columns, i):
+    if isinstance(columns, dict):
+        return {k: row(v, i) for k, v in columns.items()}
+    return columns[i]
+
+def test_parse_normalises_and_validates():
+    assert projection.parse({'fields': ' hourly.temp,daily , hourly.temp'}, 'forecast') == ('daily,hourly.temp', 'rows')
+    assert projection.parse({'profile': 'chart', 'fields': 'daily.dt', 'format': 'columns'}, 'forecast') == \
+        ('daily.dt,hourly.dt,hourly.temp', 'columns')
+    assert projection.parse({}, 'weather') == ('', 'rows')
+    for data, error in [({'fields': 'hourly..temp'}, "Invalid field 'hourly..temp'"),
+                        ({'fields': 'hourly.temp;drop'}, "Invalid field 'hourly.temp;drop'"),
+                        ({'format': 'csv'}, "Unknown format 'csv'. Available: rows, columns"),
+                        ({'profile': 'page'}, "Unknown profile 'page'. Available: summary"),
+                        ({'fields': ','.join(f'f{i}' for i in range(51))}, 'At most 50 fields')]:
+        with pytest.raises(ValueError, match=re.escape(error)):
+            projection.parse(data, 'weather')
+
+def test_field_tree_keeps_the_widest_path():
+    assert projection.field_tree('daily.temp.max,daily.dt,hourly') == \
+        {'daily': {'temp': {'max': True}, 'dt': True}, 'hourly': True}
+    assert projection.field_tree('daily,daily.temp.max') == {'daily': True}
+
+def test_nested_paths_apply_to_every_list_element(forecast):
+    data = projection.apply(forecast, 'daily.temp.max,daily.weather.main,hourly.dt,location.city', 'rows')
+    assert data['location'] == {'city': 'Denver'}
+    assert data['hourly'] == [{'dt': h['dt']} for h in forecast['hourly']]
+    assert data['daily'] == [{'temp': {'max': d['temp']['max']}, 'weather': [{'main': w['main']} for w in d['weather']]}
+                             for d in forecast['daily']]
+    assert projection.apply(forecast, '', 'rows') is forecast
+
+def test_unknown_fields_are_left_out(forecast):
+    assert projection.apply(forecast, 'nope,daily.nope,hourly.temp.nope', 'rows') == \
+        {'daily': [{}] * len(forecast['daily']), 'hourly': [{'temp': h['temp']} for h in forecast['hourly']]}
+
+def test_columns_hold_the_full_payload(forecast):
+    data = projection.apply(forecast, '', 'columns')
+    assert data['location'] == forecast['location'] and data['timezone_offset'] == forecast['timezone_offset']
+    for series in ['hourly', 'daily']:
+        assert set(data[series]) == set(forecast[series][0])
+        assert [row(data[series], i) for i in range(len(forecast[series]))] == forecast[series]
+    assert data['daily']['temp']['max'] == [d['temp']['max'] for d in forecast['daily']]
+    # Rows missing a key get None in its column
+    assert projection.columns([{'a': 1}, {'b': 2}]) == {'a': [1, None], 'b': [None, 2]}
+    assert projection.columns([]) == []
+
+def test_columns_after_projection(forecast):
+    data = projection.apply(forecast, 'hourly.dt,hourly.temp,daily.temp.min', 'columns')
+    assert data == {'hourly': {'dt': [h['dt'] for h in forecast['hourly']], 'temp': [h['temp'] for h in forecast['hourly']]},
+                    'daily': {'temp': {'min': [d['temp']['min'] for d in forecast['daily']]}}}
+
+def test_shapes_are_stored_apart(app):
+    client = app.app.test_client()
+    for _ in range(2):
+        full = client.get('/api/forecast?zip_code=80202&units=metric').get_json()
+        chart = client.get('/api/forecast?zip_code=80202&units=metric&profile=chart&format=columns').get_json()
+    assert full['cached'] and chart['cached']
+    assert set(full['data']) == {'daily', 'hourly', 'location', 'timezone_offset'}
+    assert chart['data'] == {'hourly': {'dt': [h['dt'] for h in full['data']['hourly']],
+                                        'temp': [h['temp'] for h in full['data']['hourly']]}}
+    bad = client.get('/api/forecast?zip_code=80202&fields=hourly..temp').get_json()
+    assert bad == {'success': False, 'error': "Invalid field 'hourly..temp'"}
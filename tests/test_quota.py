@@ -0,0 +1,109 @@
+import time
+import sqlite3
+import threading
+import multiprocessing
+
+import cache_store
+import quota
+
+def charge_many(n, results):
+    results.put(sum(quota.charge('onecall')[0] for _ in range(n)))
+
+def test_daily_limit_is_exact_across_threads(monkeypatch):
+    monkeypatch.setattr(quota, 'API_DAILY_LIMIT', 20)
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {'onecall': (0, 1000)})
+    allowed = []
+    threads = [threading.Thread(target=lambda: allowed.append(sum(quota.charge('onecall')[0] for _ in range(10))))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(allowed) == 20
+    assert quota.usage()[1] == 20
+    assert quota.charge('onecall') == (False, 'API daily limit of 20 reached. Try again tomorrow.')
+
+def test_daily_limit_is_exact_across_processes(monkeypatch):
+    monkeypatch.setattr(quota, 'API_DAILY_LIMIT', 25)
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {'onecall': (0, 1000)})
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=charge_many, args=(15, results)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert sum(results.get() for _ in procs) == 25
+    assert quota.usage()[1] == 25
+
+def test_endpoint_bucket_refills(monkeypatch):
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {'zippopotam': (1.0, 3)})
+    assert [quota.charge('zippopotam', daily=False)[0] for _ in range(4)] == [True, True, True, False]
+    assert quota.charge('zippopotam', daily=False)[1] == 'Upstream rate limit reached. Try again in a minute.'
+    # Two seconds later two tokens are back
+    cache_store.connect().execute('UPDATE quota_buckets SET updated = updated - 2')
+    assert [quota.charge('zippopotam', daily=False)[0] for _ in range(3)] == [True, True, False]
+
+def test_client_bucket_applies_to_billed_calls_only(monkeypatch):
+    monkeypatch.setattr(quota, 'CLIENT_BUCKET', (0, 2))
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {})
+    assert [quota.charge('onecall', 'a')[0] for _ in range(3)] == [True, True, False]
+    assert quota.charge('onecall', 'a')[1].startswith('Too many requests')
+    assert quota.charge('onecall', 'b')[0]
+    assert quota.charge('geocode', 'a', daily=False)[0]
+    # Refused calls are not counted against the day
+    assert quota.usage()[1] == 3
+
+def test_refused_call_takes_nothing(monkeypatch):
+    monkeypatch.setattr(quota, 'API_DAILY_LIMIT', 1)
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {'onecall': (0, 5)})
+    assert quota.charge('onecall')[0]
+    assert not quota.charge('onecall')[0]
+    # The endpoint token taken before the daily check was rolled back
+    tokens = cache_store.connect().execute("SELECT tokens FROM quota_buckets WHERE name = 'endpoint:onecall'").fetchone()
+    assert tokens == (4,)
+
+def test_pool_is_a_share_of_the_day(monkeypatch):
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {})
+    pool = ('prewarm', 2)
+    assert [quota.charge('onecall', pool=pool)[0] for _ in range(3)] == [True, True, False]
+    assert quota.charge('onecall', pool=pool)[1] == 'Daily prewarm budget reached.'
+    assert quota.usage('prewarm')[1] == 2
+    assert quota.usage()[1] == 2
+    assert quota.charge('onecall')[0]
+
+def test_locked_counters_refuse_the_call(db, monkeypatch):
+    monkeypatch.setattr(quota, 'ENDPOINT_BUCKETS', {})
+    assert quota.charge('onecall')[0]
+    other = sqlite3.connect(db, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        quota.connect().execute('PRAGMA busy_timeout = 50')
+        assert quota.charge('onecall') == (False, 'Usage counter unavailable. Try again shortly.')
+    finally:
+        other.execute('ROLLBACK')
+    assert quota.usage()[1] == 1
+
+def test_rollover_hooks_run_once_off_the_request_path(monkeypatch):
+    ran = []
+    started = threading.Event()
+    def slow_hook(day):
+        started.set()
+        time.sleep(0.3)
+        ran.append(day)
+    monkeypatch.setattr(quota, 'ROLLOVER_HOOKS', [slow_hook])
+    t = time.perf_counter()
+    day = quota.today()
+    assert time.perf_counter() - t < 0.2
+    assert started.wait(1)
+    # Other callers do not wait for the hooks either
+    t = time.perf_counter()
+    assert quota.today() == day
+    assert time.perf_counter() - t < 0.1
+    quota._rollover_thread.join()
+    assert ran == [day]
+    # Another process starting the same day does not run them again
+    monkeypatch.setattr(quota, '_day_ends', 0)
+    quota.today()
+    quota._rollover_thread.join()
+    assert ran == [day]
@@ -0,0 +1,63 @@
+import gzip
+
+import pytest
+
+import cache_store
+
+DENVER = (39.7392, -104.9750)
+
+@pytest.fixture
+def client(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    monkeypatch.setattr(app, 'get_location', lambda city, state, zip_code, country=None: DENVER + ('Denver', 'CO'))
+    return app.app.test_client()
+
+def warm(client, path):
+    """Fetch path until its body is stored (the first response is a cache miss)."""
+    client.get(path)
+    return client.get(path)
+
+def test_conditional_get_returns_304(client):
+    resp = warm(client, '/api/weather?zip_code=80202')
+    assert resp.status_code == 200 and resp.headers['Cache-Control'] == 'no-cache'
+    etag = resp.headers['ETag']
+    again = client.get('/api/weather?zip_code=80202', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b'' and again.headers['ETag'] == etag
+    since = client.get('/api/weather?zip_code=80202', headers={'If-Modified-Since': resp.headers['Last-Modified']})
+    assert since.status_code == 304
+    # Another variant of the same entry is another representation
+    other = client.get('/api/weather?zip_code=80202&units=metric', headers={'If-None-Match': etag})
+    assert other.status_code == 200 and other.headers['ETag'] != etag
+
+def test_gzip_and_identity_have_their_own_etags(client):
+    plain = warm(client, '/api/forecast?zip_code=80202')
+    packed = client.get('/api/forecast?zip_code=80202', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers and packed.headers['Content-Encoding'] == 'gzip'
+    assert plain.headers['Vary'] == packed.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(packed.data) == plain.data
+    assert packed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gz"'
+    # An ETag only matches the encoding it was sent with
+    assert client.get('/api/forecast?zip_code=80202', headers={'If-None-Match': packed.headers['ETag']}).status_code == 200
+    assert client.get('/api/forecast?zip_code=80202', headers={'Accept-Encoding': 'gzip',
+                      'If-None-Match': packed.headers['ETag']}).status_code == 304
+
+def test_small_bodies_are_not_gzipped(client):
+    resp = warm(client, '/api/uv?zip_code=80202')
+    resp = client.get('/api/uv?zip_code=80202', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200 and 'Content-Encoding' not in resp.headers and 'Vary' not in resp.headers
+
+def test_refreshed_entry_drops_its_stored_bodies(client):
+    import app
+    old = warm(client, '/api/weather?zip_code=80202')
+    assert old.get_json()['cached'] is True
+    key = app.location_key(*DENVER)
+    ts, result = cache_store.get_entry('onecall', key)
+    assert cache_store.connect().execute('SELECT COUNT(*) FROM rendered WHERE ts = ?', (ts,)).fetchone() == (1,)
+    # -40 reads the same in °C and °F
+    result = dict(result, current=dict(result['current'], temp=-40.0))
+    cache_store.set_entry('onecall', key, result)
+    assert cache_store.connect().execute('SELECT COUNT(*) FROM rendered').fetchone() == (0,)
+    new = client.get('/api/weather?zip_code=80202', headers={'If-None-Match': old.headers['ETag']})
+    assert new.status_code == 200 and new.headers['ETag'] != old.headers['ETag']
+    assert new.get_json()['data']['current']['temp'] == -40.0
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import threading
+import multiprocessing
+
+import pytest
+
+import cache_store
+import singleflight
+
+def test_threads_share_one_fetch():
+    calls = []
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'n': len(calls)}
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(singleflight.do('k', fetch, lambda: None)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [{'n': 1}] * 8
+    assert not singleflight.lease_held('k')
+
+def test_followers_get_the_leaders_error():
+    started = threading.Event()
+    def fetch():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('upstream down')
+    errors = []
+    def run():
+        try:
+            singleflight.do('k', fetch, lambda: None)
+        except ValueError as e:
+            errors.append(str(e))
+    leader = threading.Thread(target=run)
+    leader.start()
+    started.wait(1)
+    followers = [threading.Thread(target=run) for _ in range(3)]
+    for t in followers:
+        t.start()
+    for t in [leader] + followers:
+        t.join()
+    assert errors == ['upstream down'] * 4
+    assert not singleflight.lease_held('k')
+
+def test_lease_is_exclusive_until_released_or_expired():
+    assert singleflight.acquire_lease('k', ttl=0.2)
+    assert not singleflight.acquire_lease('k')
+    # Only the owner can release it
+    other = threading.Thread(target=singleflight.release_lease, args=('k',))
+    other.start()
+    other.join()
+    assert singleflight.lease_held('k')
+    time.sleep(0.25)
+    assert singleflight.acquire_lease('k')
+    singleflight.release_lease('k')
+    assert not singleflight.lease_held('k')
+
+def fetch_in_child(path, done):
+    def fetch():
+        with open(path, 'a') as f:
+            f.write('fetch\n')
+        time.sleep(0.3)
+        cache_store.set_entry('onecall', 'k', {'from': 'leader'})
+        return {'from': 'leader'}
+    def check():
+        entry = cache_store.get_entry('onecall', 'k')
+        return entry[1] if entry else None
+    done.put(singleflight.do('onecall:k', fetch, check))
+
+def test_processes_share_one_fetch(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    done = ctx.Queue()
+    log = str(tmp_path / 'fetches')
+    procs = [ctx.Process(target=fetch_in_child, args=(log, done)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    results = [done.get(timeout=10) for _ in procs]
+    for p in procs:
+        p.join()
+    assert results == [{'from': 'leader'}] * 4
+    with open(log) as f:
+        assert f.read() == 'fetch\n'
+
+def test_waiter_takes_over_an_abandoned_lease(monkeypatch):
+    monkeypatch.setattr(singleflight, 'POLL_INTERVAL', 0.01)
+    # A process that died while fetching leaves its lease behind until it expires
+    singleflight.connect().execute("INSERT INTO leases (key, owner, expires) VALUES ('k', 'gone:1', ?)",
+                                   (time.time() + 0.2,))
+    start = time.perf_counter()
+    assert singleflight.do('k', lambda: 'mine', lambda: None) == 'mine'
+    assert 0.15 < time.perf_counter() - start < 2
+
+def test_async_callers_share_one_fetch():
+    calls = []
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'result'
+    async def check():
+        return None
+    async def main():
+        return await asyncio.gather(*(singleflight.do_async('k', fetch, check) for _ in range(10)))
+    assert asyncio.run(main()) == ['result'] * 10
+    assert calls == [1]
+
+def test_cancelled_follower_does_not_cancel_the_fetch():
+    async def fetch():
+        await asyncio.sleep(0.1)
+        return 'result'
+    async def check():
+        return None
+    async def main():
+        leader = asyncio.ensure_future(singleflight.do_async('k', fetch, check))
+        follower = asyncio.ensure_future(singleflight.do_async('k', fetch, check))
+        await asyncio.sleep(0.02)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+    assert asyncio.run(main()) == 'result'
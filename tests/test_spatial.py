@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import fake_upstream
+import cache_store
+import spatial
+
+ONECALL = 'openweathermap:/data/3.0/onecall'
+
+@pytest.fixture
+def app(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'API_KEY', 'test-key')
+    return app
+
+def cache(feature, key, age=0):
+    cache_store.set_entry(feature, key, {'key': key}, ts=time.time() - age)
+    spatial.index(feature, key)
+
+def test_nearby_points_share_a_cell():
+    assert spatial.cell_key(39.7392, -104.9750) == spatial.cell_key(39.7401, -104.9850) == '39.7400,-104.9800'
+    assert spatial.cell_key(39.7392, -104.9750) != spatial.cell_key(39.7601, -104.9750)
+    assert spatial.snap_key('39.7392,-104.9750,imperial') == '39.7400,-104.9800'
+
+def test_nearest_picks_the_closest_fresh_entry():
+    cache('onecall', '39.7400,-104.9800')
+    cache('onecall', '39.7600,-104.9800')  # 2.2 km
+    cache('onecall', '39.7800,-104.9800')  # 4.4 km
+    cache('onecall', '39.7200,-104.9800', age=3600)  # closest, but too old
+    cache('air_quality', '39.7400,-104.9600')  # other feature
+    cache('onecall', '39.8200,-104.9800')  # 8.9 km, outside the radius
+    assert spatial.nearest('onecall', '39.7400,-104.9800', 600)[0] == '39.7600,-104.9800'
+    assert spatial.nearest('onecall', '39.8000,-104.9800', 600)[0] == '39.7800,-104.9800'
+    assert spatial.nearest('onecall', '39.9000,-104.9800', 600) is None
+    assert spatial.nearest('onecall', '39.7000,-104.9800', 7200)[0] == '39.7200,-104.9800'
+
+def test_nearest_scales_longitude_with_latitude():
+    cache('onecall', '64.0000,-147.0000')
+    # 0.08 degrees of longitude at 64N is about 3.9 km; the same at the equator is 8.9 km
+    assert spatial.nearest('onecall', '64.0000,-147.0800', 600)[0] == '64.0000,-147.0000'
+    cache('onecall', '0.0000,10.0000')
+    assert spatial.nearest('onecall', '0.0000,10.0800', 600) is None
+
+def test_prune_forgets_evicted_entries():
+    cache('onecall', '39.7600,-104.9800')
+    cache_store.connect().execute('DELETE FROM cache')
+    spatial.prune()
+    assert spatial.connect().execute('SELECT COUNT(*) FROM cache_locations').fetchone() == (0,)
+
+def test_neighbouring_cell_reuses_the_upstream_result(app):
+    before = fake_upstream.STATS[ONECALL]
+    result, cached, error = app.fetch_onecall(39.7392, -104.9750, 'Weather', 'test')
+    assert error is None and not cached
+    assert fake_upstream.STATS[ONECALL] == before + 1
+    # 2.2 km north: another cell, answered from the first one's entry
+    near, cached, error = app.fetch_onecall(39.7601, -104.9750, 'Weather', 'test')
+    assert error is None and cached and near == result
+    assert fake_upstream.STATS[ONECALL] == before + 1
+    assert cache_store.get_entry('onecall', '39.7600,-104.9800')[0] == cache_store.get_entry('onecall', '39.7400,-104.9800')[0]
+    # Far away: upstream again
+    app.fetch_onecall(40.0150, -105.2705, 'Weather', 'test')
+    assert fake_upstream.STATS[ONECALL] == before + 2
+
+def test_refresh_does_not_copy_back_older_data(app):
+    cache('onecall', '39.7600,-104.9800', age=300)
+    cache('onecall', '39.7400,-104.9800', age=60)
+    assert app.nearby_hit('onecall', '39.7400,-104.9800', refresh=True) is None
+    assert app.nearby_hit('onecall', '39.7400,-104.9800')[0] == {'key': '39.7600,-104.9800'}
+
+def test_places_in_one_cell_keep_their_own_bodies(app, monkeypatch):
+    places = {'80202': (39.7392, -104.9750), '80204': (39.7401, -104.9850)}
+    assert spatial.cell_key(*places['80202']) == spatial.cell_key(*places['80204'])
+    monkeypatch.setattr(app, 'get_location', lambda city, state, zip_code, country=None:
+                        places[zip_code] + ('Denver', 'CO'))
+    client = app.app.test_client()
+    etags = {}
+    for zip_code in ['80202', '80204'] * 3:
+        resp = client.get(f'/api/weather?zip_code={zip_code}')
+        location = resp.get_json()['data']['location']
+        assert (location['lat'], location['lon']) == places[zip_code]
+        etags.setdefault(zip_code, set()).add(resp.headers['ETag'])
+    assert len(etags['80204']) == 1 and etags['80204'].isdisjoint(etags['80202'])
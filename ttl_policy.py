@@ -0,0 +1,116 @@
+# Weather Alert Pro - cache lifetimes paced to the daily upstream budget
+# Copyright (c) 2025 Donald Bryant
+# Decides how long cached data counts as fresh, per view, and what to do when
+# the daily quota is gone.
+#
+# - Each view has its own base TTL: alerts go stale quickly, UV, forecasts and
+#   air quality slowly. Views of the shared One Call entry (weather, forecast,
+#   alerts, uv) judge its age by their own TTL, so an alerts request may
+#   refresh an entry a UV request still accepts.
+# - TTLs stretch while the budget runs ahead of the clock: with a share r of
+#   the daily limit left and a share f of the day left, every TTL is multiplied
+#   by f / r (capped at MAX_STRETCH and each view's MAX_TTLS). Upstream calls
+#   for a busy location fall roughly in proportion, so the remaining calls last
+#   until midnight instead of running out in the afternoon.
+# - Once the budget is spent (or a call is refused by the rate limits, or the
+#   service is failing; see breaker.py), the newest cached data is served at
+#   any age. mark_stale() flags the request;
+#   the response then carries "stale": true, "data_age" (seconds) and a
+#   'Warning: 110' header instead of an error.
+import time
+import threading
+import contextvars
+
+import quota
+
+BASE_TTLS = {
+    'weather': 900,
+    'forecast': 1800,
+    'alerts': 300,
+    'uv': 1800,
+    'air_quality': 3600,  # OpenWeatherMap updates air pollution hourly
+}
+MAX_TTLS = {
+    'weather': 3 * 3600,
+    'forecast': 6 * 3600,
+    'alerts': 1800,
+    'uv': 3 * 3600,
+    'air_quality': 6 * 3600,
+}
+# The view whose TTL applies when a cache entry is used without a view
+FEATURE_VIEWS = {'onecall': 'weather', 'air_quality': 'air_quality'}
+DEFAULT_TTL = 900
+MAX_STRETCH = 4.0
+PACE_REFRESH = 30  # seconds a process reuses its reading of the daily counter
+# Oldest neighbouring entry served when a location has no data of its own
+STALE_NEIGHBOR_MAX_AGE = 86400
+STALE_WARNING = '110 - "Response is Stale"'
+
+_pace = (0, 1.0, False)  # (read at, stretch, exhausted)
+_pace_lock = threading.Lock()
+_request = contextvars.ContextVar('ttl_policy_request', default=None)
+
+def day_left(now=None):
+    """Share of the local day still to come, from 1.0 at midnight to 0.0."""
+    t = time.localtime(now)
+    return 1.0 - (t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec) / 86400.0
+
+def pace():
+    """Return (stretch, exhausted) for the current budget, re-read every PACE_REFRESH seconds."""
+    global _pace
+    now = time.time()
+    if now - _pace[0] < PACE_REFRESH:
+        return _pace[1], _pace[2]
+    with _pace_lock:
+        if now - _pace[0] >= PACE_REFRESH:
+            day, used = quota.usage()
+            remaining = max(0, quota.API_DAILY_LIMIT - used) / float(max(1, quota.API_DAILY_LIMIT))
+            share = day_left(now)
+            if remaining >= share:
+                stretch = 1.0
+            elif remaining <= 0:
+                stretch = MAX_STRETCH
+            else:
+                stretch = min(MAX_STRETCH, share / remaining)
+            _pace = (now, stretch, remaining <= 0)
+    return _pace[1], _pace[2]
+
+def stretch():
+    return pace()[0]
+
+def exhausted():
+    """True once today's upstream budget is spent."""
+    return pace()[1]
+
+def ttl(view):
+    """Seconds cached data stays fresh for view (or a cache feature name)."""
+    view = FEATURE_VIEWS.get(view, view)
+    base = BASE_TTLS.get(view, DEFAULT_TTL)
+    return min(MAX_TTLS.get(view, base), base * stretch())
+
+def view_of(variant):
+    """The view a stored response variant ('weather|imperial|...') belongs to."""
+    return variant.split('|', 1)[0]
+
+# --- Stale responses ---
+def begin():
+    """Start a request in the current context (nothing is stale yet)."""
+    _request.set({})
+
+def mark_stale(ts):
+    """Record that the current response includes data cached at ts, past its TTL."""
+    state = _request.get()
+    if state is not None:
+        state['oldest'] = min(ts, state.get('oldest', ts))
+
+def stale_age():
+    """Age in seconds of the oldest stale data in the current response, or None."""
+    state = _request.get()
+    if not state or 'oldest' not in state:
+        return None
+    return max(0, int(time.time() - state['oldest']))
+
+def stale_fields():
+    """Extra response fields for a stale response ({} when the data is fresh)."""
+    age = stale_age()
+    return {} if age is None else {'stale': True, 'data_age': age}
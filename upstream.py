@@ -0,0 +1,221 @@
+# Weather Alert Pro - shared HTTP client for upstream services
+# Copyright (c) 2025 Donald Bryant
+# Every call to OpenWeatherMap, zippopotam.us and ip-api.com goes through get().
+#
+# - One requests.Session per host with a sized connection pool, so a persistent
+#   server reuses TCP/TLS connections instead of handshaking on every call.
+# - Consistent (connect, read) timeouts; callers may shorten the read timeout.
+# - Bounded retries with jittered exponential backoff on connection failures,
+#   429 and 5xx, honouring Retry-After when it is short. Read timeouts are not
+#   retried: the caller has already waited the full timeout once.
+# - At most HOST_CONCURRENCY requests in flight per host per process.
+# - The base URL of each service can be overridden from the environment, e.g. to
+#   run against the local stand-ins in fake_upstream.py (see benchmark.py).
+# - Every attempt is counted and timed per host (see metrics.py); the whole call,
+#   retries included, is the 'upstream' phase of the request.
+# - Every attempt also feeds the host's circuit breaker (see breaker.py). While
+#   a circuit is open, calls raise CircuitOpenError at once. probe() sends the
+#   recovery trial for a half-open circuit.
+#
+# aget() applies the same policy with httpx for the asyncio serving path
+# (asgi.py); httpx is only imported when it is used.
+import os
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import breaker
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.5  # seconds; doubles per retry, with full jitter
+MAX_RETRY_AFTER = 5  # give up rather than honour a longer Retry-After
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POOL_SIZE = 10
+OPENWEATHERMAP_URL = os.environ.get('WEATHER_OPENWEATHERMAP_URL', 'https://api.openweathermap.org').rstrip('/')
+ZIPPOPOTAM_URL = os.environ.get('WEATHER_ZIPPOPOTAM_URL', 'https://api.zippopotam.us').rstrip('/')
+IP_API_URL = os.environ.get('WEATHER_IP_API_URL', 'http://ip-api.com').rstrip('/')
+# Keyed by host[:port] of the base URLs above
+HOST_CONCURRENCY = {
+    urlsplit(OPENWEATHERMAP_URL).netloc: 8,
+    urlsplit(ZIPPOPOTAM_URL).netloc: 4,
+    urlsplit(IP_API_URL).netloc: 2,
+}
+DEFAULT_HOST_CONCURRENCY = 4
+USER_AGENT = 'WeatherAlertPro/1.0.1'
+# Cheap requests that show a host is answering again. None of them is billed:
+# OpenWeatherMap answers a request without a key with a 401.
+PROBE_URLS = {
+    urlsplit(OPENWEATHERMAP_URL).netloc: f'{OPENWEATHERMAP_URL}/data/2.5/weather?q=London',
+    urlsplit(ZIPPOPOTAM_URL).netloc: f'{ZIPPOPOTAM_URL}/us/90210',
+    urlsplit(IP_API_URL).netloc: f'{IP_API_URL}/json/?fields=status',
+}
+
+class CircuitOpenError(requests.ConnectionError):
+    """The host's circuit breaker is open; no request was sent."""
+
+_sessions = {}
+_semaphores = {}
+_lock = threading.Lock()
+_pid = None
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+def _host_state(host):
+    global _pid
+    with _lock:
+        # Pools and semaphores must not be shared with a forked child
+        if _pid != os.getpid():
+            _sessions.clear()
+            _semaphores.clear()
+            _pid = os.getpid()
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = USER_AGENT
+            _sessions[host] = session
+            _semaphores[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+        return session, _semaphores[host]
+
+def _backoff(attempt, resp=None):
+    if resp is not None:
+        retry_after = resp.headers.get('Retry-After', '')
+        if retry_after.isdigit() and int(retry_after) <= MAX_RETRY_AFTER:
+            return int(retry_after)
+    return random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+
+def _record(host, start, status=None, error=None):
+    """Count and time one attempt; return (ok, seconds) for the circuit breaker."""
+    seconds = time.perf_counter() - start
+    metrics.observe('weather_upstream_seconds', seconds, host=host)
+    if status is not None:
+        metrics.inc('weather_upstream_requests_total', host=host, status=str(status))
+    if error or status >= 400:
+        metrics.inc('weather_upstream_errors_total', host=host, error=error or str(status))
+    return not error and status not in RETRY_STATUSES, seconds
+
+def _refused(host):
+    metrics.inc('weather_upstream_errors_total', host=host, error='circuit_open')
+    return f'{host} is unavailable (circuit open)'
+
+@metrics.timed('upstream')
+def get(url, params=None, timeout=None, retries=MAX_RETRIES):
+    """GET url through the pooled session for its host.
+
+    Returns the final requests.Response (which may still be an error status) or
+    raises requests.RequestException once the retries are used up, or
+    CircuitOpenError while the host's circuit is open.
+    """
+    host = host_of(url)
+    session, semaphore = _host_state(host)
+    read_timeout = READ_TIMEOUT if timeout is None else timeout
+    for attempt in range(retries + 1):
+        # The trial of a half-open circuit is a single attempt
+        allowed, trial = breaker.admit(host)
+        if not allowed:
+            raise CircuitOpenError(_refused(host))
+        if not semaphore.acquire(timeout=CONNECT_TIMEOUT):
+            metrics.inc('weather_upstream_errors_total', host=host, error='saturated')
+            raise requests.ConnectionError(f'Too many concurrent requests to {host}')
+        start = time.perf_counter()
+        try:
+            resp = session.get(url, params=params, timeout=(CONNECT_TIMEOUT, read_timeout))
+        except requests.RequestException as e:
+            semaphore.release()
+            breaker.record(host, *_record(host, start, error=type(e).__name__), trial=trial)
+            if trial or not isinstance(e, requests.ConnectionError) or attempt == retries:
+                raise
+            resp = None
+        else:
+            semaphore.release()
+            breaker.record(host, *_record(host, start, resp.status_code), trial=trial)
+        if resp is not None and (trial or resp.status_code not in RETRY_STATUSES or attempt == retries):
+            return resp
+        time.sleep(_backoff(attempt, resp))
+
+def probe(host):
+    """Send the trial request for host's half-open circuit, unless another is under way."""
+    url = PROBE_URLS.get(host)
+    if url is None or not breaker.admit(host)[1]:
+        return
+    session, semaphore = _host_state(host)
+    start = time.perf_counter()
+    try:
+        resp = session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException as e:
+        breaker.record(host, *_record(host, start, error=type(e).__name__), trial=True)
+    else:
+        breaker.record(host, *_record(host, start, resp.status_code), trial=True)
+
+# --- asyncio (httpx) ---
+_async_clients = {}
+_async_semaphores = {}
+_async_loop = None
+
+def _async_host_state(host):
+    global _async_loop
+    import httpx
+    loop = asyncio.get_running_loop()
+    # Clients and semaphores belong to the loop that created them
+    if _async_loop is not loop:
+        _async_clients.clear()
+        _async_semaphores.clear()
+        _async_loop = loop
+    client = _async_clients.get(host)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            headers={'User-Agent': USER_AGENT})
+        _async_clients[host] = client
+        _async_semaphores[host] = asyncio.Semaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+    return client, _async_semaphores[host]
+
+@metrics.timed('upstream')
+async def aget(url, params=None, timeout=None, retries=MAX_RETRIES):
+    """Coroutine version of get(); returns an httpx.Response or raises httpx.HTTPError
+    (httpx.ConnectError while the host's circuit is open)."""
+    import httpx
+    host = host_of(url)
+    client, semaphore = _async_host_state(host)
+    read_timeout = READ_TIMEOUT if timeout is None else timeout
+    for attempt in range(retries + 1):
+        allowed, trial = await asyncio.to_thread(breaker.admit, host)
+        if not allowed:
+            raise httpx.ConnectError(_refused(host))
+        try:
+            await asyncio.wait_for(semaphore.acquire(), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.inc('weather_upstream_errors_total', host=host, error='saturated')
+            raise httpx.ConnectError(f'Too many concurrent requests to {host}')
+        start = time.perf_counter()
+        try:
+            resp = await client.get(url, params=params,
+                                    timeout=httpx.Timeout(read_timeout, connect=CONNECT_TIMEOUT))
+        except httpx.HTTPError as e:
+            semaphore.release()
+            await asyncio.to_thread(breaker.record, host, *_record(host, start, error=type(e).__name__), trial=trial)
+            if trial or not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or attempt == retries:
+                raise
+            resp = None
+        else:
+            semaphore.release()
+            await asyncio.to_thread(breaker.record, host, *_record(host, start, resp.status_code), trial=trial)
+        if resp is not None and (trial or resp.status_code not in RETRY_STATUSES or attempt == retries):
+            return resp
+        await asyncio.sleep(_backoff(attempt, resp))
+
+async def aclose():
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
@@ -0,0 +1,337 @@
+# Weather Alert Pro - background API usage log and analytics store
+# Copyright (c) 2025 Donald Bryant
+# Handlers call record() and return immediately; IP geolocation and the writes
+# to the shared database happen off the request path.
+#
+# - Events go to the append-only usage_events table. Its rowid grows with time,
+#   so the latest page is a short index walk from the end and older pages are
+#   fetched with a 'before' cursor; nothing ever reads the whole log.
+# - Each batch also adds to usage_counters, hourly pre-aggregated counts per
+#   endpoint, per client location and per cache outcome (record_cache()).
+#   Dashboards are built from these counters.
+# - In a persistent server, start_worker() runs a thread that resolves IPs
+#   (in-process cache, then the ip_location table, then ip-api.com) and writes
+#   events in batches.
+# - Under plain CGI there is no worker: queued events are written at interpreter
+#   exit using cached locations only, and unknown IPs are marked pending so the
+#   worker or 'python usage_log.py resolve' (e.g. from cron) can fill them in.
+#   ip-api.com is never called while a response is outstanding.
+# - record_demand() counts which cached locations are asked for, per day; the
+#   pre-warm scheduler (prewarm.py) ranks locations by these counts.
+import sys
+import time
+import queue
+import atexit
+import threading
+from collections import Counter
+
+import cache_store
+import metrics
+import quota
+import upstream
+
+IP_LOCATION_TTL = 7 * 86400
+IP_LOOKUP_TIMEOUT = 3
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 2.0  # seconds
+EVENT_RETENTION_DAYS = 7
+COUNTER_RETENTION_DAYS = 90
+MAX_PAGE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ip_location (
+    ip TEXT PRIMARY KEY,
+    location TEXT,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    ip TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_events_ts ON usage_events (ts);
+CREATE TABLE IF NOT EXISTS usage_counters (
+    hour TEXT NOT NULL,  -- local time, 'YYYY-MM-DD HH'
+    kind TEXT NOT NULL,  -- endpoint, location, cache_hit or cache_miss
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (hour, kind, name)
+);
+CREATE TABLE IF NOT EXISTS location_demand (
+    day TEXT NOT NULL,
+    feature TEXT NOT NULL,
+    key TEXT NOT NULL,
+    hits INTEGER NOT NULL,
+    PRIMARY KEY (day, feature, key)
+);
+"""
+
+_events = queue.Queue()
+_demand = Counter()
+_demand_lock = threading.Lock()
+_cache_outcomes = Counter()
+_ip_cache = {}
+_worker = None
+_worker_lock = threading.Lock()
+_schema_ready = threading.local()
+
+def connect():
+    conn = cache_store.connect()
+    if not getattr(_schema_ready, 'done', False):
+        conn.executescript(SCHEMA)
+        _schema_ready.done = True
+    return conn
+
+def record(endpoint, ip):
+    """Queue one usage event; never blocks on I/O."""
+    _events.put((time.time(), endpoint, ip or 'unknown'))
+
+def record_demand(feature, key):
+    """Count one request for a cached location; written with the next batch."""
+    with _demand_lock:
+        _demand[(feature, key)] += 1
+
+def record_cache(feature, hit):
+    """Count one cache hit or miss for feature; written with the next batch."""
+    metrics.inc('weather_cache_requests_total', feature=feature, result='hit' if hit else 'miss')
+    with _demand_lock:
+        _cache_outcomes[(hour_of(time.time()), 'cache_hit' if hit else 'cache_miss', feature)] += 1
+
+def hour_of(ts):
+    return time.strftime('%Y-%m-%d %H', time.localtime(ts))
+
+def write_demand():
+    with _demand_lock:
+        counts = dict(_demand)
+        _demand.clear()
+    if not counts:
+        return
+    day = quota.today()
+    try:
+        connect().executemany('INSERT INTO location_demand (day, feature, key, hits) VALUES (?, ?, ?, ?) '
+                              'ON CONFLICT (day, feature, key) DO UPDATE SET hits = hits + excluded.hits',
+                              [(day, feature, key, hits) for (feature, key), hits in counts.items()])
+    except Exception:
+        pass
+
+def prune_demand(days=7):
+    since = time.strftime('%Y-%m-%d', time.localtime(time.time() - days * 86400))
+    try:
+        connect().execute('DELETE FROM location_demand WHERE day < ?', (since,))
+    except Exception:
+        pass
+
+def top_demand(days=2, limit=50):
+    """Return [(feature, key, hits)] for the most requested locations of the last days."""
+    since = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+    try:
+        return connect().execute('SELECT feature, key, SUM(hits) AS total FROM location_demand WHERE day >= ? '
+                                 'GROUP BY feature, key ORDER BY total DESC LIMIT ?', (since, limit)).fetchall()
+    except Exception:
+        return []
+
+def demanded(days=2):
+    """Return the set of (feature, key) requested at least once in the last days."""
+    since = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+    try:
+        return set(connect().execute('SELECT DISTINCT feature, key FROM location_demand WHERE day >= ?',
+                                     (since,)).fetchall())
+    except Exception:
+        return set()
+
+def cached_location(ip):
+    """Return the known location for ip, or None if it has not been resolved."""
+    hit = _ip_cache.get(ip)
+    if hit and hit[1] > time.time():
+        return hit[0]
+    try:
+        row = connect().execute('SELECT location, expires FROM ip_location WHERE ip = ?', (ip,)).fetchone()
+    except Exception:
+        row = None
+    if row and row[0] is not None and row[1] > time.time():
+        _ip_cache[ip] = (row[0], row[1])
+        return row[0]
+    return None
+
+def mark_pending(ip):
+    try:
+        connect().execute('INSERT OR IGNORE INTO ip_location (ip, location, expires) VALUES (?, NULL, 0)', (ip,))
+    except Exception:
+        pass
+
+def resolve_location(ip):
+    # Network lookup; only ever called from the worker or the resolve command
+    location = 'unknown'
+    if not quota.charge('ip-api', daily=False)[0]:
+        return location
+    try:
+        geo_resp = upstream.get(f'{upstream.IP_API_URL}/json/{ip}', timeout=IP_LOOKUP_TIMEOUT, retries=0)
+        if geo_resp.ok:
+            geo = geo_resp.json()
+            if geo.get('status') == 'success':
+                location = f"{geo.get('city','')}, {geo.get('regionName','')}, {geo.get('country','')}"
+    except Exception:
+        pass
+    expires = time.time() + IP_LOCATION_TTL
+    _ip_cache[ip] = (location, expires)
+    try:
+        connect().execute('INSERT OR REPLACE INTO ip_location (ip, location, expires) VALUES (?, ?, ?)',
+                          (ip, location, expires))
+    except Exception:
+        pass
+    return location
+
+def write_batch(events, resolve=True):
+    write_demand()
+    metrics.flush()
+    with _demand_lock:
+        counters = Counter(_cache_outcomes)
+        _cache_outcomes.clear()
+    for ts, endpoint, ip in events:
+        location = cached_location(ip)
+        if location is None:
+            if resolve:
+                location = resolve_location(ip)
+            else:
+                mark_pending(ip)
+                location = 'unknown'
+        hour = hour_of(ts)
+        counters[(hour, 'endpoint', endpoint)] += 1
+        counters[(hour, 'location', location)] += 1
+    if not events and not counters:
+        return
+    try:
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO usage_events (ts, endpoint, ip) VALUES (?, ?, ?)', events)
+            conn.executemany('INSERT INTO usage_counters (hour, kind, name, count) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (hour, kind, name) DO UPDATE SET count = count + excluded.count',
+                             [(hour, kind, name, n) for (hour, kind, name), n in counters.items()])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    except Exception:
+        pass
+
+def prune(event_days=EVENT_RETENTION_DAYS, counter_days=COUNTER_RETENTION_DAYS):
+    now = time.time()
+    try:
+        conn = connect()
+        conn.execute('DELETE FROM usage_events WHERE ts < ?', (now - event_days * 86400,))
+        conn.execute('DELETE FROM usage_counters WHERE hour < ?', (hour_of(now - counter_days * 86400),))
+    except Exception:
+        pass
+
+# --- Reading (dashboards) ---
+def recent_events(before=None, limit=50):
+    """Return ([(id, ts, endpoint, ip, location)], next_before) newest first.
+
+    Pass next_before back as before to get the following (older) page.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE))
+    sql = ('SELECT e.id, e.ts, e.endpoint, e.ip, COALESCE(l.location, \'unknown\') FROM usage_events e '
+           'LEFT JOIN ip_location l ON l.ip = e.ip')
+    try:
+        if before is None:
+            rows = connect().execute(sql + ' ORDER BY e.id DESC LIMIT ?', (limit,)).fetchall()
+        else:
+            rows = connect().execute(sql + ' WHERE e.id < ? ORDER BY e.id DESC LIMIT ?',
+                                     (int(before), limit)).fetchall()
+    except Exception:
+        return [], None
+    return rows, rows[-1][0] if len(rows) == limit else None
+
+def counter_totals(kind, since_hour, limit=None):
+    """Return [(name, count)] for kind summed over the hours since since_hour, largest first."""
+    sql = ('SELECT name, SUM(count) AS total FROM usage_counters WHERE hour >= ? AND kind = ? '
+           'GROUP BY name ORDER BY total DESC')
+    params = [since_hour, kind]
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    try:
+        return connect().execute(sql, params).fetchall()
+    except Exception:
+        return []
+
+def hourly(hours=24):
+    """Return [(hour, requests, cache_hits, cache_misses)] for the last hours, oldest first."""
+    since = hour_of(time.time() - (hours - 1) * 3600)
+    try:
+        return connect().execute(
+            "SELECT hour, SUM(CASE WHEN kind = 'endpoint' THEN count ELSE 0 END), "
+            "SUM(CASE WHEN kind = 'cache_hit' THEN count ELSE 0 END), "
+            "SUM(CASE WHEN kind = 'cache_miss' THEN count ELSE 0 END) "
+            "FROM usage_counters WHERE hour >= ? AND kind != 'location' GROUP BY hour ORDER BY hour",
+            (since,)).fetchall()
+    except Exception:
+        return []
+
+def summary(hours=24, top=10):
+    """Aggregates for the dashboards: totals per endpoint, client location and cache feature."""
+    since = hour_of(time.time() - (hours - 1) * 3600)
+    hits = dict(counter_totals('cache_hit', since))
+    misses = dict(counter_totals('cache_miss', since))
+    cache = {}
+    for feature in sorted(set(hits) | set(misses)):
+        h, m = hits.get(feature, 0), misses.get(feature, 0)
+        cache[feature] = {'hits': h, 'misses': m, 'hit_ratio': round(h / (h + m), 3) if h + m else None}
+    return {
+        'endpoints': dict(counter_totals('endpoint', since)),
+        'locations': counter_totals('location', since, top),
+        'cache': cache,
+        'hourly': hourly(hours),
+    }
+
+def drain(limit=None):
+    events = []
+    while limit is None or len(events) < limit:
+        try:
+            events.append(_events.get_nowait())
+        except queue.Empty:
+            break
+    return events
+
+def _run():
+    while True:
+        try:
+            first = _events.get(timeout=FLUSH_INTERVAL)
+        except queue.Empty:
+            continue
+        # Give the batch a moment to fill before writing it out
+        deadline = time.time() + FLUSH_INTERVAL
+        events = [first]
+        while len(events) < BATCH_SIZE and time.time() < deadline:
+            try:
+                events.append(_events.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        write_batch(events)
+
+def start_worker():
+    """Start the background writer (persistent server mode)."""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run, name='usage-log', daemon=True)
+            _worker.start()
+
+@atexit.register
+def flush():
+    # Whatever is still queued at exit is written without touching the network
+    write_batch(drain(), resolve=False)
+
+def resolve_pending():
+    rows = connect().execute('SELECT ip FROM ip_location WHERE expires < ?', (time.time(),)).fetchall()
+    for (ip,) in rows:
+        resolve_location(ip)
+    return len(rows)
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['resolve']:
+        print('usage: usage_log.py resolve', file=sys.stderr)
+        sys.exit(2)
+    print(f'resolved {resolve_pending()} addresses')
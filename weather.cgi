@@ -12,12 +12,16 @@ try:
 
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'site-packages'))
 
-    # Patch sys.stdout.write for flup compatibility
+    # Patch sys.stdout.write for flup compatibility: flup writes the headers as
+    # text and the body as bytes, which may be gzipped, so bytes go straight to
+    # the binary buffer (after the text written before them)
     if hasattr(sys.stdout, "buffer"):
         orig_write = sys.stdout.write
         def write_patched(data):
             if isinstance(data, bytes):
-                data = data.decode('utf-8')
+                sys.stdout.flush()
+                sys.stdout.buffer.write(data)
+                return len(data)
             return orig_write(data)
         sys.stdout.write = write_patched
 